@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_FOLDER))
+
+import main
+from synthetic import build_database, build_target_database
+
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_FOLDER, "baseline.json")
+# Diferencia mínima de tiempo que se considera regresión, para no fallar por ruido en chequeos muy rápidos
+MIN_REGRESSION_SECONDS = 0.05
+# Base de destino de la comparación: la sintética con algunas filas distintas
+TARGET_DATABASE = "destino"
+
+
+def prepare(database, target, work_folder):
+    # Las auditorías se conectan al reemplazo local en lugar de SQL Server; la base de destino, por su nombre
+    def connect(connection_string, **kwargs):
+        if f"DATABASE={target.name};" in connection_string:
+            return target.connect()
+        return database.connect()
+
+    main.pyodbc.connect = connect
+    main.app.config["UPLOAD_FOLDER"] = os.path.join(work_folder, "logs")
+    main.audit_state_store = main.AuditStateStore(os.path.join(work_folder, "audit_state.sqlite3"))
+    # La espera adaptativa mide la carga cada pocos segundos y haría variar la cantidad de consultas
+    main.app.config["AUDIT_THROTTLE"] = False
+
+
+def reset_caches():
+    main.schema_catalogs.clear()
+    main.audit_result_cache = main.AuditResultCache(
+        main.app.config["AUDIT_CACHE_MAX_ENTRIES"], main.app.config["AUDIT_CACHE_TTL_SECONDS"]
+    )
+
+
+def run_function(audit):
+    def run(database, pool):
+        profiler = main.QueryProfiler()
+        token = main.current_profiler.set(profiler)
+        try:
+            audit(database.connect(), pool)
+        finally:
+            main.current_profiler.reset(token)
+        return profiler
+
+    return run
+
+
+def in_chunks(audit):
+    # Las tablas sintéticas son chicas: se bajan los umbrales para que el modo por partes las divida
+    def run(connection, pool):
+        previous = main.app.config["AUDIT_CHUNK_THRESHOLD_ROWS"], main.app.config["AUDIT_CHUNK_ROWS"]
+        main.app.config["AUDIT_CHUNK_THRESHOLD_ROWS"], main.app.config["AUDIT_CHUNK_ROWS"] = 1000, 500
+        try:
+            audit(connection, pool)
+        finally:
+            main.app.config["AUDIT_CHUNK_THRESHOLD_ROWS"], main.app.config["AUDIT_CHUNK_ROWS"] = previous
+
+    return run
+
+
+def compare_with_target(connection, pool):
+    # La base de destino se registra en main.connection_manager, como hace /audit con la opción 6
+    target = ("standin", TARGET_DATABASE, "benchmark")
+    main.connection_manager.connect(*target, "benchmark")
+    main.compare_databases(connection, pool, settings={"compare_with": target})
+
+
+def run_audit_route(database, pool):
+    # Flujo completo de la interfaz web: POST /connect y /audit, y consulta del trabajo hasta que termina.
+    # El pool lo administra main.connection_manager, que lo reutiliza entre repeticiones
+    client = main.app.test_client()
+    client.post(
+        "/connect", data={"server": "standin", "database": "standin", "username": "benchmark", "password": "benchmark"}
+    )
+    response = client.post("/audit", data={"option": "4"})
+    if response.status_code != 302:
+        raise RuntimeError(f"/audit respondió {response.status_code}")
+    with client.session_transaction() as session:
+        job_id = session["job_id"]
+    while True:
+        status = client.get(f"/jobs/{job_id}").get_json()
+        if status["status"] not in ("pending", "running"):
+            break
+        time.sleep(0.01)
+    if status["status"] != "finished":
+        raise RuntimeError(f"La auditoría terminó con error: {status['error']}")
+    return main.audit_jobs[job_id].profiler
+
+
+BENCHMARK_CASES = [
+    ("identify_relations", run_function(lambda connection, pool: main.identify_relations(connection))),
+    ("advise_foreign_key_indexes", run_function(lambda connection, pool: main.advise_foreign_key_indexes(connection))),
+    ("check_integrity_anomalies", run_function(lambda connection, pool: main.check_integrity_anomalies(connection, pool))),
+    ("check_data_anomalies", run_function(lambda connection, pool: main.check_data_anomalies(connection, pool))),
+    (
+        "check_data_anomalies[duplicados]",
+        run_function(
+            lambda connection, pool: main.check_data_anomalies(connection, pool, settings={"duplicate_analysis": True})
+        ),
+    ),
+    (
+        "check_data_anomalies[partes]",
+        run_function(
+            in_chunks(lambda connection, pool: main.check_data_anomalies(connection, pool, settings={"chunked": True}))
+        ),
+    ),
+    ("generate_custom_log", run_function(lambda connection, pool: main.generate_custom_log(connection, pool))),
+    ("compare_databases", run_function(compare_with_target)),
+    ("/audit", run_audit_route),
+]
+
+
+def run_benchmarks(database, connections, repeat):
+    main.app.config["AUDIT_MAX_CONNECTIONS"] = connections
+    results = {}
+    for name, run in BENCHMARK_CASES:
+        timings = []
+        for _ in range(repeat):
+            # Cada repetición arranca en frío: sin catálogo ni resultados en caché
+            reset_caches()
+            pool = main.ConnectionPool("standin", connections)
+            started = time.perf_counter()
+            profiler = run(database, pool)
+            timings.append(time.perf_counter() - started)
+            pool.close()
+        results[name] = {
+            "seconds": round(min(timings), 4),
+            "queries": len(profiler.queries),
+            "checks": dict(Counter(query["check"] for query in profiler.queries)),
+        }
+        print(f"{name}: {results[name]['seconds']} s, {results[name]['queries']} consultas")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline["cases"].get(name)
+        if expected is None:
+            print(f"{name}: sin valores de referencia")
+            continue
+        if result["queries"] > expected["queries"]:
+            regressions.append(f"{name}: {expected['queries']} -> {result['queries']} consultas")
+        for check, queries in result["checks"].items():
+            if queries > expected["checks"].get(check, 0):
+                regressions.append(
+                    f"{name} ({check}): {expected['checks'].get(check, 0)} -> {queries} consultas"
+                )
+        limit = max(expected["seconds"] * (1 + tolerance), expected["seconds"] + MIN_REGRESSION_SECONDS)
+        if result["seconds"] > limit:
+            regressions.append(f"{name}: {expected['seconds']} -> {result['seconds']} s")
+    return regressions
+
+
+def main_benchmarks(argv):
+    parser = argparse.ArgumentParser(
+        description="Mide el tiempo y la cantidad de consultas de cada auditoría sobre una base sintética local."
+    )
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--foreign-keys", type=int, default=30)
+    parser.add_argument("--rows", type=int, default=2000, help="filas por tabla")
+    parser.add_argument("--null-rate", type=float, default=0.1)
+    parser.add_argument("--duplicate-skew", type=float, default=0.2, help="fracción de filas con valores repetidos")
+    parser.add_argument("--orphan-rate", type=float, default=0.01, help="fracción de referencias sin fila padre")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--connections", type=int, default=4, help="tamaño del pool de conexiones")
+    parser.add_argument("--repeat", type=int, default=3, help="repeticiones por chequeo (se toma el mejor tiempo)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="aumento de tiempo tolerado (0.5 = 50%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="guarda los resultados como nueva referencia")
+    args = parser.parse_args(argv)
+
+    parameters = {
+        "tables": args.tables,
+        "foreign_keys": args.foreign_keys,
+        "rows": args.rows,
+        "null_rate": args.null_rate,
+        "duplicate_skew": args.duplicate_skew,
+        "orphan_rate": args.orphan_rate,
+        "seed": args.seed,
+        "connections": args.connections,
+    }
+    print("Generando base sintética:", parameters)
+    database = build_database(
+        args.tables, args.foreign_keys, args.rows, args.null_rate, args.duplicate_skew, args.orphan_rate, args.seed
+    )
+    target = build_target_database(
+        args.tables, args.foreign_keys, args.rows, args.null_rate, args.duplicate_skew, args.orphan_rate, args.seed,
+        TARGET_DATABASE,
+    )
+    with tempfile.TemporaryDirectory() as work_folder:
+        prepare(database, target, work_folder)
+        results = run_benchmarks(database, args.connections, args.repeat)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({"parameters": parameters, "cases": results}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Valores de referencia guardados en {args.baseline}.")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No existe {args.baseline}: ejecute con --update-baseline para crearlo.")
+        return 1
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    if baseline["parameters"] != parameters:
+        print("Los valores de referencia se generaron con otros parámetros:", baseline["parameters"])
+        return 1
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESIÓN:", regression)
+    if not regressions:
+        print("Sin regresiones respecto de los valores de referencia.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmarks(sys.argv[1:]))
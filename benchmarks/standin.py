@@ -0,0 +1,426 @@
+import hashlib
+import re
+import sqlite3
+import threading
+
+
+# Reemplazo local de SQL Server para los benchmarks: una base SQLite en memoria con las vistas
+# sys.* e information_schema que consulta main.py, detrás de una interfaz parecida a pyodbc
+
+SYSTEM_TYPE_IDS = {
+    "int": 56,
+    "decimal": 106,
+    "float": 62,
+    "numeric": 108,
+    "char": 175,
+    "varchar": 167,
+    "nchar": 239,
+    "nvarchar": 231,
+    "datetime": 61,
+    "date": 40,
+    "time": 41,
+}
+NUMERIC_TYPES = ("int", "decimal", "float", "numeric")
+HISTOGRAM_STEPS = 200
+
+CATALOG_SCRIPT = """
+CREATE TABLE information_schema.tables(table_catalog, table_schema, table_name, table_type);
+CREATE TABLE information_schema.columns(table_catalog, table_schema, table_name, column_name, ordinal_position, data_type, is_nullable, character_maximum_length);
+CREATE TABLE information_schema.table_constraints(constraint_schema, constraint_name, table_schema, table_name, constraint_type);
+CREATE TABLE information_schema.key_column_usage(constraint_schema, constraint_name, table_schema, table_name, column_name, ordinal_position);
+CREATE TABLE sys.schemas(schema_id, name);
+CREATE TABLE sys.objects(object_id, name, schema_id, type, modify_date, is_ms_shipped);
+CREATE TABLE sys.tables(object_id, name, schema_id, type, modify_date, is_ms_shipped);
+CREATE TABLE sys.columns(object_id, column_id, name, system_type_id, max_length, is_nullable);
+CREATE TABLE sys.foreign_keys(object_id, name, parent_object_id, referenced_object_id, is_disabled, is_not_trusted);
+CREATE TABLE sys.foreign_key_columns(constraint_object_id, constraint_column_id, parent_object_id, parent_column_id, referenced_object_id, referenced_column_id);
+CREATE TABLE sys.indexes(object_id, index_id, name, type, is_unique, is_primary_key, is_unique_constraint, is_disabled, is_hypothetical, has_filter, data_space_id);
+CREATE TABLE sys.index_columns(object_id, index_id, index_column_id, column_id, key_ordinal, is_included_column, partition_ordinal);
+CREATE TABLE sys.partitions(object_id, index_id, partition_number, rows);
+CREATE TABLE sys.partition_schemes(data_space_id, function_id);
+CREATE TABLE sys.partition_functions(function_id, name);
+CREATE TABLE sys.stats(object_id, stats_id, name);
+CREATE TABLE sys.stats_columns(object_id, stats_id, stats_column_id, column_id);
+CREATE TABLE sys.dm_db_stats_histogram(object_id, stats_id, step_number, range_high_key, range_rows, equal_rows);
+CREATE TABLE sys.dm_db_partition_stats(object_id, index_id, partition_number, row_count, used_page_count);
+CREATE TABLE sys.dm_db_index_usage_stats(database_id, object_id, index_id, last_user_update);
+CREATE TABLE sys.dm_os_sys_info(sqlserver_start_time);
+CREATE TABLE sys.dm_hadr_database_replica_states(database_id, is_local, is_primary_replica);
+CREATE TABLE sys.dm_exec_sessions(session_id, is_user_process);
+CREATE TABLE sys.dm_exec_requests(session_id, status);
+CREATE TABLE sys.dm_os_wait_stats(wait_type, wait_time_ms);
+CREATE TABLE sys.databases(database_id, name, snapshot_isolation_state);
+INSERT INTO sys.schemas VALUES (1, 'dbo');
+INSERT INTO sys.dm_os_sys_info VALUES ('2024-01-01 00:00:00');
+INSERT INTO sys.databases VALUES (5, 'standin', 0);
+"""
+
+SERVER_NAME = "standin"
+DATABASE_NAME = "standin"
+LOGIN_NAME = "benchmark"
+MODIFY_DATE = "2024-01-01 00:00:00"
+
+
+def translate(query, database_name=DATABASE_NAME):
+    # Traduce el T-SQL que genera main.py al dialecto de SQLite
+    query = re.sub(r"\bCOUNT_BIG\b", "COUNT", query)
+    query = re.sub(r"\bISNULL\(", "IFNULL(", query)
+    query = re.sub(r"\bN'", "'", query)
+    query = re.sub(r"\bAPPROX_COUNT_DISTINCT\(", "COUNT(DISTINCT ", query)
+    query = re.sub(
+        r"APPROX_PERCENTILE_CONT\(([\d.]+)\) WITHIN GROUP \(ORDER BY ([^)]+)\)",
+        r"PERCENTILE(\1, \2)",
+        query,
+    )
+    query = re.sub(r"CAST\(SERVERPROPERTY\('(\w+)'\) AS int\)", r"SERVERPROPERTY('\1')", query)
+    query = re.sub(r"TABLESAMPLE SYSTEM \([\d.]+ PERCENT\) REPEATABLE \(\d+\)", "", query)
+    query = re.sub(r"OPTION \(MAXDOP \d+\)", "", query)
+    query = re.sub(
+        r"CROSS APPLY\s+sys\.dm_db_stats_histogram\((\w+)\.object_id, (\w+)\.stats_id\) AS (\w+)",
+        r"INNER JOIN sys.dm_db_stats_histogram AS \3 ON \3.object_id = \1.object_id AND \3.stats_id = \2.stats_id",
+        query,
+    )
+    query = query.replace("@@SERVERNAME", f"'{SERVER_NAME}'").replace("DB_NAME()", f"'{database_name}'")
+    query = query.replace("SUSER_SNAME()", f"'{LOGIN_NAME}'")
+    query = query.replace("@@SPID", "0").replace("[_]", "_")
+    query = re.sub(r"IF OBJECT_ID\('[^']*', 'U'\) IS NULL\s+CREATE TABLE", "CREATE TABLE IF NOT EXISTS", query)
+    # Tablas temporales #nombre: en SQLite viven en el esquema temp
+    query = re.sub(
+        r"IF OBJECT_ID\('tempdb\.\.#(\w+)'\) IS NOT NULL DROP TABLE #\w+", r"DROP TABLE IF EXISTS temp.\1", query
+    )
+    query = re.sub(r"^\s*SELECT(.*?)\bINTO\s+#(\w+)\s+FROM", r"CREATE TABLE temp.\2 AS SELECT\1 FROM", query, flags=re.S)
+    query = re.sub(r"#(\w+)", r"temp.\1", query)
+    # Hash de filas de la comparación: CONVERT a texto y los enteros que se leen de los bytes del hash
+    query = re.sub(r"CONVERT\(nvarchar\(max\), ([^,()]+)(?:, \d+)?\)", r"CONVERT_TEXT(\1)", query)
+    query = re.sub(r"CAST\(SUBSTRING\((\w+\.row_hash), (\d+), 4\) AS int\)", r"HASH_INT(\1, \2)", query)
+    # SELECT TOP (n) ... ORDER BY ...: el LIMIT va después del ORDER BY de la misma consulta
+    while True:
+        match = re.search(r"SELECT\s+TOP\s*\((\d+)\)", query)
+        if match is None:
+            break
+        query = query[: match.start()] + "SELECT " + query[match.end():]
+        order_by = re.compile(r"ORDER BY[^)\n]*").search(query, match.start())
+        if order_by is not None:
+            query = query[: order_by.end()] + f" LIMIT {match.group(1)}" + query[order_by.end():]
+        else:
+            query = query.rstrip() + f" LIMIT {match.group(1)}"
+    return query
+
+
+class Row(tuple):
+    def __new__(cls, values, names):
+        row = super().__new__(cls, values)
+        row._names = names
+        return row
+
+    def __getattr__(self, name):
+        try:
+            return self[self._names[name.lower()]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection.database.db.cursor()
+        self.description = None
+        self._result_sets = []
+        self.messages = []
+        self.arraysize = 1
+        self.fast_executemany = False
+
+    def execute(self, query, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = tuple(params[0])
+        # Un lote puede tener varias sentencias separadas por ";": cada SELECT deja un conjunto de resultados
+        result_sets = []
+        with self.connection.database.lock:
+            for statement in re.split(r";\s*\n", query):
+                if not statement.strip() or re.match(r"\s*SET ", statement):
+                    # SET TRANSACTION ISOLATION LEVEL / SET STATISTICS IO / SET NOCOUNT no tienen equivalente
+                    continue
+                self._cursor.execute(translate(statement, self.connection.database.name), params)
+                if self._cursor.description:
+                    result_sets.append((self._cursor.description, self._cursor.fetchall()))
+        self._result_sets = result_sets
+        self._next_result_set()
+        return self
+
+    def executemany(self, query, rows):
+        # fast_executemany no cambia nada en SQLite: los parámetros se insertan todos en una llamada
+        with self.connection.database.lock:
+            self._cursor.executemany(translate(query, self.connection.database.name), rows)
+        self._result_sets = []
+        self._next_result_set()
+
+    def _next_result_set(self):
+        self.description, self._rows = self._result_sets.pop(0) if self._result_sets else (None, [])
+        self._names = {column[0].lower(): index for index, column in enumerate(self.description or ())}
+        self._position = 0
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = self._rows[self._position : self._position + size]
+        self._position += len(rows)
+        return [Row(row, self._names) for row in rows]
+
+    def fetchall(self):
+        rows = self._rows[self._position :]
+        self._position = len(self._rows)
+        return [Row(row, self._names) for row in rows]
+
+    def nextset(self):
+        if not self._result_sets:
+            return False
+        self._next_result_set()
+        return True
+
+    def close(self):
+        pass
+
+
+class Connection:
+    def __init__(self, database):
+        self.database = database
+        self.timeout = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def execute(self, query, *params):
+        return self.cursor().execute(query, *params)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StandardDeviation:
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(float(value))
+
+    def finalize(self):
+        if len(self.values) < 2:
+            return None
+        mean = sum(self.values) / len(self.values)
+        return (sum((value - mean) ** 2 for value in self.values) / (len(self.values) - 1)) ** 0.5
+
+
+class Percentile:
+    def __init__(self):
+        self.values = []
+        self.quantile = None
+
+    def step(self, quantile, value):
+        self.quantile = quantile
+        if value is not None:
+            self.values.append(float(value))
+
+    def finalize(self):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        position = self.quantile * (len(values) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class ChecksumAggregate:
+    # CHECKSUM_AGG: XOR de los valores
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        if value is not None:
+            self.value = (self.value or 0) ^ value
+
+    def finalize(self):
+        return self.value
+
+
+def hash_bytes(algorithm, value):
+    # HASHBYTES sobre nvarchar: los bytes del texto en UTF-16LE
+    if value is None:
+        return None
+    return hashlib.new(algorithm.replace("SHA2_", "sha").lower(), str(value).encode("utf-16le")).digest()
+
+
+def hash_int(value, start):
+    # CAST(SUBSTRING(hash, start, 4) AS int)
+    return None if value is None else int.from_bytes(value[start - 1 : start + 3], "big", signed=True)
+
+
+def convert_text(value):
+    if value is None:
+        return None
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def histogram_steps(values):
+    # Pasos como los de sys.dm_db_stats_histogram: hasta 200 claves con las filas iguales y las intermedias
+    counts = {}
+    for value in values:
+        if value is not None:
+            counts[value] = counts.get(value, 0) + 1
+    keys = sorted(counts)
+    if not keys:
+        return []
+    if len(keys) <= HISTOGRAM_STEPS:
+        boundaries = keys
+    else:
+        boundaries = [keys[round(index * (len(keys) - 1) / (HISTOGRAM_STEPS - 1))] for index in range(HISTOGRAM_STEPS)]
+    steps = []
+    previous = None
+    position = 0
+    for key in boundaries:
+        range_rows = 0
+        while keys[position] < key:
+            if previous is None or keys[position] > previous:
+                range_rows += counts[keys[position]]
+            position += 1
+        steps.append((key, range_rows, counts[key]))
+        previous = key
+    return steps
+
+
+class StandInDatabase:
+    def __init__(self, tables, foreign_keys=(), unique_constraints=(), indexes=(), major_version=16, name=DATABASE_NAME):
+        # tables: {nombre: ([(columna, tipo, nullable, largo máximo)], filas)}; la primera columna es la PK
+        # foreign_keys: [(nombre, tabla hija, columnas, tabla referenciada, columnas)]
+        # unique_constraints: [(nombre, tabla, columnas)]
+        # indexes: [(nombre, tabla, columnas)], índices nonclustered además de la PK
+        self.major_version = major_version
+        self.name = name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._register_functions()
+        for schema in ("dbo", "sys", "information_schema"):
+            self.db.execute(f"ATTACH ':memory:' AS {schema}")
+        self.db.executescript(CATALOG_SCRIPT)
+        self._load(tables, foreign_keys, unique_constraints, indexes)
+        self.db.commit()
+
+    def connect(self):
+        return Connection(self)
+
+    def _register_functions(self):
+        properties = {"ProductMajorVersion": self.major_version, "EngineEdition": 3}
+        type_names = {type_id: name for name, type_id in SYSTEM_TYPE_IDS.items()}
+        self.db.create_function("SERVERPROPERTY", 1, properties.get)
+        self.db.create_function("TYPE_NAME", 1, type_names.get)
+        self.db.create_function("DB_ID", 0, lambda: 5)
+        self.db.create_function("SCHEMA_NAME", 1, lambda schema_id: "dbo")
+        self.db.create_function("OBJECT_SCHEMA_NAME", 1, lambda object_id: "dbo")
+        self.db.create_function("LEN", 1, lambda value: None if value is None else len(str(value).rstrip()))
+        self.db.create_function("DATALENGTH", 1, lambda value: None if value is None else len(value))
+        self.db.create_function(
+            "CONCAT", -1, lambda *values: "".join("" if value is None else str(value) for value in values)
+        )
+        self.db.create_function("HASHBYTES", 2, hash_bytes)
+        self.db.create_function("HASH_INT", 2, hash_int)
+        self.db.create_function("CONVERT_TEXT", 1, convert_text)
+        self.db.create_aggregate("STDEV", 1, StandardDeviation)
+        self.db.create_aggregate("CHECKSUM_AGG", 1, ChecksumAggregate)
+        self.db.create_aggregate("PERCENTILE", 2, Percentile)
+
+    def _load(self, tables, foreign_keys, unique_constraints, indexes):
+        object_ids = {}
+        column_ids = {}
+        for object_id, (table, (columns, rows)) in enumerate(tables.items(), start=1000):
+            object_ids[table] = object_id
+            self.db.execute(f"CREATE TABLE dbo.[{table}] (" + ", ".join(f"[{column[0]}]" for column in columns) + ")")
+            self.db.executemany(
+                f"INSERT INTO dbo.[{table}] VALUES ({', '.join('?' * len(columns))})", rows
+            )
+            self.db.execute("INSERT INTO information_schema.tables VALUES (?, 'dbo', ?, 'BASE TABLE')", (self.name, table))
+            for catalog_table in ("sys.tables", "sys.objects"):
+                self.db.execute(f"INSERT INTO {catalog_table} VALUES (?, ?, 1, 'U', ?, 0)", (object_id, table, MODIFY_DATE))
+            self.db.execute("INSERT INTO sys.partitions VALUES (?, 1, 1, ?)", (object_id, len(rows)))
+            self.db.execute(
+                "INSERT INTO sys.dm_db_partition_stats VALUES (?, 1, 1, ?, ?)", (object_id, len(rows), len(rows) // 50 + 1)
+            )
+            # La primera columna es la clave primaria (índice clustered)
+            self.db.execute("INSERT INTO sys.indexes VALUES (?, 1, ?, 1, 1, 1, 0, 0, 0, 0, 1)", (object_id, f"PK_{table}"))
+            self.db.execute("INSERT INTO sys.index_columns VALUES (?, 1, 1, 1, 1, 0, 0)", (object_id,))
+            self.db.execute(
+                "INSERT INTO information_schema.table_constraints VALUES ('dbo', ?, 'dbo', ?, 'PRIMARY KEY')", (f"PK_{table}", table)
+            )
+            self.db.execute(
+                "INSERT INTO information_schema.key_column_usage VALUES ('dbo', ?, 'dbo', ?, ?, 1)", (f"PK_{table}", table, columns[0][0])
+            )
+            stats_id = 1
+            for column_id, (name, data_type, nullable, max_length) in enumerate(columns, start=1):
+                column_ids[(table, name)] = column_id
+                self.db.execute(
+                    "INSERT INTO information_schema.columns VALUES (?, 'dbo', ?, ?, ?, ?, ?, ?)",
+                    (self.name, table, name, column_id, data_type, "YES" if nullable else "NO", max_length),
+                )
+                self.db.execute(
+                    "INSERT INTO sys.columns VALUES (?, ?, ?, ?, ?, ?)",
+                    (object_id, column_id, name, SYSTEM_TYPE_IDS[data_type], max_length or 4, int(nullable)),
+                )
+                if data_type in NUMERIC_TYPES:
+                    # Estadística sobre cada columna numérica, como las que crea AUTO_CREATE_STATISTICS
+                    self.db.execute("INSERT INTO sys.stats VALUES (?, ?, ?)", (object_id, stats_id, f"ST_{table}_{name}"))
+                    self.db.execute("INSERT INTO sys.stats_columns VALUES (?, ?, 1, ?)", (object_id, stats_id, column_id))
+                    self.db.executemany(
+                        "INSERT INTO sys.dm_db_stats_histogram VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (object_id, stats_id, step_number, key, range_rows, equal_rows)
+                            for step_number, (key, range_rows, equal_rows) in enumerate(
+                                histogram_steps(row[column_id - 1] for row in rows), start=1
+                            )
+                        ],
+                    )
+                    stats_id += 1
+
+        for foreign_key_id, (name, parent, parent_columns, referenced, referenced_columns) in enumerate(foreign_keys, start=100000):
+            self.db.execute(
+                "INSERT INTO sys.foreign_keys VALUES (?, ?, ?, ?, 0, 0)",
+                (foreign_key_id, name, object_ids[parent], object_ids[referenced]),
+            )
+            self.db.execute("INSERT INTO sys.objects VALUES (?, ?, 1, 'F', ?, 0)", (foreign_key_id, name, MODIFY_DATE))
+            for position, (parent_column, referenced_column) in enumerate(zip(parent_columns, referenced_columns), start=1):
+                self.db.execute(
+                    "INSERT INTO sys.foreign_key_columns VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        foreign_key_id,
+                        position,
+                        object_ids[parent],
+                        column_ids[(parent, parent_column)],
+                        object_ids[referenced],
+                        column_ids[(referenced, referenced_column)],
+                    ),
+                )
+
+        for name, table, columns in unique_constraints:
+            self.db.execute(
+                "INSERT INTO information_schema.table_constraints VALUES ('dbo', ?, 'dbo', ?, 'UNIQUE')", (name, table)
+            )
+            for position, column in enumerate(columns, start=1):
+                self.db.execute(
+                    "INSERT INTO information_schema.key_column_usage VALUES ('dbo', ?, 'dbo', ?, ?, ?)",
+                    (name, table, column, position),
+                )
+
+        for index_id, (name, table, columns) in enumerate(indexes, start=2):
+            self.db.execute(
+                "INSERT INTO sys.indexes VALUES (?, ?, ?, 2, 0, 0, 0, 0, 0, 0, 1)", (object_ids[table], index_id, name)
+            )
+            for position, column in enumerate(columns, start=1):
+                self.db.execute(
+                    "INSERT INTO sys.index_columns VALUES (?, ?, ?, ?, ?, 0, 0)",
+                    (object_ids[table], index_id, position, column_ids[(table, column)], position),
+                )
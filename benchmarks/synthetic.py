@@ -0,0 +1,109 @@
+import datetime
+import random
+
+from standin import StandInDatabase
+
+
+# Valores frecuentes que se repiten según duplicate_skew
+HOT_VALUES = 5
+
+
+def generate_schema(tables, foreign_keys, rows, null_rate, duplicate_skew, orphan_rate, seed):
+    # Esquema sintético reproducible: cada tabla tiene una PK entera, columnas de texto, numéricas y de
+    # fecha, y una columna por cada FK que sale de ella. Las FKs siempre apuntan a una tabla anterior
+    generator = random.Random(seed)
+    names = [f"Table{index:03d}" for index in range(tables)]
+
+    links = []
+    for index in range(foreign_keys):
+        if tables < 2:
+            break
+        parent = generator.randrange(1, tables)
+        referenced = generator.randrange(0, parent)
+        links.append((f"FK_{names[parent]}_{names[referenced]}_{index}", parent, referenced, f"ref{index}_id"))
+
+    def nullable(value):
+        return None if generator.random() < null_rate else value
+
+    def skewed(value):
+        # Con probabilidad duplicate_skew la fila toma uno de los pocos valores frecuentes
+        if generator.random() < duplicate_skew:
+            return f"HOT-{generator.randrange(HOT_VALUES)}"
+        return value
+
+    schema = {}
+    for index, name in enumerate(names):
+        columns = [
+            ("id", "int", False, None),
+            ("code", "varchar", True, 20),
+            ("description", "nvarchar", True, 100),
+            ("amount", "decimal", True, None),
+            ("quantity", "int", True, None),
+            ("created", "datetime", True, None),
+        ]
+        outgoing = [link for link in links if link[1] == index]
+        columns.extend((column, "int", True, None) for _, _, _, column in outgoing)
+
+        table_rows = []
+        start = datetime.datetime(2020, 1, 1)
+        for row_id in range(1, rows + 1):
+            amount = round(generator.gauss(1000, 150), 2)
+            if generator.random() < 0.001:
+                # Valores atípicos para el chequeo de outliers
+                amount *= 100
+            row = [
+                row_id,
+                nullable(skewed(f"C-{row_id:08d}")),
+                nullable("" if generator.random() < null_rate else f"Descripción {row_id}"),
+                nullable(amount),
+                nullable(generator.randrange(1, 100)),
+                nullable((start + datetime.timedelta(minutes=generator.randrange(2_000_000))).isoformat(" ")),
+            ]
+            for _ in outgoing:
+                if generator.random() < orphan_rate:
+                    # Referencia a una fila que no existe en la tabla padre
+                    row.append(rows + generator.randrange(1, 1000))
+                else:
+                    row.append(nullable(generator.randrange(1, rows + 1)))
+            table_rows.append(tuple(row))
+        schema[name] = (columns, table_rows)
+
+    foreign_key_specs = [
+        (name, names[parent], [column], names[referenced], ["id"]) for name, parent, referenced, column in links
+    ]
+    unique_constraints = [(f"UQ_{name}_code", name, ["code"]) for name in names[::4]]
+    # La mitad de las FKs tiene un índice de apoyo, para que el orden de las sondas de integridad importe
+    indexes = [(f"IX_{names[parent]}_{column}", names[parent], [column]) for _, parent, _, column in links[::2]]
+    return schema, foreign_key_specs, unique_constraints, indexes
+
+
+def build_database(tables=20, foreign_keys=30, rows=2000, null_rate=0.1, duplicate_skew=0.2, orphan_rate=0.01, seed=1):
+    return StandInDatabase(
+        *generate_schema(tables, foreign_keys, rows, null_rate, duplicate_skew, orphan_rate, seed)
+    )
+
+
+def change_rows(schema, every=500):
+    # Copia del esquema con diferencias para la comparación: en cada tabla cambia el monto de una de cada
+    # `every` filas, borra la siguiente y agrega una fila al final
+    changed = {}
+    for name, (columns, rows) in schema.items():
+        rows = list(rows)
+        for position in range(0, len(rows) - 1, every):
+            row = list(rows[position])
+            row[3] = None if row[3] is not None else 1.0
+            rows[position] = tuple(row)
+            del rows[position + 1]
+        rows.append((rows[-1][0] + every,) + rows[-1][1:])
+        changed[name] = (columns, rows)
+    return changed
+
+
+def build_target_database(
+    tables=20, foreign_keys=30, rows=2000, null_rate=0.1, duplicate_skew=0.2, orphan_rate=0.01, seed=1, name="destino"
+):
+    # La misma base que build_database con algunas filas distintas, para medir la comparación entre bases
+    schema, foreign_key_specs, unique_constraints, indexes = generate_schema(
+        tables, foreign_keys, rows, null_rate, duplicate_skew, orphan_rate, seed
+    )
+    return StandInDatabase(change_rows(schema), foreign_key_specs, unique_constraints, indexes, name=name)
@@ -7,583 +7,4114 @@ from flask import (
     flash,
     session,
     send_from_directory,
+    jsonify,
+    abort,
+    Response,
 )
 import pyodbc
 import sys
 import os
 import datetime
+import decimal
+import hashlib
+import json
+import math
+import sqlite3
+import time
+import uuid
+import re
+import threading
+import contextvars
+import asyncio
+import bisect
+from collections import OrderedDict
+import argparse
+import configparser
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 
 app = Flask(__name__)
 app.secret_key = "super secret key"
 app.config["UPLOAD_FOLDER"] = "logs"
 
+# Tipos de datos que alimentan cada sección del chequeo de anomalías de datos
+NUMERIC_TYPES = ("int", "decimal", "float", "numeric")
+DATETIME_TYPES = ("datetime", "date", "time")
+STRING_TYPES = ("char", "varchar", "nchar", "nvarchar")
+BINARY_TYPES = ("binary", "varbinary")
+# Tipos que SQL Server no permite agrupar ni comparar
+UNGROUPABLE_TYPES = ("text", "ntext", "image", "xml", "geography", "geometry")
 
-def connect_to_database(server, database, username, password):
+# APPROX_COUNT_DISTINCT garantiza un error de hasta 2% (con 97% de probabilidad): con ese conteo solo se
+# informan duplicados que superan el 2% de los valores no nulos
+APPROX_DISTINCT_ERROR = 0.02
+# Límite de agregados por consulta de perfilado (SQL Server admite 4096 columnas por SELECT)
+PROFILE_EXPRESSIONS_PER_QUERY = 1000
+# Outliers: valores a más de 1.5 rangos intercuartiles de Q1/Q3 o a más de 3 desvíos de la media
+app.config["OUTLIER_IQR_FACTOR"] = 1.5
+app.config["OUTLIER_Z_SCORE"] = 3
+# Análisis de duplicados: columnas o claves por consulta y valores más repetidos a informar
+DUPLICATE_TARGETS_PER_QUERY = 20
+app.config["DUPLICATE_TOP_VALUES"] = 5
+# Cantidad de chequeos de claves foráneas combinados con UNION ALL en cada consulta
+FK_CHECKS_PER_BATCH = 25
+# Tamaño máximo del pool de conexiones usado por los chequeos en paralelo
+app.config["AUDIT_MAX_CONNECTIONS"] = int(os.environ.get("AUDIT_MAX_CONNECTIONS", "4"))
+# Una conexión ociosa se verifica con SELECT 1 antes de reutilizarla si estuvo sin uso más de
+# AUDIT_CONNECTION_CHECK_SECONDS, y se cierra después de AUDIT_CONNECTION_IDLE_SECONDS
+app.config["AUDIT_CONNECTION_CHECK_SECONDS"] = 30
+app.config["AUDIT_CONNECTION_IDLE_SECONDS"] = int(os.environ.get("AUDIT_CONNECTION_IDLE_SECONDS", "300"))
+# Reintentos al abrir una conexión ante errores transitorios (red, timeout de login, failover)
+app.config["AUDIT_CONNECT_RETRIES"] = 3
+CONNECT_MIN_BACKOFF_SECONDS = 1
+CONNECT_MAX_BACKOFF_SECONDS = 30
+# SQLSTATE de pyodbc: no se pudo establecer la conexión, se cortó el enlace, timeout
+TRANSIENT_SQLSTATES = ("08001", "08S01", "HYT00", "HYT01")
+# Con réplicas legibles, los chequeos que solo leen metadatos van al nodo menos cargado, primario incluido;
+# los que recorren tablas se reparten entre las réplicas
+METADATA_AUDIT_OPTIONS = ("1", "5")
+# Auditorías que se ejecutan a la vez en segundo plano y trabajos terminados que se conservan
+app.config["AUDIT_MAX_JOBS"] = int(os.environ.get("AUDIT_MAX_JOBS", "2"))
+app.config["AUDIT_KEEP_FINISHED_JOBS"] = 50
+# Motor de los chequeos en paralelo: "threads" (un hilo por conexión del pool) o "asyncio"
+# (un event loop programa las consultas sobre las conexiones del pool)
+app.config["AUDIT_ENGINE"] = os.environ.get("AUDIT_ENGINE", "threads")
+# Consultas en paralelo por servidor, sumando todas las auditorías y pools que lo usan
+app.config["AUDIT_MAX_QUERIES_PER_SERVER"] = int(os.environ.get("AUDIT_MAX_QUERIES_PER_SERVER", "8"))
+# Líneas de log por página en /results
+app.config["RESULTS_PAGE_SIZE"] = 200
+# Buffer de escritura de los logs
+LOG_BUFFER_SIZE = 64 * 1024
+
+# Modo muestreo: las tablas con menos filas que el umbral se recorren completas
+app.config["SAMPLING_THRESHOLD_ROWS"] = 1_000_000
+# Margen de error buscado para las proporciones estimadas (95% de confianza)
+app.config["SAMPLING_MARGIN"] = 0.01
+# TABLESAMPLE elige páginas enteras, no filas: se agranda la muestra para compensar
+app.config["SAMPLING_DESIGN_EFFECT"] = 4
+app.config["SAMPLING_MIN_ROWS"] = 10_000
+# "tablesample" (lee solo las páginas elegidas) o "hash" (muestra por filas, recorre la tabla)
+app.config["SAMPLING_METHOD"] = "tablesample"
+SAMPLING_SEED = 20240
+
+# Base SQLite local con el estado de las auditorías incrementales
+app.config["AUDIT_STATE_PATH"] = "audit_state.sqlite3"
+
+# Modo por partes: las tablas con al menos AUDIT_CHUNK_THRESHOLD_ROWS filas se recorren en partes de unas
+# AUDIT_CHUNK_ROWS filas (por partición o por rangos de la clave clustered), en paralelo y cada una con su
+# propio timeout. Las partes terminadas se guardan en AUDIT_STATE_PATH hasta que termina la tabla
+app.config["AUDIT_CHUNK_THRESHOLD_ROWS"] = int(os.environ.get("AUDIT_CHUNK_THRESHOLD_ROWS", "10000000"))
+app.config["AUDIT_CHUNK_ROWS"] = 2_000_000
+app.config["AUDIT_MAX_CHUNKS"] = 64
+app.config["AUDIT_CHUNK_TIMEOUT"] = int(os.environ.get("AUDIT_CHUNK_TIMEOUT", "300"))
+# Tipos de la clave clustered que se pueden dividir en rangos
+CHUNK_KEY_TYPES = NUMERIC_TYPES + ("bigint", "smallint", "tinyint", "datetime", "datetime2", "date")
+
+# Resultados de chequeos recientes que reutiliza el log personalizado
+app.config["AUDIT_CACHE_TTL_SECONDS"] = 600
+app.config["AUDIT_CACHE_MAX_ENTRIES"] = 16
+
+# Muestras de filas con anomalías: primeras N claves por anomalía (0 = todas), leídas en lotes de
+# ROW_SAMPLE_ARRAYSIZE filas con fetchmany
+app.config["ROW_SAMPLE_LIMIT"] = int(os.environ.get("ROW_SAMPLE_LIMIT", "1000"))
+app.config["ROW_SAMPLE_ARRAYSIZE"] = 1000
+# Tabla de cuarentena opcional, en cualquier servidor, donde se copian las claves con fast_executemany
+app.config["QUARANTINE_CONNECTION_STRING"] = os.environ.get("AUDIT_QUARANTINE_CONNECTION_STRING", "")
+app.config["QUARANTINE_TABLE"] = os.environ.get("AUDIT_QUARANTINE_TABLE", "dbo.audit_quarantine")
+
+# Comparación entre dos bases: cada rango con diferencias se divide en COMPARE_FANOUT rangos de la PK hasta
+# que tiene COMPARE_ROW_LIMIT filas o menos; recién ahí se traen las claves y el hash de cada fila
+COMPARE_FANOUT = 16
+COMPARE_RANGES_PER_QUERY = 256
+app.config["COMPARE_ROW_LIMIT"] = 1000
+# Claves distintas que se informan por tabla (el total se informa siempre)
+app.config["COMPARE_MAX_KEYS"] = 100
+# Estilo de CONVERT a texto que no pierde precisión, por tipo
+HASH_CONVERT_STYLES = {
+    "float": 2,
+    "real": 2,
+    "money": 2,
+    "smallmoney": 2,
+    "datetime": 121,
+    "datetime2": 121,
+    "smalldatetime": 121,
+    "date": 121,
+    "time": 121,
+    "datetimeoffset": 121,
+    "binary": 1,
+    "varbinary": 1,
+}
+
+# Perfil de consultas por auditoría: lecturas lógicas vía SET STATISTICS IO y consultas más lentas a mostrar
+app.config["PROFILE_STATISTICS_IO"] = True
+app.config["PROFILE_SLOWEST_QUERIES"] = 20
+LOGICAL_READS_PATTERN = re.compile(r"logical reads (\d+)")
+# Métricas de /metrics (formato de texto de Prometheus): límites de los histogramas de duración, en segundos
+QUERY_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600)
+CHECK_DURATION_BUCKETS = (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200)
+
+# Aislamiento y límites de las consultas de auditoría: "read uncommitted" no toma locks compartidos;
+# "snapshot" lee versiones de fila si la base lo permite (si no, se usa "read uncommitted")
+app.config["AUDIT_ISOLATION_LEVEL"] = os.environ.get("AUDIT_ISOLATION_LEVEL", "read uncommitted")
+app.config["AUDIT_MAXDOP"] = int(os.environ.get("AUDIT_MAXDOP", "2"))
+app.config["AUDIT_QUERY_TIMEOUT"] = int(os.environ.get("AUDIT_QUERY_TIMEOUT", "600"))
+# Antes de cada recorrido se mide la carga del servidor y se espera mientras supere los límites
+app.config["AUDIT_THROTTLE"] = os.environ.get("AUDIT_THROTTLE", "1") == "1"
+app.config["AUDIT_THROTTLE_MAX_ACTIVE_REQUESTS"] = int(os.environ.get("AUDIT_THROTTLE_MAX_ACTIVE_REQUESTS", "50"))
+# Milisegundos de espera de recursos (locks, E/S, log, CPU, memoria) acumulados por segundo
+app.config["AUDIT_THROTTLE_MAX_WAIT_MS_PER_SECOND"] = int(os.environ.get("AUDIT_THROTTLE_MAX_WAIT_MS_PER_SECOND", "10000"))
+app.config["AUDIT_THROTTLE_CHECK_SECONDS"] = 5
+app.config["AUDIT_THROTTLE_MAX_PAUSE_SECONDS"] = 600
+THROTTLE_MIN_BACKOFF_SECONDS = 1
+THROTTLE_MAX_BACKOFF_SECONDS = 60
+
+
+def build_connection_string(server, database, username, password, read_only=False):
+    return (
+        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"UID={username};"
+        f"PWD={password};"
+        f"PORT=1433"
+        # Un listener de grupo de disponibilidad deriva las conexiones de solo lectura a una secundaria
+        + (";ApplicationIntent=ReadOnly" if read_only else "")
+    )
+
+
+def connection_server(connection_string):
+    match = re.search(r"SERVER=([^;]*)", connection_string)
+    return match.group(1) if match else ""
+
+
+def build_pool(server, database, username, password, max_size, replicas=(), read_only=False):
+    # Pool del servidor indicado y, si hay réplicas legibles, uno por réplica con ApplicationIntent=ReadOnly.
+    # Las réplicas que no responden se informan y quedan fuera
+    pool = ConnectionPool(build_connection_string(server, database, username, password, read_only), max_size)
+    if not replicas:
+        return pool
+    replica_pools = []
+    for replica in replicas:
+        replica_pool = ConnectionPool(build_connection_string(replica, database, username, password, True), max_size)
+        try:
+            with replica_pool.connection():
+                pass
+        except Exception as e:
+            print(f"No se puede conectar a la réplica {replica}, se omite:", e)
+            continue
+        replica_pools.append(replica_pool)
+    return ReplicaPool(pool, replica_pools, replicas) if replica_pools else pool
+
+
+def connect_to_database(server, database, username, password, replicas=(), read_only=False):
+    # Devuelve el pool de la base con una conexión ya verificada; el error queda a cargo de quien llama
     try:
-        connection_string = (
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={server};"
-            f"DATABASE={database};"
-            f"UID={username};"
-            f"PWD={password};"
-            f"PORT=1433"
-        )
-        connection = pyodbc.connect(connection_string)
+        pool = connection_manager.connect(server, database, username, password, replicas, read_only)
         print("Conexión exitosa a la base de datos.")
-        return connection
+        return pool
     except Exception as e:
         print("Error al conectar a la base de datos:", e)
-        sys.exit(1)
+        raise
+
+
+def is_transient_error(error):
+    return isinstance(error, pyodbc.Error) and bool(error.args) and error.args[0] in TRANSIENT_SQLSTATES
+
+
+ISOLATION_LEVELS = {
+    "read uncommitted": "READ UNCOMMITTED",
+    "read committed": "READ COMMITTED",
+    "snapshot": "SNAPSHOT",
+}
+
+
+def open_audit_connection(connection_string):
+    # Con autocommit cada consulta es su propia transacción: una conexión del pool no deja una transacción
+    # abierta entre auditorías, que con SNAPSHOT seguiría leyendo la misma versión y retendría el version store
+    connection = pyodbc.connect(connection_string, autocommit=True)
+    # El timeout se aplica a los cursores que se crean después de asignarlo
+    connection.timeout = app.config["AUDIT_QUERY_TIMEOUT"]
+    isolation_level = ISOLATION_LEVELS[app.config["AUDIT_ISOLATION_LEVEL"]]
+    cursor = connection.cursor()
+    if isolation_level == "SNAPSHOT":
+        # SET ... SNAPSHOT no falla si la base no lo permite: fallaría recién la primera consulta
+        row = cursor.execute(
+            "SELECT snapshot_isolation_state FROM sys.databases WHERE database_id = DB_ID()"
+        ).fetchone()
+        if row is None or row[0] != 1:
+            isolation_level = "READ UNCOMMITTED"
+    cursor.execute(f"SET TRANSACTION ISOLATION LEVEL {isolation_level}")
+    cursor.close()
+    return connection
+
+
+class WorkloadThrottle:
+    def __init__(self):
+        self.enabled = app.config["AUDIT_THROTTLE"]
+        # False si falta VIEW SERVER STATE: no se vuelve a intentar medir
+        self.measurable = True
+        self.overloaded = False
+        self.last_load = None
+        self._last_check = None
+        self._last_waits = None
+        self._lock = threading.Lock()
+
+    def read_load(self, cursor):
+        row = cursor.execute("""
+        SELECT 
+            (
+                SELECT COUNT(*)
+                FROM sys.dm_exec_requests AS r
+                INNER JOIN sys.dm_exec_sessions AS s ON s.session_id = r.session_id
+                WHERE s.is_user_process = 1 AND r.session_id <> @@SPID
+            ) AS active_requests,
+            (
+                SELECT SUM(wait_time_ms)
+                FROM sys.dm_os_wait_stats
+                WHERE wait_type LIKE 'LCK[_]M[_]%'
+                    OR wait_type LIKE 'PAGEIOLATCH[_]%'
+                    OR wait_type IN ('WRITELOG', 'SOS_SCHEDULER_YIELD', 'RESOURCE_SEMAPHORE')
+            ) AS wait_time_ms
+        """).fetchone()
+        return row.active_requests, row.wait_time_ms or 0
+
+    def check(self, cursor):
+        # La carga se mide como mucho cada AUDIT_THROTTLE_CHECK_SECONDS entre todos los hilos
+        now = time.monotonic()
+        with self._lock:
+            if self._last_check is not None and now - self._last_check < app.config["AUDIT_THROTTLE_CHECK_SECONDS"]:
+                return self.overloaded
+            self._last_check = now
+        try:
+            active_requests, wait_time_ms = self.read_load(cursor)
+        except Exception as e:
+            # Sin VIEW SERVER STATE no se puede medir la carga: se sigue con las demás protecciones
+            print("No se puede medir la carga del servidor, se desactiva la espera adaptativa:", e)
+            self.enabled = False
+            self.measurable = False
+            return False
+        with self._lock:
+            # La tasa de espera se calcula sobre al menos un segundo para no amplificar el ruido
+            wait_ms_per_second = self.last_load["wait_ms_per_second"] if self.last_load else None
+            if self._last_waits is None:
+                self._last_waits = (now, wait_time_ms)
+            elif now - self._last_waits[0] >= 1:
+                wait_ms_per_second = (wait_time_ms - self._last_waits[1]) / (now - self._last_waits[0])
+                self._last_waits = (now, wait_time_ms)
+            self.last_load = {"active_requests": active_requests, "wait_ms_per_second": wait_ms_per_second}
+            self.overloaded = active_requests > app.config["AUDIT_THROTTLE_MAX_ACTIVE_REQUESTS"] or (
+                wait_ms_per_second is not None
+                and wait_ms_per_second > app.config["AUDIT_THROTTLE_MAX_WAIT_MS_PER_SECOND"]
+            )
+            return self.overloaded
+
+    def current_load(self):
+        # Última carga medida, o None si no se midió en los últimos AUDIT_THROTTLE_CHECK_SECONDS
+        with self._lock:
+            if self._last_check is None or time.monotonic() - self._last_check >= app.config["AUDIT_THROTTLE_CHECK_SECONDS"]:
+                return None
+            return self.last_load
+
+    def wait(self, cursor):
+        # Espera con backoff exponencial mientras el servidor esté sobrecargado; devuelve los segundos esperados
+        if not self.enabled:
+            return 0
+        delay = THROTTLE_MIN_BACKOFF_SECONDS
+        paused = 0
+        while paused < app.config["AUDIT_THROTTLE_MAX_PAUSE_SECONDS"] and self.check(cursor):
+            time.sleep(delay)
+            paused += delay
+            delay = min(delay * 2, THROTTLE_MAX_BACKOFF_SECONDS)
+        return paused
+
+
+# Límite de consultas simultáneas de cada servidor, compartido por todos sus pools
+server_query_slots = {}
+server_query_slots_lock = threading.Lock()
+
+
+def get_server_query_slots(server):
+    with server_query_slots_lock:
+        slots = server_query_slots.get(server)
+        if slots is None:
+            slots = server_query_slots[server] = threading.BoundedSemaphore(app.config["AUDIT_MAX_QUERIES_PER_SERVER"])
+        return slots
+
+
+class ConnectionPool:
+    def __init__(self, connection_string, max_size):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self._server_slots = get_server_query_slots(connection_server(connection_string))
+        # Espera adaptativa compartida por todas las auditorías que usan este pool
+        self.throttle = WorkloadThrottle()
+        # Conexiones ociosas con el momento en que se devolvieron; se reutiliza la más reciente
+        self._idle = []
+        self.in_use = 0
+        self._lock = threading.Lock()
+        # Limita la cantidad de conexiones prestadas al mismo tiempo
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def open_connection(self):
+        # Conexión nueva fuera del pool; los errores transitorios se reintentan con backoff exponencial
+        delay = CONNECT_MIN_BACKOFF_SECONDS
+        retries = app.config["AUDIT_CONNECT_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                return open_audit_connection(self.connection_string)
+            except Exception as e:
+                if attempt == retries or not is_transient_error(e):
+                    raise
+                print(f"Error transitorio al conectar, se reintenta en {delay} s:", e)
+                time.sleep(delay)
+                delay = min(delay * 2, CONNECT_MAX_BACKOFF_SECONDS)
+
+    @contextmanager
+    def dedicated_connection(self):
+        # Conexión propia de una auditoría, fuera de los lugares del pool; mientras se usa, las consultas
+        # esperan según la carga de este servidor
+        connection = self.open_connection()
+        throttle_token = current_throttle.set(self.throttle)
+        try:
+            yield connection
+        finally:
+            current_throttle.reset(throttle_token)
+            connection.close()
+
+    def is_healthy(self, connection, idle_since):
+        # Consulta mínima solo para las conexiones que estuvieron ociosas un tiempo
+        if time.monotonic() - idle_since < app.config["AUDIT_CONNECTION_CHECK_SECONDS"]:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1").fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            self.in_use += 1
+        try:
+            self.evict_idle()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, idle_since = self._idle.pop()
+                if self.is_healthy(connection, idle_since):
+                    return connection
+                close_quietly(connection)
+            return self.open_connection()
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        with self._lock:
+            self.in_use -= 1
+            if not discard:
+                self._idle.append((connection, time.monotonic()))
+        if discard:
+            close_quietly(connection)
+        self._slots.release()
+
+    def evict_idle(self):
+        # Cierra las conexiones ociosas por más de AUDIT_CONNECTION_IDLE_SECONDS
+        limit = time.monotonic() - app.config["AUDIT_CONNECTION_IDLE_SECONDS"]
+        with self._lock:
+            expired = [connection for connection, idle_since in self._idle if idle_since < limit]
+            self._idle = [(connection, idle_since) for connection, idle_since in self._idle if idle_since >= limit]
+        for connection in expired:
+            close_quietly(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        # Además del tamaño del pool, cada conexión prestada ocupa un lugar del límite del servidor: los trabajos
+        # en segundo plano y los pools de otros usuarios no suman más consultas simultáneas que ese límite
+        try:
+            self._server_slots.acquire()
+        except BaseException:
+            self.release(connection)
+            raise
+        # Las consultas hechas con la conexión esperan según la carga de este servidor
+        throttle_token = current_throttle.set(self.throttle)
+        try:
+            yield connection
+        except pyodbc.Error:
+            # Una conexión que falló a nivel de driver no se devuelve al pool
+            self.release(connection, discard=True)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+        finally:
+            current_throttle.reset(throttle_token)
+            self._server_slots.release()
+
+    def stats(self):
+        with self._lock:
+            return self.in_use, len(self._idle)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            close_quietly(connection)
+
+
+class ReplicaPool:
+    # Pool del primario y de sus réplicas legibles, con la misma interfaz que ConnectionPool. Cada conexión va
+    # al nodo menos cargado: entre las réplicas para los chequeos que recorren tablas (for_option) y entre
+    # todos los nodos para los que solo leen metadatos
+    def __init__(self, primary, replicas, replica_servers, include_primary=True):
+        self.primary = primary
+        self.replicas = replicas
+        self.replica_servers = tuple(replica_servers)
+        self.nodes = ([primary] if include_primary else []) + replicas
+        self.connection_string = primary.connection_string
+        self.max_size = sum(node.max_size for node in self.nodes)
+        # Hasta elegir un nodo se espera según la carga del primario
+        self.throttle = primary.throttle
+
+    def for_option(self, option):
+        return ReplicaPool(self.primary, self.replicas, self.replica_servers, option in METADATA_AUDIT_OPTIONS)
+
+    def choose(self):
+        # Primero los nodos con lugar en su pool y sin superar los límites de carga, después los de menos
+        # solicitudes activas y menos conexiones prestadas. Un nodo sin medición reciente cuenta como libre:
+        # así se vuelve a medir cada AUDIT_THROTTLE_CHECK_SECONDS
+        def load(node):
+            current = node.throttle.current_load()
+            if current is None:
+                return (node.in_use >= node.max_size, False, 0, node.in_use)
+            return (node.in_use >= node.max_size, node.throttle.overloaded, current["active_requests"], node.in_use)
+
+        return min(self.nodes, key=load)
+
+    def measure(self, node, connection):
+        # La carga se mide con la misma conexión que se va a usar, como mucho cada AUDIT_THROTTLE_CHECK_SECONDS.
+        # Devuelve otro nodo si el elegido resultó sobrecargado y hay uno que no lo está
+        if node.throttle.measurable:
+            cursor = connection.cursor()
+            node.throttle.check(cursor)
+            cursor.close()
+        if not node.throttle.overloaded:
+            return None
+        other = self.choose()
+        if other is node or (other.throttle.current_load() is not None and other.throttle.overloaded):
+            return None
+        return other
+
+    @contextmanager
+    def dedicated_connection(self):
+        # Como ConnectionPool.dedicated_connection, en el nodo elegido. Las consultas esperan según la carga de
+        # ese nodo solo mientras se usa la conexión: al salir vuelve la espera que tenía el llamador
+        node = self.choose()
+        while True:
+            connection = node.open_connection()
+            other = self.measure(node, connection)
+            if other is None:
+                break
+            close_quietly(connection)
+            node = other
+        throttle_token = current_throttle.set(node.throttle)
+        try:
+            yield connection
+        finally:
+            current_throttle.reset(throttle_token)
+            connection.close()
+
+    @contextmanager
+    def connection(self):
+        node = self.choose()
+        while True:
+            with node.connection() as connection:
+                other = self.measure(node, connection)
+                if other is None:
+                    yield connection
+                    return
+            node = other
+
+    def all_nodes(self):
+        return [self.primary] + self.replicas
+
+    def evict_idle(self):
+        for node in self.all_nodes():
+            node.evict_idle()
+
+    def close(self):
+        for node in self.all_nodes():
+            node.close()
+
+
+def audit_pool(pool, option):
+    if isinstance(pool, ReplicaPool):
+        return pool.for_option(option)
+    return pool
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class ConnectionManager:
+    # Un pool por (servidor, base, usuario), compartido por las sesiones web que se conectaron a esa base
+    def __init__(self):
+        self._pools = {}
+        # Auditorías que usan cada pool y pools reemplazados que se cierran cuando termina la última
+        self._users = {}
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def connect(self, server, database, username, password, replicas=(), read_only=False):
+        key = (server, database, username)
+        connection_string = build_connection_string(server, database, username, password, read_only)
+        with self._lock:
+            pool = self._pools.get(key)
+        if (
+            pool is None
+            or pool.connection_string != connection_string
+            or getattr(pool, "replica_servers", ()) != tuple(replicas)
+        ):
+            pool = build_pool(
+                server, database, username, password, app.config["AUDIT_MAX_CONNECTIONS"], replicas, read_only
+            )
+        # El pool se registra recién después de verificar la conexión, que queda ociosa en el pool
+        with pool.connection():
+            pass
+        with self._lock:
+            previous = self._pools.get(key)
+            self._pools[key] = pool
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._evict_loop, name="connection-reaper", daemon=True)
+                self._reaper.start()
+            replaced = previous is not None and previous is not pool
+            if replaced and self._users.get(previous):
+                # Un trabajo en segundo plano todavía lo usa: se cierra cuando termine
+                self._retired.add(previous)
+                replaced = False
+        if replaced:
+            previous.close()
+        return pool
+
+    def retain(self, pool):
+        with self._lock:
+            self._users[pool] = self._users.get(pool, 0) + 1
+
+    def release(self, pool):
+        with self._lock:
+            self._users[pool] -= 1
+            if self._users[pool]:
+                return
+            del self._users[pool]
+            if pool not in self._retired:
+                return
+            self._retired.discard(pool)
+        pool.close()
+
+    @contextmanager
+    def using(self, pool):
+        self.retain(pool)
+        try:
+            yield pool
+        finally:
+            self.release(pool)
+
+    def get(self, server, database, username):
+        with self._lock:
+            return self._pools.get((server, database, username))
+
+    def pools(self):
+        with self._lock:
+            return list(self._pools.items())
+
+    def evict_idle(self):
+        with self._lock:
+            pools = list(self._pools.values()) + list(self._retired)
+        for pool in pools:
+            pool.evict_idle()
+
+    def _evict_loop(self):
+        while True:
+            time.sleep(max(1, app.config["AUDIT_CONNECTION_IDLE_SECONDS"] / 2))
+            self.evict_idle()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()) + list(self._retired), {}
+            self._retired = set()
+        for pool in pools:
+            pool.close()
+
+
+connection_manager = ConnectionManager()
+
+
+async def run_scheduled(pool, task, items, workers):
+    # pyodbc bloquea en cada llamada: el event loop reparte las consultas entre workers hilos. El límite de
+    # consultas por servidor lo aplica pool.connection(), compartido con las demás auditorías
+    loop = asyncio.get_running_loop()
+
+    def run(item):
+        with pool.connection() as pooled_connection:
+            return task(pooled_connection.cursor(), item)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="audit-query") as executor:
+        return await asyncio.gather(
+            *(loop.run_in_executor(executor, contextvars.copy_context().run, run, item) for item in items)
+        )
+
+
+def run_parallel(connection, pool, task, items):
+    # Ejecuta task(cursor, item) para cada elemento y devuelve los resultados en el orden de items
+    items = list(items)
+    if pool is None or pool.max_size <= 1 or len(items) <= 1:
+        cursor = connection.cursor()
+        return [task(cursor, item) for item in items]
+
+    if app.config["AUDIT_ENGINE"] == "asyncio":
+        return asyncio.run(run_scheduled(pool, task, items, min(pool.max_size, len(items))))
+
+    def run(item):
+        with pool.connection() as pooled_connection:
+            return task(pooled_connection.cursor(), item)
+
+    with ThreadPoolExecutor(max_workers=min(pool.max_size, len(items))) as executor:
+        # Cada tarea corre en una copia del contexto para heredar el perfilador de la auditoría
+        futures = [executor.submit(contextvars.copy_context().run, run, item) for item in items]
+        return [future.result() for future in futures]
+
+
+class AuditRecord:
+    __slots__ = ("check", "table", "column", "metric", "value", "severity", "message")
+
+    def __init__(self, check, message, table=None, column=None, metric=None, value=None, severity="info"):
+        self.check = check
+        # Línea del log de texto; None para los registros que solo van al archivo de resultados
+        self.message = message
+        self.table = table
+        self.column = column
+        self.metric = metric
+        self.value = value
+        self.severity = severity
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class LogWriter:
+    def __init__(self, filepath, page_size):
+        self.filepath = filepath
+        # Los registros tipados de cada chequeo se guardan en JSONL junto al log de texto
+        self.records_filepath = os.path.splitext(filepath)[0] + ".jsonl"
+        self.page_size = page_size
+        # Posición en bytes donde empieza cada página del log
+        self.offsets = [0]
+        self.lines = 0
+        self.records = 0
+        self.flushed_size = 0
+        # Tamaño y fecha de los dos archivos al terminar, para saber si se volvieron a escribir
+        self.signature = None
+        self.on_finish = None
+
+    def file_signature(self):
+        try:
+            return tuple((os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in (self.filepath, self.records_filepath))
+        except OSError:
+            return None
+
+    def unchanged(self):
+        return self.signature is not None and self.file_signature() == self.signature
+
+    def replay(self):
+        # Vuelve a entregar las entradas del log leyendo el texto y el JSONL a la par: cada registro ocupa las
+        # líneas de su mensaje (ninguna si no tiene) y las demás líneas son cadenas
+        with open(self.filepath, encoding="utf-8") as file, open(self.records_filepath, encoding="utf-8") as records_file:
+            records = (AuditRecord(**json.loads(line)) for line in records_file)
+            pending = next(records, None)
+            while True:
+                while pending is not None and pending.message is None:
+                    yield pending
+                    pending = next(records, None)
+                line = file.readline()
+                if not line:
+                    break
+                line = line[:-1] if line.endswith("\n") else line
+                if pending is not None and pending.message.split("\n")[0] == line:
+                    for _ in range(pending.message.count("\n")):
+                        file.readline()
+                    yield pending
+                    pending = next(records, None)
+                else:
+                    yield line
+            while pending is not None:
+                yield pending
+                pending = next(records, None)
+
+    def write(self, entries):
+        position = 0
+        with open(self.filepath, "wb", buffering=LOG_BUFFER_SIZE) as file, open(
+            self.records_filepath, "wb", buffering=LOG_BUFFER_SIZE
+        ) as records_file:
+            for entry in entries:
+                # Las cadenas son encabezados y notas del log; los AuditRecord son resultados
+                if isinstance(entry, AuditRecord):
+                    records_file.write(
+                        (json.dumps(entry.to_dict(), ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+                    )
+                    self.records += 1
+                    entry = entry.message
+                    if entry is None:
+                        continue
+                data = (entry + "\n").encode("utf-8")
+                file.write(data)
+                position += len(data)
+                self.lines += data.count(b"\n")
+                if self.lines >= len(self.offsets) * self.page_size:
+                    # Al cerrar una página se vuelca el buffer para poder leerla mientras se escribe
+                    self.offsets.append(position)
+                    file.flush()
+                    audit_metrics.add("audit_log_bytes_total", (("file", os.path.basename(self.filepath)),), position - self.flushed_size)
+                    self.flushed_size = position
+        audit_metrics.add("audit_log_bytes_total", (("file", os.path.basename(self.filepath)),), position - self.flushed_size)
+        self.flushed_size = position
+        self.signature = self.file_signature()
+        if self.on_finish is not None:
+            self.on_finish()
+
+    def pages(self):
+        # Rangos de bytes (inicio, fin) de las páginas ya volcadas al disco
+        size = self.flushed_size
+        bounds = [offset for offset in self.offsets if offset < size] + [size]
+        return list(zip(bounds, bounds[1:]))
+
+
+def read_log_page(filepath, page_range):
+    start, end = page_range
+    with open(filepath, "rb") as file:
+        file.seek(start)
+        return file.read(end - start).decode("utf-8").splitlines()
+
+
+# Log que está escribiendo write_to_file; cached_audit lo guarda en la caché cuando es todo su contenido
+current_log_writer = contextvars.ContextVar("current_log_writer", default=None)
+# Carpeta del trabajo que se está ejecutando; sin trabajo se escribe directo en UPLOAD_FOLDER
+current_output_folder = contextvars.ContextVar("current_output_folder", default=None)
+
+
+def output_folder():
+    folder = current_output_folder.get() or app.config["UPLOAD_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def write_to_file(filename, data, progress=None):
+    filepath = os.path.join(output_folder(), filename)
+    writer = LogWriter(filepath, app.config["RESULTS_PAGE_SIZE"])
+    if progress is not None:
+        progress.output = writer
+    writer_token = current_log_writer.set(writer)
+    try:
+        writer.write(data)
+    finally:
+        current_log_writer.reset(writer_token)
+    print(f"Datos guardados exitosamente en '{filename}'.")
+    return filepath
+
+
+class AuditProgress:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.checks = {}
+        self.output = None
+        self._lock = threading.Lock()
+
+    def start_check(self, name, total):
+        with self._lock:
+            self.checks[name] = {
+                "done": 0,
+                "total": total,
+                "rows_scanned": 0,
+                "started": time.monotonic(),
+                "finished": None if total else time.monotonic(),
+            }
+
+    def advance(self, name, done=1, rows=0):
+        with self._lock:
+            check = self.checks[name]
+            check["done"] += done
+            check["rows_scanned"] += rows or 0
+            finished = check["finished"] is None and check["done"] >= check["total"]
+            if check["done"] >= check["total"]:
+                check["finished"] = time.monotonic()
+        if rows:
+            audit_metrics.add("audit_rows_scanned_total", (("check", name),), rows)
+        if finished:
+            audit_metrics.observe(
+                "audit_check_duration_seconds", (("check", name),), check["finished"] - check["started"], CHECK_DURATION_BUCKETS
+            )
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def snapshot(self):
+        now = self.finished or time.monotonic()
+        with self._lock:
+            return {
+                "elapsed_seconds": round(now - self.started, 1),
+                "checks": {
+                    name: {
+                        "done": check["done"],
+                        "total": check["total"],
+                        "rows_scanned": check["rows_scanned"],
+                        "elapsed_seconds": round((check["finished"] or now) - check["started"], 1),
+                    }
+                    for name, check in self.checks.items()
+                },
+            }
+
+
+class QueryProfiler:
+    def __init__(self, statistics_io=False):
+        self.statistics_io = statistics_io
+        self.queries = []
+        self._statistics_connections = set()
+        self._lock = threading.Lock()
+
+    def logical_reads(self, cursor):
+        return drain_logical_reads(cursor) if self.statistics_io else None
+
+    def prepare(self, cursor):
+        # SET STATISTICS IO se activa una vez por conexión; sin permiso se mide solo el tiempo
+        if not self.statistics_io:
+            return
+        key = id(getattr(cursor, "connection", cursor))
+        with self._lock:
+            if key in self._statistics_connections:
+                return
+            self._statistics_connections.add(key)
+        try:
+            cursor.execute("SET STATISTICS IO ON")
+        except Exception:
+            pass
+
+    def record(self, check, table, column, elapsed, rows, logical_reads, throttled=0, error=None):
+        with self._lock:
+            self.queries.append({
+                "check": check,
+                "table": table,
+                "column": column,
+                "elapsed_seconds": round(elapsed, 4),
+                "rows": rows,
+                "logical_reads": logical_reads,
+                "throttled_seconds": throttled,
+                "error": str(error) if error is not None else None,
+            })
+
+    def by_check(self):
+        totals = {}
+        with self._lock:
+            queries = list(self.queries)
+        for query in queries:
+            total = totals.setdefault(
+                (query["check"], query["table"]),
+                {"check": query["check"], "table": query["table"], "queries": 0, "elapsed_seconds": 0.0, "rows": 0, "logical_reads": None},
+            )
+            total["queries"] += 1
+            total["elapsed_seconds"] += query["elapsed_seconds"]
+            total["rows"] += query["rows"] or 0
+            if query["logical_reads"] is not None:
+                total["logical_reads"] = (total["logical_reads"] or 0) + query["logical_reads"]
+        for total in totals.values():
+            total["elapsed_seconds"] = round(total["elapsed_seconds"], 4)
+        return sorted(totals.values(), key=lambda total: total["elapsed_seconds"], reverse=True)
+
+    def slowest(self, limit):
+        with self._lock:
+            queries = list(self.queries)
+        return sorted(queries, key=lambda query: query["elapsed_seconds"], reverse=True)[:limit]
+
+    def to_dict(self):
+        with self._lock:
+            queries = list(self.queries)
+        return {
+            "query_count": len(queries),
+            "query_seconds": round(sum(query["elapsed_seconds"] for query in queries), 4),
+            "throttled_seconds": sum(query["throttled_seconds"] for query in queries),
+            "checks": self.by_check(),
+            "queries": queries,
+        }
+
+
+METRICS = {
+    "audit_queries_total": ("counter", "Consultas de auditoría ejecutadas."),
+    "audit_query_errors_total": ("counter", "Consultas de auditoría que fallaron."),
+    "audit_query_rows_total": ("counter", "Filas devueltas por las consultas de auditoría."),
+    "audit_query_duration_seconds": ("histogram", "Duración de cada consulta de auditoría."),
+    "audit_throttle_wait_seconds_total": ("counter", "Segundos de espera por carga del servidor antes de los recorridos."),
+    "audit_last_query_timestamp_seconds": ("gauge", "Momento (epoch) en que terminó la última consulta de auditoría."),
+    "audit_rows_scanned_total": ("counter", "Filas recorridas por los chequeos."),
+    "audit_check_duration_seconds": ("histogram", "Duración de cada chequeo, desde que empieza hasta su último elemento."),
+    "audit_jobs": ("gauge", "Auditorías en la cola (pending) o en ejecución (running)."),
+    "audit_jobs_finished_total": ("counter", "Auditorías terminadas, por opción y estado."),
+    "audit_job_duration_seconds": ("histogram", "Duración de cada auditoría."),
+    "audit_pool_connections": ("gauge", "Conexiones de los pools, prestadas (in_use) u ociosas (idle)."),
+    "audit_pool_max_connections": ("gauge", "Tamaño máximo de cada pool."),
+    "audit_log_bytes_total": ("counter", "Bytes escritos en los logs de texto."),
+}
+
+
+def metric_labels(labels):
+    # {nombre="valor",...} con las barras, comillas y saltos de línea escapados
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class AuditMetrics:
+    # Contadores e histogramas de todas las auditorías del proceso. Cada consulta los actualiza con un solo
+    # lock; los valores que cambian solos (trabajos, pools) se leen recién al pedir /metrics
+    def __init__(self):
+        self.counters = {}
+        # Por (nombre, etiquetas): [límites, conteo por intervalo (el último es +Inf), suma, cantidad]
+        self.histograms = {}
+        self.last_query = None
+        self._lock = threading.Lock()
+
+    def _add(self, name, labels, amount):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def _observe(self, name, labels, value, buckets):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+        histogram[1][bisect.bisect_left(buckets, value)] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+    def add(self, name, labels, amount=1):
+        with self._lock:
+            self._add(name, labels, amount)
+
+    def observe(self, name, labels, value, buckets):
+        with self._lock:
+            self._observe(name, labels, value, buckets)
+
+    def observe_query(self, check, elapsed, rows, throttled, error):
+        labels = (("check", check or ""),)
+        with self._lock:
+            self._add("audit_queries_total", labels, 1)
+            if error is not None:
+                self._add("audit_query_errors_total", labels, 1)
+            if rows:
+                self._add("audit_query_rows_total", labels, rows)
+            if throttled:
+                self._add("audit_throttle_wait_seconds_total", labels, throttled)
+            self._observe("audit_query_duration_seconds", labels, elapsed, QUERY_DURATION_BUCKETS)
+            self.last_query = time.time()
+
+    def render(self, gauges):
+        # gauges: (nombre, etiquetas, valor) leídos en el momento
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(f"{name}{metric_labels(labels)} {value}")
+            for (name, labels), (buckets, counts, total, count) in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{metric_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{metric_labels(labels)} {total}")
+                lines.append(f"{name}_count{metric_labels(labels)} {count}")
+            if self.last_query is not None:
+                samples["audit_last_query_timestamp_seconds"] = [f"audit_last_query_timestamp_seconds {self.last_query}"]
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(f"{name}{metric_labels(labels)} {value}")
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            if name in samples:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+
+audit_metrics = AuditMetrics()
+
+
+# Perfilador y control de carga de la auditoría en curso; run_parallel los propaga a los hilos del pool
+current_profiler = contextvars.ContextVar("current_profiler", default=None)
+current_throttle = contextvars.ContextVar("current_throttle", default=None)
+
+
+def read_logical_reads(cursor):
+    # Mensajes de SET STATISTICS IO: "Table 'X'. Scan count 1, logical reads 12, ..."
+    total = None
+    for _, message in getattr(cursor, "messages", None) or []:
+        for match in LOGICAL_READS_PATTERN.finditer(str(message)):
+            total = (total or 0) + int(match.group(1))
+    return total
+
+
+def drain_logical_reads(cursor):
+    # Con el driver ODBC de SQL Server, los mensajes de SET STATISTICS IO de una consulta llegan recién al
+    # pasar al siguiente conjunto de resultados: se suman los del actual y los de cada nextset(). Solo
+    # después de leer todas las filas que se van a usar
+    total = read_logical_reads(cursor)
+    while cursor.nextset():
+        reads = read_logical_reads(cursor)
+        if reads is not None:
+            total = (total or 0) + reads
+    return total
+
+
+def limit_full_scan(cursor, query):
+    # Los recorridos completos esperan a que baje la carga del servidor y limitan su paralelismo
+    throttled = 0
+    throttle = current_throttle.get()
+    if throttle is not None:
+        throttled = throttle.wait(cursor)
+    if app.config["AUDIT_MAXDOP"]:
+        query = f"{query}\n    OPTION (MAXDOP {app.config['AUDIT_MAXDOP']})"
+    return query, throttled
+
+
+def run_query(cursor, query, fetch="all", check=None, table=None, column=None, full_scan=False):
+    # Ejecuta una consulta de auditoría y, si hay un perfilador activo, registra su costo
+    throttled = 0
+    if full_scan:
+        query, throttled = limit_full_scan(cursor, query)
+
+    profiler = current_profiler.get()
+    if profiler is not None:
+        profiler.prepare(cursor)
+    started = time.perf_counter()
+    try:
+        cursor.execute(query)
+        if fetch == "one":
+            result = cursor.fetchone()
+            rows = 0 if result is None else 1
+        else:
+            result = cursor.fetchall()
+            rows = len(result)
+    except Exception as e:
+        audit_metrics.observe_query(check, time.perf_counter() - started, None, throttled, e)
+        if profiler is not None:
+            profiler.record(check, table, column, time.perf_counter() - started, None, None, throttled, e)
+        raise
+    audit_metrics.observe_query(check, time.perf_counter() - started, rows, throttled, None)
+    if profiler is not None:
+        profiler.record(check, table, column, time.perf_counter() - started, rows, profiler.logical_reads(cursor), throttled)
+    return result
+
+
+def fetch_batches(cursor, query, arraysize, check=None, table=None, column=None, full_scan=False):
+    # Como run_query, pero entrega las filas en lotes de fetchmany para no tenerlas todas en memoria.
+    # El tiempo registrado incluye el de procesar cada lote, porque el resultado se lee a medida que se usa
+    throttled = 0
+    if full_scan:
+        query, throttled = limit_full_scan(cursor, query)
+    profiler = current_profiler.get()
+    if profiler is not None:
+        profiler.prepare(cursor)
+    cursor.arraysize = arraysize
+    started = time.perf_counter()
+    rows = 0
+    try:
+        cursor.execute(query)
+        while True:
+            batch = cursor.fetchmany(arraysize)
+            if not batch:
+                break
+            rows += len(batch)
+            yield batch
+    except Exception as e:
+        audit_metrics.observe_query(check, time.perf_counter() - started, rows, throttled, e)
+        if profiler is not None:
+            profiler.record(check, table, column, time.perf_counter() - started, None, None, throttled, e)
+        raise
+    audit_metrics.observe_query(check, time.perf_counter() - started, rows, throttled, None)
+    if profiler is not None:
+        profiler.record(check, table, column, time.perf_counter() - started, rows, profiler.logical_reads(cursor), throttled)
+
+
+def run_script(cursor, statements, check=None, table=None):
+    # Envía varias sentencias (PlannedStatement) en un solo lote y devuelve las filas de cada conjunto
+    # de resultados, en orden. Los recorridos completos se limitan como en run_query
+    throttled = 0
+    maxdop = app.config["AUDIT_MAXDOP"]
+    if any(statement.scans for statement in statements):
+        throttle = current_throttle.get()
+        if throttle is not None:
+            throttled = throttle.wait(cursor)
+    # SET NOCOUNT ON evita que los SELECT INTO y DROP devuelvan conteos de filas como resultados
+    script = ";\n".join(
+        ["SET NOCOUNT ON"]
+        + [
+            f"{statement.query}\n    OPTION (MAXDOP {maxdop})" if statement.scans and maxdop else statement.query
+            for statement in statements
+        ]
+    )
+
+    profiler = current_profiler.get()
+    if profiler is not None:
+        profiler.prepare(cursor)
+    started = time.perf_counter()
+    result_sets = []
+    logical_reads = None
+    try:
+        cursor.execute(script)
+        while True:
+            if cursor.description is not None:
+                result_sets.append(cursor.fetchall())
+            reads = read_logical_reads(cursor)
+            if reads is not None:
+                logical_reads = (logical_reads or 0) + reads
+            if not cursor.nextset():
+                break
+    except Exception as e:
+        audit_metrics.observe_query(check, time.perf_counter() - started, None, throttled, e)
+        if profiler is not None:
+            profiler.record(check, table, None, time.perf_counter() - started, None, None, throttled, e)
+        raise
+    audit_metrics.observe_query(check, time.perf_counter() - started, sum(len(rows) for rows in result_sets), throttled, None)
+    if profiler is not None:
+        profiler.record(
+            check, table, None, time.perf_counter() - started,
+            sum(len(rows) for rows in result_sets), logical_reads, throttled,
+        )
+    return result_sets
+
+
+def quote_identifier(name):
+    return "[" + name.replace("]", "]]") + "]"
+
+
+def qualified_name(schema, table):
+    return f"{quote_identifier(schema)}.{quote_identifier(table)}"
+
+
+def get_server_capabilities(cursor):
+    row = run_query(cursor, """
+    SELECT 
+        CAST(SERVERPROPERTY('ProductMajorVersion') AS int) AS major_version,
+        CAST(SERVERPROPERTY('EngineEdition') AS int) AS engine_edition
+    """, fetch="one", check="catalogo")
+    major_version = row.major_version or 0
+    # Azure SQL Database (5) y Managed Instance (8) siempre tienen la última versión del motor
+    cloud = row.engine_edition in (5, 8)
+    return {
+        "approx_count_distinct": cloud or major_version >= 15,
+        "approx_percentile": cloud or major_version >= 16,
+        # sys.dm_db_stats_histogram existe desde SQL Server 2016 SP1 CU2
+        "stats_histogram": cloud or major_version >= 14,
+    }
+
+
+class ColumnInfo:
+    __slots__ = ("name", "data_type", "nullable", "max_length")
+
+    def __init__(self, name, data_type, nullable, max_length):
+        self.name = name
+        self.data_type = data_type
+        self.nullable = nullable
+        self.max_length = max_length
+
+
+class TableInfo:
+    __slots__ = ("object_id", "schema", "name", "row_count", "columns")
+
+    def __init__(self, object_id, schema, name, row_count):
+        self.object_id = object_id
+        self.schema = schema
+        self.name = name
+        self.row_count = row_count
+        self.columns = []
+
+    @property
+    def display_name(self):
+        return f"{self.schema}.{self.name}"
+
+    @property
+    def qualified_name(self):
+        return qualified_name(self.schema, self.name)
+
+
+class ForeignKeyInfo:
+    __slots__ = (
+        "object_id",
+        "name",
+        "parent_schema",
+        "parent_table",
+        "parent_columns",
+        "referenced_schema",
+        "referenced_table",
+        "referenced_columns",
+        "parent_row_count",
+        "indexed",
+    )
+
+    def __init__(self, object_id, name, parent_schema, parent_table, referenced_schema, referenced_table):
+        self.object_id = object_id
+        self.name = name
+        self.parent_schema = parent_schema
+        self.parent_table = parent_table
+        self.parent_columns = []
+        self.referenced_schema = referenced_schema
+        self.referenced_table = referenced_table
+        self.referenced_columns = []
+        self.parent_row_count = None
+        # Si las columnas de la FK son las primeras claves de algún índice de la tabla hija
+        self.indexed = None
+
+
+class UniqueConstraintInfo:
+    __slots__ = ("name", "schema", "table", "columns", "primary_key")
+
+    def __init__(self, name, schema, table, primary_key=False):
+        self.name = name
+        self.schema = schema
+        self.table = table
+        self.columns = []
+        self.primary_key = primary_key
+
+
+def load_tables(cursor):
+    query = """
+    SELECT 
+        t.object_id,
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        t.name AS table_name
+    FROM 
+        sys.tables AS t
+    WHERE 
+        t.is_ms_shipped = 0
+    ORDER BY 
+        schema_name, table_name
+    """
+    row_counts = load_row_counts(cursor)
+    return {
+        (row.schema_name, row.table_name): TableInfo(
+            row.object_id, row.schema_name, row.table_name, row_counts.get(row.object_id, 0)
+        )
+        for row in run_query(cursor, query, check="catalogo")
+    }
+
+
+def load_row_counts(cursor):
+    query = """
+    SELECT object_id, SUM({rows}) AS row_count
+    FROM {source}
+    WHERE index_id IN (0, 1)
+    GROUP BY object_id
+    """
+    try:
+        rows = run_query(cursor, query.format(source="sys.dm_db_partition_stats", rows="row_count"), check="catalogo")
+    except Exception:
+        # sys.dm_db_partition_stats requiere VIEW DATABASE STATE; sys.partitions no
+        rows = run_query(cursor, query.format(source="sys.partitions", rows="rows"), check="catalogo")
+    return {row.object_id: row.row_count for row in rows}
+
+
+def load_columns(cursor, tables):
+    query = """
+    SELECT 
+        c.table_schema, 
+        c.table_name, 
+        c.column_name, 
+        c.data_type, 
+        c.is_nullable, 
+        c.character_maximum_length
+    FROM 
+        information_schema.columns AS c
+    INNER JOIN 
+        information_schema.tables AS t
+    ON 
+        t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE 
+        t.table_type = 'BASE TABLE'
+    ORDER BY 
+        c.table_schema, c.table_name, c.ordinal_position
+    """
+    for row in run_query(cursor, query, check="catalogo"):
+        table = tables.get((row.table_schema, row.table_name))
+        if table is not None:
+            table.columns.append(
+                ColumnInfo(
+                    row.column_name,
+                    row.data_type.lower(),
+                    row.is_nullable == "YES",
+                    row.character_maximum_length,
+                )
+            )
+
+
+def load_foreign_keys(cursor):
+    query = """
+    SELECT 
+        fk.object_id AS constraint_id,
+        fk.name AS foreign_key_name,
+        SCHEMA_NAME(tp.schema_id) AS parent_schema,
+        tp.name AS parent_table,
+        cp.name AS parent_column,
+        SCHEMA_NAME(tr.schema_id) AS referenced_schema,
+        tr.name AS referenced_table,
+        cr.name AS referenced_column
+    FROM 
+        sys.foreign_keys AS fk
+    INNER JOIN 
+        sys.foreign_key_columns AS fkc ON fk.object_id = fkc.constraint_object_id
+    INNER JOIN 
+        sys.tables AS tp ON fkc.parent_object_id = tp.object_id
+    INNER JOIN 
+        sys.columns AS cp ON fkc.parent_object_id = cp.object_id AND fkc.parent_column_id = cp.column_id
+    INNER JOIN 
+        sys.tables AS tr ON fkc.referenced_object_id = tr.object_id
+    INNER JOIN 
+        sys.columns AS cr ON fkc.referenced_object_id = cr.object_id AND fkc.referenced_column_id = cr.column_id
+    ORDER BY 
+        fk.name, fkc.constraint_object_id, fkc.constraint_column_id
+    """
+    rows = run_query(cursor, query, check="catalogo")
+
+    # Una FK compuesta devuelve una fila por columna: se agrupan por constraint_object_id
+    foreign_keys = {}
+    for row in rows:
+        fk = foreign_keys.get(row.constraint_id)
+        if fk is None:
+            fk = foreign_keys[row.constraint_id] = ForeignKeyInfo(
+                row.constraint_id,
+                row.foreign_key_name,
+                row.parent_schema,
+                row.parent_table,
+                row.referenced_schema,
+                row.referenced_table,
+            )
+        fk.parent_columns.append(row.parent_column)
+        fk.referenced_columns.append(row.referenced_column)
+    return list(foreign_keys.values())
+
+
+def load_indexes(cursor):
+    # Columnas clave (sin las incluidas) de cada índice rowstore habilitado y sin filtro, en orden
+    query = """
+    SELECT 
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        t.name AS table_name,
+        i.index_id,
+        c.name AS column_name
+    FROM 
+        sys.indexes AS i
+    INNER JOIN 
+        sys.index_columns AS ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+    INNER JOIN 
+        sys.columns AS c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+    INNER JOIN 
+        sys.tables AS t ON t.object_id = i.object_id
+    WHERE 
+        t.is_ms_shipped = 0
+        AND i.type IN (1, 2)
+        AND i.is_disabled = 0
+        AND i.is_hypothetical = 0
+        AND i.has_filter = 0
+        AND ic.is_included_column = 0
+        AND ic.key_ordinal > 0
+    ORDER BY 
+        schema_name, table_name, i.index_id, ic.key_ordinal
+    """
+    indexes = {}
+    for row in run_query(cursor, query, check="catalogo"):
+        indexes.setdefault((row.schema_name, row.table_name), {}).setdefault(row.index_id, []).append(row.column_name)
+    return {table: list(table_indexes.values()) for table, table_indexes in indexes.items()}
+
+
+def load_unique_constraints(cursor):
+    query = """
+    SELECT 
+        tc.table_schema, 
+        tc.table_name, 
+        tc.constraint_name, 
+        tc.constraint_type, 
+        kcu.column_name
+    FROM 
+        information_schema.table_constraints AS tc
+    INNER JOIN 
+        information_schema.key_column_usage AS kcu
+    ON 
+        tc.constraint_schema = kcu.constraint_schema AND tc.constraint_name = kcu.constraint_name
+    WHERE 
+        tc.constraint_type IN ('UNIQUE', 'PRIMARY KEY')
+    ORDER BY 
+        tc.table_schema, tc.table_name, tc.constraint_name, kcu.ordinal_position
+    """
+    constraints = {}
+    for row in run_query(cursor, query, check="catalogo"):
+        key = (row.table_schema, row.constraint_name)
+        constraint = constraints.get(key)
+        if constraint is None:
+            constraint = constraints[key] = UniqueConstraintInfo(
+                row.constraint_name,
+                row.table_schema,
+                row.table_name,
+                row.constraint_type == "PRIMARY KEY",
+            )
+        constraint.columns.append(row.column_name)
+    return list(constraints.values())
+
+
+class SchemaCatalog:
+    __slots__ = ("key", "version", "login", "capabilities", "tables", "foreign_keys", "unique_constraints")
+
+    def __init__(self, key, version, login=None):
+        self.key = key
+        self.version = version
+        # Usuario con el que se cargó: otro usuario puede ver otras tablas y no comparte el catálogo
+        self.login = login
+        self.capabilities = {}
+        self.tables = {}
+        self.foreign_keys = []
+        self.unique_constraints = []
+
+    @staticmethod
+    def read_version(cursor):
+        # Cualquier cambio de DDL actualiza sys.objects.modify_date o la cantidad de objetos
+        row = run_query(cursor, """
+        SELECT 
+            @@SERVERNAME AS server_name, 
+            DB_NAME() AS database_name, 
+            SUSER_SNAME() AS login_name, 
+            MAX(modify_date) AS last_modified, 
+            COUNT(*) AS object_count
+        FROM 
+            sys.objects
+        """, fetch="one", check="catalogo")
+        return (row.server_name, row.database_name), (row.last_modified, row.object_count), row.login_name
+
+    @classmethod
+    def load(cls, cursor, key, version, login=None):
+        catalog = cls(key, version, login)
+        catalog.capabilities = get_server_capabilities(cursor)
+        catalog.tables = load_tables(cursor)
+        load_columns(cursor, catalog.tables)
+        catalog.foreign_keys = load_foreign_keys(cursor)
+        indexes = load_indexes(cursor)
+        for fk in catalog.foreign_keys:
+            parent = catalog.tables.get((fk.parent_schema, fk.parent_table))
+            fk.parent_row_count = parent.row_count if parent is not None else None
+            # Un índice sirve aunque tenga las columnas de la FK en otro orden, siempre que vayan primero
+            fk.indexed = any(
+                set(columns[: len(fk.parent_columns)]) == set(fk.parent_columns)
+                for columns in indexes.get((fk.parent_schema, fk.parent_table), [])
+            )
+        catalog.unique_constraints = load_unique_constraints(cursor)
+        return catalog
+
+    def refresh_row_counts(self, cursor):
+        # El DML no cambia la versión del catálogo: las filas se releen en cada auditoría para que el
+        # muestreo, la extrapolación y el orden de los chequeos no trabajen con conteos viejos
+        row_counts = load_row_counts(cursor)
+        for table in self.tables.values():
+            table.row_count = row_counts.get(table.object_id, 0)
+        for fk in self.foreign_keys:
+            parent = self.tables.get((fk.parent_schema, fk.parent_table))
+            fk.parent_row_count = parent.row_count if parent is not None else None
+
+
+# Catálogos cargados, por (servidor, base de datos) y usuario
+schema_catalogs = {}
+schema_catalogs_lock = threading.Lock()
+
+
+def get_schema_catalog(connection):
+    cursor = connection.cursor()
+    key, version, login = SchemaCatalog.read_version(cursor)
+    with schema_catalogs_lock:
+        catalog = schema_catalogs.get((key, login))
+    if catalog is None or catalog.version != version:
+        print("Cargando catálogo del esquema.")
+        catalog = SchemaCatalog.load(cursor, key, version, login)
+        with schema_catalogs_lock:
+            schema_catalogs[(key, login)] = catalog
+    else:
+        catalog.refresh_row_counts(cursor)
+    return catalog
+
+
+class AuditStateStore:
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS audit_state (
+                server TEXT NOT NULL,
+                database_name TEXT NOT NULL,
+                check_name TEXT NOT NULL,
+                object_key TEXT NOT NULL,
+                watermark TEXT NOT NULL,
+                result TEXT NOT NULL,
+                audited_at TEXT NOT NULL,
+                PRIMARY KEY (server, database_name, check_name, object_key)
+            )
+            """)
+        return self._connection
+
+    def load(self, database_key, check_name):
+        server, database = database_key
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT object_key, watermark, result FROM audit_state "
+                "WHERE server = ? AND database_name = ? AND check_name = ?",
+                (server, database, check_name),
+            ).fetchall()
+        return {object_key: (watermark, json.loads(result)) for object_key, watermark, result in rows}
+
+    def save(self, database_key, check_name, entries):
+        # entries: (object_key, watermark, resultado serializable)
+        server, database = database_key
+        audited_at = datetime.datetime.now().isoformat()
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO audit_state VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (server, database, check_name, object_key, watermark, json.dumps(result, default=str), audited_at)
+                    for object_key, watermark, result in entries
+                ],
+            )
+            connection.commit()
+
+    def delete(self, database_key, check_name, prefix):
+        server, database = database_key
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "DELETE FROM audit_state WHERE server = ? AND database_name = ? AND check_name = ? "
+                "AND substr(object_key, 1, ?) = ?",
+                (server, database, check_name, len(prefix), prefix),
+            )
+            connection.commit()
+
+
+audit_state_store = AuditStateStore(app.config["AUDIT_STATE_PATH"])
+
+
+def load_table_watermarks(cursor):
+    # Marca de cambios por tabla: DDL, cantidad de filas, última escritura registrada y reinicio
+    # del servidor (las estadísticas de uso de índices se pierden al reiniciar)
+    query = """
+    SELECT 
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        t.name AS table_name,
+        t.modify_date,
+        ISNULL(p.row_count, 0) AS row_count,
+        u.last_user_update,
+        i.sqlserver_start_time
+    FROM 
+        sys.tables AS t
+    LEFT JOIN (
+        SELECT object_id, SUM(row_count) AS row_count
+        FROM sys.dm_db_partition_stats
+        WHERE index_id IN (0, 1)
+        GROUP BY object_id
+    ) AS p ON p.object_id = t.object_id
+    LEFT JOIN (
+        SELECT object_id, MAX(last_user_update) AS last_user_update
+        FROM sys.dm_db_index_usage_stats
+        WHERE database_id = DB_ID()
+        GROUP BY object_id
+    ) AS u ON u.object_id = t.object_id
+    CROSS JOIN 
+        sys.dm_os_sys_info AS i
+    WHERE 
+        t.is_ms_shipped = 0
+    """
+    return {
+        f"{row.schema_name}.{row.table_name}": (
+            f"{row.modify_date}|{row.row_count}|{row.last_user_update}|{row.sqlserver_start_time}"
+        )
+        for row in run_query(cursor, query, check="incremental")
+    }
+
+
+def split_unchanged(items, object_key, watermarks, previous):
+    # Separa los elementos cuyo watermark no cambió (con su resultado guardado) de los que hay que auditar
+    reused = {}
+    pending = []
+    for item in items:
+        key = object_key(item)
+        watermark = watermarks.get(key)
+        cached = previous.get(key)
+        if watermark is not None and cached is not None and cached[0] == watermark:
+            reused[key] = cached[1]
+        else:
+            pending.append(item)
+    return reused, pending
+
+
+def is_readable_secondary(cursor):
+    row = run_query(cursor, """
+    SELECT COUNT(*) AS secondary
+    FROM sys.dm_hadr_database_replica_states
+    WHERE database_id = DB_ID() AND is_local = 1 AND is_primary_replica = 0
+    """, fetch="one", check="incremental")
+    return row.secondary > 0
+
+
+def load_incremental_state(connection, pool, catalog, check_name):
+    # Devuelve (watermarks, resultados guardados, clave del estado, aviso). Una réplica legible no registra en
+    # sys.dm_db_index_usage_stats las escrituras que recibe del primario y tiene su propio @@SERVERNAME:
+    # con réplicas, los watermarks y la clave del estado salen del primario
+    try:
+        if isinstance(pool, ReplicaPool):
+            with pool.primary.connection() as primary_connection:
+                cursor = primary_connection.cursor()
+                database_key = SchemaCatalog.read_version(cursor)[0]
+                watermarks = load_table_watermarks(cursor)
+        else:
+            cursor = connection.cursor()
+            if is_readable_secondary(cursor):
+                return {}, {}, catalog.key, (
+                    "Modo incremental no disponible en una réplica secundaria (no registra las escrituras del "
+                    "primario), se auditan todas las tablas."
+                )
+            database_key = catalog.key
+            watermarks = load_table_watermarks(cursor)
+    except Exception as e:
+        # Sin VIEW SERVER STATE no hay forma confiable de saber qué cambió: se audita todo
+        return {}, {}, catalog.key, f"Modo incremental no disponible, se auditan todas las tablas: {e}"
+    return watermarks, audit_state_store.load(database_key, check_name), database_key, None
+
+
+def load_chunk_layout(cursor):
+    # Por tabla: función y columna de partición (si está particionada), primera columna de la clave
+    # clustered y filas de cada partición del heap o del índice clustered
+    query = """
+    SELECT 
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        t.name AS table_name,
+        pf.name AS function_name,
+        pc.name AS partition_column,
+        kc.name AS key_column,
+        p.partition_number,
+        p.rows
+    FROM 
+        sys.tables AS t
+    INNER JOIN 
+        sys.indexes AS i ON i.object_id = t.object_id AND i.index_id IN (0, 1)
+    INNER JOIN 
+        sys.partitions AS p ON p.object_id = i.object_id AND p.index_id = i.index_id
+    LEFT JOIN 
+        sys.partition_schemes AS ps ON ps.data_space_id = i.data_space_id
+    LEFT JOIN 
+        sys.partition_functions AS pf ON pf.function_id = ps.function_id
+    LEFT JOIN 
+        sys.index_columns AS pic ON pic.object_id = i.object_id AND pic.index_id = i.index_id AND pic.partition_ordinal = 1
+    LEFT JOIN 
+        sys.columns AS pc ON pc.object_id = pic.object_id AND pc.column_id = pic.column_id
+    LEFT JOIN 
+        sys.index_columns AS kic ON kic.object_id = i.object_id AND kic.index_id = 1 AND kic.key_ordinal = 1
+    LEFT JOIN 
+        sys.columns AS kc ON kc.object_id = kic.object_id AND kc.column_id = kic.column_id
+    WHERE 
+        t.is_ms_shipped = 0
+    ORDER BY 
+        schema_name, table_name, p.partition_number
+    """
+    layout = {}
+    for row in run_query(cursor, query, check="partes"):
+        entry = layout.setdefault(
+            (row.schema_name, row.table_name), (row.function_name, row.partition_column, row.key_column, [])
+        )
+        entry[3].append((row.partition_number, row.rows))
+    return layout
+
+
+def sql_literal(value):
+    # Fechas en ISO 8601 con "T", que SQL Server interpreta igual con cualquier idioma o DATEFORMAT
+    if isinstance(value, datetime.datetime):
+        return f"'{value.isoformat(timespec='milliseconds')}'"
+    if isinstance(value, datetime.date):
+        return f"'{value.isoformat()}'"
+    return str(value)
+
+
+def chunk_boundary(low, high, number, parts):
+    if isinstance(low, int):
+        return low + (high - low) * number // parts
+    return low + (high - low) * number / parts
+
+
+def chunk_predicates(cursor, table, layout):
+    # Devuelve (método, predicados sobre la tabla con alias t); cada fila cumple exactamente uno
+    parts = max(1, min(app.config["AUDIT_MAX_CHUNKS"], -(-table.row_count // app.config["AUDIT_CHUNK_ROWS"])))
+    function_name, partition_column, key_column, partitions = layout or (None, None, None, [])
+    if function_name and partition_column and len(partitions) > 1:
+        # Particiones consecutivas agrupadas hasta juntar unas row_count / parts filas; $PARTITION
+        # permite que SQL Server lea solo las particiones de cada parte
+        expression = f"$PARTITION.{quote_identifier(function_name)}(t.{quote_identifier(partition_column)})"
+        size = table.row_count / parts
+        groups = [[]]
+        rows = 0
+        for number, partition_rows in partitions:
+            if groups[-1] and rows >= size:
+                groups.append([])
+                rows = 0
+            groups[-1].append(number)
+            rows += partition_rows
+        return f"particiones de {partition_column}", [
+            f"{expression} = {group[0]}" if len(group) == 1 else f"{expression} BETWEEN {group[0]} AND {group[-1]}"
+            for group in groups
+        ]
+
+    column = next((column for column in table.columns if column.name == key_column), None)
+    if column is None or column.data_type not in CHUNK_KEY_TYPES or parts < 2:
+        return None, []
+    # Rangos de igual ancho entre el mínimo y el máximo de la clave (dos búsquedas en el índice clustered).
+    # El primero y el último quedan abiertos para incluir las filas que se inserten durante la auditoría
+    name = f"t.{quote_identifier(column.name)}"
+    row = run_query(
+        cursor,
+        f"SELECT MIN({name}) AS low, MAX({name}) AS high FROM {table.qualified_name} AS t",
+        fetch="one",
+        check="partes",
+        table=table.display_name,
+        column=column.name,
+    )
+    if row is None or row.low is None or row.low == row.high:
+        return None, []
+    boundaries = sorted({chunk_boundary(row.low, row.high, number, parts) for number in range(1, parts)} - {row.low})
+    if not boundaries:
+        # Rango entero más angosto que la cantidad de partes: no hay dónde cortar
+        return None, []
+    literals = [sql_literal(boundary) for boundary in boundaries]
+    predicates = (
+        [f"{name} < {literals[0]}"]
+        + [f"{name} >= {low} AND {name} < {high}" for low, high in zip(literals, literals[1:])]
+        + [f"{name} >= {literals[-1]}"]
+    )
+    if column.nullable:
+        predicates.append(f"{name} IS NULL")
+    return f"rangos de {column.name}", predicates
+
+
+class ChunkPlan:
+    # Partes en que se recorre una tabla grande para un chequeo
+    __slots__ = ("table", "database_key", "check", "method", "predicates")
+
+    def __init__(self, table, database_key, check, method, predicates):
+        self.table = table
+        self.database_key = database_key
+        self.check = check
+        self.method = method
+        self.predicates = predicates
+
+    @property
+    def state_prefix(self):
+        return f"{self.check}|{self.table.display_name}|"
+
+    def finish(self):
+        # La tabla terminó: la próxima auditoría vuelve a planificarla y a recorrerla completa
+        audit_state_store.delete(self.database_key, "partes", self.state_prefix)
+
+
+def plan_table_chunks(connection, catalog, tables, check):
+    # Plan por partes de las tablas de al menos AUDIT_CHUNK_THRESHOLD_ROWS filas. Si una auditoría
+    # anterior quedó a medias se reutiliza su plan, para que coincida con las partes ya guardadas
+    large = [table for table in tables if table.row_count >= app.config["AUDIT_CHUNK_THRESHOLD_ROWS"]]
+    if not large:
+        return {}
+    cursor = connection.cursor()
+    try:
+        layout = load_chunk_layout(cursor)
+    except Exception as e:
+        print("No se pudo leer la distribución de las tablas, se recorren completas:", e)
+        return {}
+    stored = audit_state_store.load(catalog.key, "partes")
+    plans = {}
+    for table in large:
+        plan_key = f"{check}|{table.display_name}|plan"
+        saved = stored.get(plan_key)
+        if saved is not None and saved[0] == str(table.object_id):
+            method, predicates = saved[1]
+        else:
+            try:
+                method, predicates = chunk_predicates(cursor, table, layout.get((table.schema, table.name)))
+            except Exception as e:
+                print(f"No se pudo dividir {table.display_name}, se recorre completa:", e)
+                continue
+            if len(predicates) > 1:
+                audit_state_store.save(catalog.key, "partes", [(plan_key, str(table.object_id), (method, predicates))])
+        if len(predicates) > 1:
+            plans[table.display_name] = ChunkPlan(table, catalog.key, check, method, predicates)
+    return plans
+
+
+def encode_chunk_row(row):
+    # JSON no distingue fechas ni decimales: se guardan con su tipo para poder combinarlos con las
+    # partes que se recorran en la próxima ejecución
+    return [
+        [type(value).__name__, str(value)] if isinstance(value, (decimal.Decimal, datetime.date, datetime.time)) else value
+        for value in row
+    ]
+
+
+CHUNK_VALUE_TYPES = {
+    "Decimal": decimal.Decimal,
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "time": datetime.time.fromisoformat,
+}
+
+
+def decode_chunk_row(row):
+    return [CHUNK_VALUE_TYPES[value[0]](value[1]) if isinstance(value, list) else value for value in row]
+
+
+@contextmanager
+def chunk_cursor(cursor):
+    # Cursor con el timeout de las partes: pyodbc lo toma de la conexión al crear el cursor
+    connection = cursor.connection
+    connection.timeout = app.config["AUDIT_CHUNK_TIMEOUT"]
+    try:
+        limited = connection.cursor()
+    finally:
+        connection.timeout = app.config["AUDIT_QUERY_TIMEOUT"]
+    try:
+        yield limited
+    finally:
+        limited.close()
+
+
+def run_chunks(connection, pool, plan, phase, queries):
+    # Ejecuta una consulta de una fila por parte, en paralelo, y devuelve las filas en orden. Cada parte
+    # terminada se guarda enseguida: si la auditoría se interrumpe o una parte falla, la próxima
+    # ejecución solo recorre las que faltan. El hash de la consulta invalida lo guardado si cambia
+    keys = [f"{plan.state_prefix}{phase}|{number}" for number in range(len(queries))]
+    watermarks = [hashlib.sha1(query.encode("utf-8")).hexdigest() for query in queries]
+    stored = audit_state_store.load(plan.database_key, "partes")
+    rows = [None] * len(queries)
+    pending = []
+    for number, (key, watermark) in enumerate(zip(keys, watermarks)):
+        saved = stored.get(key)
+        if saved is not None and saved[0] == watermark:
+            rows[number] = decode_chunk_row(saved[1])
+        else:
+            pending.append(number)
+
+    def run(cursor, number):
+        with chunk_cursor(cursor) as limited:
+            row = run_query(
+                limited,
+                queries[number],
+                fetch="one",
+                check=plan.check,
+                table=plan.table.display_name,
+                column=f"parte {number % len(plan.predicates) + 1}/{len(plan.predicates)}",
+                full_scan=True,
+            )
+        encoded = encode_chunk_row(row)
+        audit_state_store.save(plan.database_key, "partes", [(keys[number], watermarks[number], encoded)])
+        return decode_chunk_row(encoded)
+
+    for number, row in zip(pending, run_parallel(connection, pool, run, pending)):
+        rows[number] = row
+    return rows
+
+
+def relation_record(fk, check="relaciones", prefix="Foreign Key: "):
+    return AuditRecord(
+        check,
+        f"{prefix}{fk.name} - Table: {fk.parent_table}({', '.join(fk.parent_columns)}) -> {fk.referenced_table}({', '.join(fk.referenced_columns)})",
+        table=f"{fk.parent_schema}.{fk.parent_table}",
+        column=", ".join(fk.parent_columns),
+        metric="foreign_key",
+        value=f"{fk.referenced_schema}.{fk.referenced_table}({', '.join(fk.referenced_columns)})",
+    )
+
+
+class AuditResultCache:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # clave -> (momento en que se guardó, LogWriter del log ya escrito); el orden es el de último uso.
+        # Las entradas no se guardan en memoria: se vuelven a leer del log y de su JSONL
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            if time.monotonic() - cached[0] > self.ttl_seconds or not cached[1].unchanged():
+                # Vencido, o el archivo se volvió a escribir con otro chequeo
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return cached
+
+    def put(self, key, writer):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), writer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+audit_result_cache = AuditResultCache(
+    app.config["AUDIT_CACHE_MAX_ENTRIES"], app.config["AUDIT_CACHE_TTL_SECONDS"]
+)
+
+
+def cached_audit(check_name, connection, settings, audit, reuse=True):
+    # Los resultados se guardan por base de datos, usuario, versión del esquema, chequeo y configuración.
+    # Con reuse=False el chequeo se ejecuta siempre y, si es todo el contenido de su log (write_to_file),
+    # la caché guarda ese log para reutilizarlo. Con reuse=True se reutiliza un log reciente si existe.
+    # audit recibe el catálogo con que se armó la clave, para no volver a cargarlo
+    catalog = get_schema_catalog(connection)
+    key = (catalog.key, catalog.login, catalog.version, check_name, tuple(sorted((settings or {}).items())))
+    if reuse:
+        cached = audit_result_cache.get(key)
+        if cached is not None:
+            stored_at, writer = cached
+            yield f"(Resultados reutilizados de una ejecución de hace {round(time.monotonic() - stored_at)} s)"
+            yield from writer.replay()
+            return
+        yield from audit(catalog)
+        return
+    writer = current_log_writer.get()
+    yield from audit(catalog)
+    if writer is not None:
+        writer.on_finish = lambda: audit_result_cache.put(key, writer)
+
+
+def text_value(expressions):
+    # Valor legible de una o varias columnas: "a | b"
+    if len(expressions) == 1:
+        return f"CAST({expressions[0]} AS nvarchar(400))"
+    return "CONCAT(" + ", N' | ', ".join(f"CAST({expression} AS nvarchar(400))" for expression in expressions) + ")"
+
+
+def sample_key_columns(catalog, table):
+    # Las filas se identifican por la PK; sin PK, por todas las columnas que se pueden comparar
+    for constraint in catalog.unique_constraints:
+        if constraint.primary_key and (constraint.schema, constraint.table) == (table.schema, table.name):
+            return constraint.columns
+    return [
+        column.name
+        for column in table.columns
+        if column.data_type not in UNGROUPABLE_TYPES and column.data_type not in BINARY_TYPES
+    ]
+
+
+def row_sample(check, catalog, table, columns, metric, value, condition):
+    key_columns = sample_key_columns(catalog, table)
+    limit = app.config["ROW_SAMPLE_LIMIT"]
+    return {
+        "check": check,
+        "table": table.display_name,
+        "column": ", ".join(columns),
+        "metric": metric,
+        "key_columns": key_columns,
+        # TOP sin ORDER BY: las primeras filas que encuentre el servidor, sin ordenar todo el resultado
+        "query": f"""
+    SELECT {f"TOP ({limit}) " if limit else ""}{", ".join(f"t.{quote_identifier(column)}" for column in key_columns)}, {value} AS value
+    FROM {table.qualified_name} AS t
+    WHERE {condition}""",
+    }
+
+
+class QuarantineTable:
+    def __init__(self, connection_string, table_name):
+        schema, _, name = table_name.rpartition(".")
+        self.table = qualified_name(schema or "dbo", name)
+        self.connection = pyodbc.connect(connection_string)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(f"""
+        IF OBJECT_ID(N'{self.table.replace("'", "''")}', N'U') IS NULL
+            CREATE TABLE {self.table} (
+                captured_at datetime2 NOT NULL,
+                source_server nvarchar(128) NOT NULL,
+                source_database nvarchar(128) NOT NULL,
+                check_name nvarchar(50) NOT NULL,
+                table_name nvarchar(256) NOT NULL,
+                column_name nvarchar(512) NOT NULL,
+                metric nvarchar(50) NOT NULL,
+                row_key nvarchar(4000) NOT NULL,
+                value nvarchar(4000) NULL
+            )
+        """)
+        self.connection.commit()
+        # Los parámetros de cada lote viajan en un solo arreglo en lugar de un INSERT por fila
+        self.cursor.fast_executemany = True
+
+    def insert(self, rows):
+        self.cursor.executemany(
+            f"INSERT INTO {self.table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+
+    def close(self):
+        close_quietly(self.connection)
+
+
+class RowSampleWriter:
+    # Cada lote de claves se escribe al JSONL (y a la cuarentena) apenas llega de fetchmany, así la
+    # memoria no depende de cuántas filas tenga la anomalía
+    def __init__(self, filepath, source, quarantine=None):
+        self.filepath = filepath
+        self.source = source
+        self.quarantine = quarantine
+        self._file = open(filepath, "wb", buffering=LOG_BUFFER_SIZE)
+        self._lock = threading.Lock()
+
+    def write(self, sample, rows):
+        captured_at = datetime.datetime.now()
+        lines = []
+        quarantine_rows = []
+        for row in rows:
+            key = dict(zip(sample["key_columns"], row[:-1]))
+            value = row[-1]
+            lines.append(json.dumps(
+                {
+                    "check": sample["check"],
+                    "table": sample["table"],
+                    "column": sample["column"],
+                    "metric": sample["metric"],
+                    "key": key,
+                    "value": value,
+                },
+                ensure_ascii=False, separators=(",", ":"), default=str,
+            ) + "\n")
+            if self.quarantine is not None:
+                quarantine_rows.append((
+                    captured_at, self.source[0], self.source[1], sample["check"], sample["table"], sample["column"],
+                    sample["metric"], json.dumps(key, ensure_ascii=False, default=str), None if value is None else str(value),
+                ))
+        with self._lock:
+            self._file.write("".join(lines).encode("utf-8"))
+            if quarantine_rows:
+                self.quarantine.insert(quarantine_rows)
+
+    def close(self):
+        self._file.close()
+        if self.quarantine is not None:
+            self.quarantine.close()
+
+
+def audit_row_samples(connection, catalog, pool, check, samples, filename, settings):
+    yield "MUESTRAS DE FILAS CON ANOMALÍAS:"
+    yield "="*40
+    if not samples:
+        yield "No hay anomalías con filas para muestrear."
+        return
+
+    quarantine = None
+    if settings.get("quarantine"):
+        if not app.config["QUARANTINE_CONNECTION_STRING"]:
+            yield AuditRecord(
+                check, "No hay una tabla de cuarentena configurada (AUDIT_QUARANTINE_CONNECTION_STRING).",
+                metric="quarantine", severity="error",
+            )
+        else:
+            try:
+                quarantine = QuarantineTable(app.config["QUARANTINE_CONNECTION_STRING"], app.config["QUARANTINE_TABLE"])
+            except Exception as e:
+                yield AuditRecord(check, f"Error al abrir la tabla de cuarentena: {e}", metric="quarantine", severity="error")
+
+    writer = RowSampleWriter(os.path.join(output_folder(), filename), catalog.key, quarantine)
+
+    def fetch(cursor, sample):
+        fetched = 0
+        try:
+            for rows in fetch_batches(
+                cursor, sample["query"], app.config["ROW_SAMPLE_ARRAYSIZE"],
+                check=check, table=sample["table"], column=sample["column"], full_scan=True,
+            ):
+                writer.write(sample, rows)
+                fetched += len(rows)
+        except Exception as e:
+            return fetched, e
+        return fetched, None
+
+    try:
+        results = run_parallel(connection, pool, fetch, samples)
+    finally:
+        writer.close()
+    destination = filename + (f" y en {app.config['QUARANTINE_TABLE']}" if quarantine is not None else "")
+    for sample, (fetched, error) in zip(samples, results):
+        if error is not None:
+            yield AuditRecord(
+                check, f"Error al obtener las filas de {sample['table']} ({sample['column']}): {error}",
+                sample["table"], sample["column"], "row_samples", fetched, "error",
+            )
+            continue
+        yield AuditRecord(
+            check,
+            f"{sample['table']}: {sample['column']} - {fetched} filas ({sample['metric']}) guardadas en {destination}, "
+            f"identificadas por {', '.join(sample['key_columns'])}",
+            sample["table"], sample["column"], "row_samples", fetched,
+        )
+
+
+def audit_relations(connection, progress=None, catalog=None):
+    progress = progress or AuditProgress()
+    catalog = catalog or get_schema_catalog(connection)
+    progress.start_check("relaciones", len(catalog.foreign_keys))
+
+    if catalog.foreign_keys:
+        for fk in catalog.foreign_keys:
+            yield relation_record(fk)
+            progress.advance("relaciones")
+    else:
+        yield "No se encontraron relaciones."
+
+
+def identify_relations(connection, progress=None):
+    print("Identificación automática de las relaciones.")
+    return write_to_file(
+        "relations_log.txt",
+        cached_audit(
+            "relaciones", connection, None, lambda catalog: audit_relations(connection, progress, catalog), reuse=False
+        ),
+        progress,
+    )
+
+
+def index_name(table, columns):
+    return f"IX_{table}_{'_'.join(columns)}"[:128]
+
+
+def audit_foreign_key_indexes(connection, progress=None, catalog=None):
+    progress = progress or AuditProgress()
+    catalog = catalog or get_schema_catalog(connection)
+    progress.start_check("indices", len(catalog.foreign_keys))
+
+    yield "SUGERENCIAS DE ÍNDICES PARA CLAVES FORÁNEAS:"
+    yield "="*40
+    # Una sugerencia por tabla y conjunto de columnas, aunque varias FKs lo compartan
+    missing = {}
+    for fk in catalog.foreign_keys:
+        if not fk.indexed:
+            missing.setdefault((fk.parent_schema, fk.parent_table, frozenset(fk.parent_columns)), []).append(fk)
+        progress.advance("indices")
+    # Sin índice, cada verificación de huérfanos y cada DELETE o UPDATE de la clave referenciada
+    # recorre la tabla hija completa: primero las tablas con más filas
+    ranked = sorted(
+        missing.values(),
+        key=lambda fks: (-(fks[0].parent_row_count or 0), fks[0].parent_schema, fks[0].parent_table),
+    )
+    for rank, fks in enumerate(ranked, start=1):
+        fk = fks[0]
+        table = f"{fk.parent_schema}.{fk.parent_table}"
+        columns = ", ".join(fk.parent_columns)
+        referenced = ", ".join(sorted({f"{other.referenced_schema}.{other.referenced_table}" for other in fks}))
+        rows = fk.parent_row_count or 0
+        yield AuditRecord(
+            "indices",
+            f"{rank}. {table} ({columns}) -> {referenced}: sin índice. Cada verificación de huérfanos y cada "
+            f"DELETE o UPDATE en {referenced} recorre ~{rows} filas de {table}.",
+            table, columns, "scan_rows", rows, "warning",
+        )
+        statement = (
+            f"CREATE INDEX {quote_identifier(index_name(fk.parent_table, fk.parent_columns))} "
+            f"ON {qualified_name(fk.parent_schema, fk.parent_table)} "
+            f"({', '.join(quote_identifier(column) for column in fk.parent_columns)});"
+        )
+        yield AuditRecord("indices", f"   {statement}", table, columns, "create_index", statement, "warning")
+    if not catalog.foreign_keys:
+        yield "No se encontraron relaciones."
+    elif not ranked:
+        yield "Todas las claves foráneas tienen un índice de apoyo."
+    yield (
+        f"Claves foráneas con índice de apoyo: {sum(1 for fk in catalog.foreign_keys if fk.indexed)} "
+        f"de {len(catalog.foreign_keys)}."
+    )
+
+
+def advise_foreign_key_indexes(connection, progress=None):
+    print("Sugerencia de índices para las claves foráneas.")
+    return write_to_file(
+        "fk_index_advice_log.txt",
+        cached_audit(
+            "indices", connection, None, lambda catalog: audit_foreign_key_indexes(connection, progress, catalog), reuse=False
+        ),
+        progress,
+    )
+
+
+def orphan_condition(fk):
+    # Filas de la tabla hija (alias t) con la FK completa y sin fila referenciada
+    not_null = " AND ".join(
+        f"t.{quote_identifier(column)} IS NOT NULL" for column in fk.parent_columns
+    )
+    join_condition = " AND ".join(
+        f"r.{quote_identifier(referenced)} = t.{quote_identifier(parent)}"
+        for parent, referenced in zip(fk.parent_columns, fk.referenced_columns)
+    )
+    return f"""{not_null}
+    AND NOT EXISTS (
+        SELECT 1
+        FROM {qualified_name(fk.referenced_schema, fk.referenced_table)} AS r
+        WHERE {join_condition}
+    )"""
+
+
+def orphan_count_query(fk, fk_index):
+    return f"""
+    SELECT {fk_index} AS fk_index, COUNT_BIG(*) AS orphaned_rows
+    FROM {qualified_name(fk.parent_schema, fk.parent_table)} AS t
+    WHERE {orphan_condition(fk)}"""
+
+
+def count_orphaned_rows_batch(cursor, foreign_keys, batch):
+    orphan_counts = {}
+    query = "\n    UNION ALL".join(orphan_count_query(foreign_keys[i], i) for i in batch)
+    tables = ", ".join(sorted({f"{foreign_keys[i].parent_schema}.{foreign_keys[i].parent_table}" for i in batch}))
+    try:
+        for row in run_query(cursor, query, check="integridad", table=tables, full_scan=True):
+            orphan_counts[row.fk_index] = row.orphaned_rows
+    except Exception:
+        # Si el lote falla se aísla la FK problemática consultándolas una por una
+        for i in batch:
+            fk = foreign_keys[i]
+            try:
+                orphan_counts[i] = run_query(
+                    cursor,
+                    orphan_count_query(fk, i),
+                    fetch="one",
+                    check="integridad",
+                    table=f"{fk.parent_schema}.{fk.parent_table}",
+                    column=", ".join(fk.parent_columns),
+                    full_scan=True,
+                ).orphaned_rows
+            except Exception as e:
+                orphan_counts[i] = e
+    return orphan_counts
+
+
+def count_orphaned_rows(connection, foreign_keys, pool=None, progress=None, chunk_plans=None):
+    # Resultado por FK: cantidad de filas huérfanas o la excepción que produjo su consulta
+    chunk_plans = chunk_plans or {}
+    parent_name = lambda fk: f"{fk.parent_schema}.{fk.parent_table}"
+    chunked = [i for i, fk in enumerate(foreign_keys) if parent_name(fk) in chunk_plans]
+    # Primero las sondas baratas: FKs con índice en la tabla hija y, dentro de cada grupo, las tablas más
+    # chicas. Así una sonda cara no demora en su lote a las que se resuelven con el índice
+    order = sorted(
+        (i for i, fk in enumerate(foreign_keys) if parent_name(fk) not in chunk_plans),
+        key=lambda i: (not foreign_keys[i].indexed, foreign_keys[i].parent_row_count or 0),
+    )
+    batch_size = FK_CHECKS_PER_BATCH
+    if pool is not None and order:
+        # Lotes más chicos para que todos los workers del pool tengan trabajo
+        batch_size = max(1, min(batch_size, -(-len(order) // pool.max_size)))
+    batches = [order[start : start + batch_size] for start in range(0, len(order), batch_size)]
+    orphan_counts = [None] * len(foreign_keys)
+
+    def count_batch(cursor, batch):
+        batch_counts = count_orphaned_rows_batch(cursor, foreign_keys, batch)
+        if progress is not None:
+            # Cada sonda recorre la tabla hija: se usa su cantidad de filas del catálogo
+            progress.advance(
+                "integridad",
+                len(batch),
+                sum(foreign_keys[i].parent_row_count or 0 for i in batch),
+            )
+        return batch_counts
+
+    for batch_counts in run_parallel(connection, pool, count_batch, batches):
+        for i, orphaned_rows in batch_counts.items():
+            orphan_counts[i] = orphaned_rows
+
+    # Las FKs de tablas grandes se cuentan parte por parte y se suman
+    for i in chunked:
+        fk = foreign_keys[i]
+        plan = chunk_plans[parent_name(fk)]
+        queries = [
+            f"""
+    SELECT COUNT_BIG(*) AS orphaned_rows
+    FROM {qualified_name(fk.parent_schema, fk.parent_table)} AS t
+    WHERE ({predicate})
+    AND {orphan_condition(fk)}"""
+            for predicate in plan.predicates
+        ]
+        try:
+            orphan_counts[i] = sum(row[0] for row in run_chunks(connection, pool, plan, fk.name, queries))
+        except Exception as e:
+            orphan_counts[i] = e
+        if progress is not None:
+            progress.advance("integridad", 1, fk.parent_row_count or 0)
+    for name, plan in chunk_plans.items():
+        if not any(
+            isinstance(orphan_counts[i], Exception) for i in chunked if parent_name(foreign_keys[i]) == name
+        ):
+            plan.finish()
+    return orphan_counts
+
+
+def audit_integrity_anomalies(connection, pool=None, progress=None, settings=None, catalog=None):
+    progress = progress or AuditProgress()
+    settings = settings or {}
+    catalog = catalog or get_schema_catalog(connection)
+
+    # Claves foráneas (agrupadas por constraint) y sus filas huérfanas, calculadas una sola vez
+    foreign_keys = catalog.foreign_keys
+    progress.start_check("integridad", len(foreign_keys))
+    chunk_plans = {}
+    if settings.get("chunked"):
+        parents = {(fk.parent_schema, fk.parent_table) for fk in foreign_keys}
+        chunk_plans = plan_table_chunks(
+            connection, catalog, [table for key, table in catalog.tables.items() if key in parents], "integridad"
+        )
+        if chunk_plans:
+            yield f"Modo por partes: {len(chunk_plans)} tablas recorridas por partes ({', '.join(chunk_plans)})."
+    if settings.get("incremental"):
+        table_watermarks, previous, state_key, warning = load_incremental_state(
+            connection, pool, catalog, "integridad"
+        )
+        if warning:
+            yield AuditRecord("integridad", warning, metric="incremental", severity="warning")
+        # Una FK cambia si cambia la tabla hija o la referenciada
+        watermarks = {}
+        for fk in foreign_keys:
+            parent = table_watermarks.get(f"{fk.parent_schema}.{fk.parent_table}")
+            referenced = table_watermarks.get(f"{fk.referenced_schema}.{fk.referenced_table}")
+            if parent is not None and referenced is not None:
+                watermarks[f"{fk.parent_schema}.{fk.name}"] = f"{parent}/{referenced}"
+        fk_key = lambda fk: f"{fk.parent_schema}.{fk.name}"
+        reused, pending = split_unchanged(foreign_keys, fk_key, watermarks, previous)
+        progress.advance("integridad", len(reused))
+        fresh = dict(zip(map(fk_key, pending), count_orphaned_rows(connection, pending, pool, progress, chunk_plans)))
+        audit_state_store.save(
+            state_key,
+            "integridad",
+            [
+                (key, watermarks[key], orphaned_rows)
+                for key, orphaned_rows in fresh.items()
+                if key in watermarks and not isinstance(orphaned_rows, Exception)
+            ],
+        )
+        orphan_counts = [reused.get(fk_key(fk), fresh.get(fk_key(fk))) for fk in foreign_keys]
+        yield (
+            f"Modo incremental: {len(reused)} claves foráneas sin cambios reutilizadas, "
+            f"{len(pending)} claves foráneas verificadas."
+        )
+    else:
+        orphan_counts = count_orphaned_rows(connection, foreign_keys, pool, progress, chunk_plans)
+
+    sections = [
+        (
+            "insert_anomaly",
+            "Chequeo de anomalías de inserción:",
+            "Anomalía de inserción en la tabla {table}, columna {column}. No existe el valor referenciado en la tabla {referenced_table}.",
+            "No se encontraron anomalías de inserción para {table}.",
+        ),
+        (
+            "delete_anomaly",
+            "Chequeo de anomalías de eliminación:",
+            "Anomalía de eliminación en la tabla {table}, columna {column}. Hay registros huérfanos que refieren a la tabla {referenced_table}.",
+            "No se encontraron anomalías de eliminación para {table}.",
+        ),
+        (
+            "update_anomaly",
+            "Chequeo de anomalías de actualización:",
+            "Anomalía de actualización en la tabla {table}, columna {column}. Posible inconsistencia con la tabla {referenced_table}.",
+            "No se encontraron anomalías de actualización para {table}.",
+        ),
+    ]
+    for metric, header, anomaly_message, clean_message in sections:
+        yield header
+        for fk, orphaned_rows in zip(foreign_keys, orphan_counts):
+            values = {
+                "table": f"{fk.parent_schema}.{fk.parent_table}",
+                "column": ", ".join(fk.parent_columns),
+                "referenced_table": f"{fk.referenced_schema}.{fk.referenced_table}",
+            }
+            if isinstance(orphaned_rows, Exception):
+                message, value, severity = f"Error al verificar la clave foránea {fk.name}: {orphaned_rows}", None, "error"
+            elif orphaned_rows > 0:
+                message, value, severity = anomaly_message.format(**values), orphaned_rows, "warning"
+            else:
+                message, value, severity = clean_message.format(**values), 0, "info"
+            yield AuditRecord("integridad", message, values["table"], values["column"], metric, value, severity)
+
+    if settings.get("row_samples"):
+        samples = []
+        for fk, orphaned_rows in zip(foreign_keys, orphan_counts):
+            table = catalog.tables.get((fk.parent_schema, fk.parent_table))
+            if table is None or isinstance(orphaned_rows, Exception) or not orphaned_rows:
+                continue
+            names = [f"t.{quote_identifier(column)}" for column in fk.parent_columns]
+            samples.append(row_sample(
+                "integridad", catalog, table, fk.parent_columns, "orphaned_rows", text_value(names), orphan_condition(fk)
+            ))
+        yield from audit_row_samples(connection, catalog, pool, "integridad", samples, "integrity_row_samples.jsonl", settings)
+
+
+def check_integrity_anomalies(connection, pool=None, progress=None, settings=None):
+    print("Chequeo automático de anomalías en la integridad referencial.")
+    # Escribir el log de anomalías a un archivo
+    return write_to_file(
+        "integrity_anomalies_log.txt",
+        cached_audit(
+            "integridad",
+            connection,
+            settings,
+            lambda catalog: audit_integrity_anomalies(connection, pool, progress, settings, catalog),
+            reuse=False,
+        ),
+        progress,
+    )
+
+
+def profile_expressions(column, capabilities, quantiles=False):
+    name = quote_identifier(column.name)
+    data_type = column.data_type
+    expressions = []
+    if column.nullable:
+        expressions.append(("non_null_count", f"COUNT_BIG({name})"))
+        if data_type in STRING_TYPES:
+            expressions.append(("empty_count", f"COUNT_BIG(CASE WHEN {name} = '' THEN 1 END)"))
+        if data_type not in UNGROUPABLE_TYPES:
+            if capabilities.get("approx_count_distinct"):
+                expressions.append(("distinct_count", f"APPROX_COUNT_DISTINCT({name})"))
+            else:
+                expressions.append(("distinct_count", f"COUNT_BIG(DISTINCT {name})"))
+    if data_type in NUMERIC_TYPES or data_type in DATETIME_TYPES:
+        expressions.append(("min_value", f"MIN({name})"))
+        expressions.append(("max_value", f"MAX({name})"))
+    if data_type in NUMERIC_TYPES:
+        expressions.append(("mean", f"AVG(CAST({name} AS float))"))
+        expressions.append(("stddev", f"STDEV(CAST({name} AS float))"))
+        if quantiles:
+            expressions.append(("q1", f"APPROX_PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY {name})"))
+            expressions.append(("q3", f"APPROX_PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY {name})"))
+    max_length = column.max_length
+    # -1 indica tipos (max), que no tienen un tamaño máximo declarado
+    if max_length is not None and max_length > 0:
+        if data_type in STRING_TYPES:
+            expressions.append(("max_size", f"MAX(LEN({name}))"))
+        elif data_type in BINARY_TYPES:
+            expressions.append(("max_size", f"MAX(DATALENGTH({name}))"))
+    return expressions
+
+
+def sample_size(total_rows):
+    # Tamaño de muestra para estimar una proporción con el margen configurado
+    margin = app.config["SAMPLING_MARGIN"]
+    required = (1.96 ** 2) * 0.25 / margin ** 2
+    required = required / (1 + (required - 1) / total_rows)
+    return max(
+        int(required * app.config["SAMPLING_DESIGN_EFFECT"]), app.config["SAMPLING_MIN_ROWS"]
+    )
+
+
+def sampling_plan(table, settings):
+    if not settings.get("sampling") or table.row_count < app.config["SAMPLING_THRESHOLD_ROWS"]:
+        return None
+    rows = sample_size(table.row_count)
+    if rows >= table.row_count:
+        return None
+    percent = 100.0 * rows / table.row_count
+    if app.config["SAMPLING_METHOD"] == "hash":
+        # Muestra repetible por filas: evita el sesgo de páginas pero lee toda la tabla
+        return {
+            "rows": rows,
+            "from": "",
+            "predicate": f"ABS(BINARY_CHECKSUM(*) % 1000000) < {int(percent * 10000)}",
+        }
+    return {
+        "rows": rows,
+        "from": f"TABLESAMPLE SYSTEM ({percent:.6f} PERCENT) REPEATABLE ({SAMPLING_SEED})",
+        "predicate": None,
+    }
+
+
+def estimate_count(sample_count, sample_rows, total_rows):
+    # Estimación del total y su margen al 95% a partir de la proporción observada en la muestra
+    if sample_count == 0:
+        # Regla del tres: cota superior cuando la muestra no tiene ningún caso
+        return 0, round(3.0 / sample_rows * total_rows)
+    proportion = sample_count / sample_rows
+    correction = max(0.0, 1 - sample_rows / total_rows)
+    margin = 1.96 * math.sqrt(proportion * (1 - proportion) / sample_rows * correction)
+    return round(proportion * total_rows), round(margin * total_rows)
+
+
+def load_numeric_histograms(cursor):
+    # Histograma de las estadísticas cuya primera columna es numérica: se lee sin recorrer la tabla.
+    # Si una columna tiene varias estadísticas se usa la de menor stats_id
+    query = """
+    SELECT 
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        t.name AS table_name,
+        c.name AS column_name,
+        s.stats_id,
+        CAST(h.range_high_key AS float) AS range_high_key,
+        h.range_rows,
+        h.equal_rows
+    FROM 
+        sys.stats AS s
+    INNER JOIN 
+        sys.stats_columns AS sc ON sc.object_id = s.object_id AND sc.stats_id = s.stats_id AND sc.stats_column_id = 1
+    INNER JOIN 
+        sys.columns AS c ON c.object_id = sc.object_id AND c.column_id = sc.column_id
+    INNER JOIN 
+        sys.tables AS t ON t.object_id = s.object_id
+    CROSS APPLY 
+        sys.dm_db_stats_histogram(s.object_id, s.stats_id) AS h
+    WHERE 
+        t.is_ms_shipped = 0
+        AND TYPE_NAME(c.system_type_id) IN ('int', 'decimal', 'float', 'numeric')
+    ORDER BY 
+        schema_name, table_name, column_name, s.stats_id, h.step_number
+    """
+    histograms = {}
+    stats_ids = {}
+    for row in run_query(cursor, query, check="datos"):
+        key = (row.schema_name, row.table_name, row.column_name)
+        if stats_ids.setdefault(key, row.stats_id) != row.stats_id:
+            continue
+        histograms.setdefault(key, []).append((row.range_high_key, row.range_rows, row.equal_rows))
+    return histograms
+
+
+def histogram_quantile(steps, quantile):
+    # Cada paso tiene range_rows valores entre la clave anterior y la suya, más equal_rows iguales a ella
+    target = quantile * sum(range_rows + equal_rows for _, range_rows, equal_rows in steps)
+    accumulated = 0
+    previous_key = None
+    for key, range_rows, equal_rows in steps:
+        if range_rows and previous_key is not None and accumulated + range_rows >= target:
+            return previous_key + (key - previous_key) * (target - accumulated) / range_rows
+        accumulated += range_rows
+        if accumulated + equal_rows >= target:
+            return key
+        accumulated += equal_rows
+        previous_key = key
+    return steps[-1][0]
+
+
+def histogram_count_outside(steps, low, high):
+    # Filas fuera de [low, high] según el histograma, suponiendo valores uniformes dentro de cada paso
+    count = 0.0
+    previous_key = None
+    for key, range_rows, equal_rows in steps:
+        if key < low or key > high:
+            count += equal_rows
+        if range_rows and previous_key is not None and key > previous_key:
+            outside = max(0.0, min(key, low) - previous_key) + max(0.0, key - max(previous_key, high))
+            count += range_rows * min(1.0, outside / (key - previous_key))
+        previous_key = key
+    return count
+
+
+def set_outlier_bounds(table, profile, histograms):
+    # Límites IQR y z-score de cada columna numérica; los cuartiles salen del histograma si lo hay
+    iqr_factor = app.config["OUTLIER_IQR_FACTOR"]
+    z_score = app.config["OUTLIER_Z_SCORE"]
+    for column in profile["columns"]:
+        if column["data_type"] not in NUMERIC_TYPES or column.get("stddev") is None:
+            continue
+        steps = histograms.get((table.schema, table.name, column["name"]))
+        if steps:
+            column["q1"] = histogram_quantile(steps, 0.25)
+            column["q3"] = histogram_quantile(steps, 0.75)
+        bounds = {}
+        if column.get("q1") is not None and column.get("q3") is not None:
+            iqr = column["q3"] - column["q1"]
+            bounds["iqr_outliers"] = (column["q1"] - iqr_factor * iqr, column["q3"] + iqr_factor * iqr)
+        if column["stddev"] > 0:
+            bounds["zscore_outliers"] = (
+                column["mean"] - z_score * column["stddev"],
+                column["mean"] + z_score * column["stddev"],
+            )
+        else:
+            column["zscore_outliers"] = 0
+        column["outlier_bounds"] = bounds
+
+
+def count_outliers(table, profile, plan, histograms, counts):
+    # counts: conteos de la pasada de outliers del lote, que aplica en el servidor los mismos límites
+    # que se calculan aquí. Las columnas con histograma de estadísticas se estiman sin recorrer la tabla
+    set_outlier_bounds(table, profile, histograms)
+    for index, column in enumerate(profile["columns"]):
+        bounds = column.get("outlier_bounds")
+        if bounds is None:
+            continue
+        steps = histograms.get((table.schema, table.name, column["name"]))
+        if steps:
+            # Estimación sin recorrer la tabla, escalada a las filas no nulas actuales
+            column["outlier_source"] = "histogram"
+            histogram_rows = sum(range_rows + equal_rows for _, range_rows, equal_rows in steps)
+            non_null_rows = profile["row_count"] - column.get("null_count", 0)
+            for metric, (low, high) in bounds.items():
+                outside = histogram_count_outside(steps, low, high)
+                column[metric] = round(outside * non_null_rows / histogram_rows) if histogram_rows else 0
+            continue
+        for metric in bounds:
+            if plan is None:
+                column[metric] = counts[(index, metric)]
+            else:
+                column[metric], column[metric + "_margin"] = estimate_count(
+                    counts[(index, metric)], profile["sample_rows"], table.row_count
+                )
+
+
+def new_profile(table):
+    return {
+        "schema": table.schema,
+        "table": table.name,
+        "row_count": None,
+        "sample_rows": None,
+        "columns": [
+            {
+                "name": column.name,
+                "data_type": column.data_type,
+                "nullable": column.nullable,
+                "max_length": column.max_length,
+            }
+            for column in table.columns
+        ],
+        "error": None,
+    }
+
+
+def finish_profile(table, profile, plan):
+    if plan is None:
+        for column in profile["columns"]:
+            if "non_null_count" in column:
+                column["null_count"] = profile["row_count"] - column["non_null_count"]
+                column["blank_count"] = column["null_count"] + column.get("empty_count", 0)
+        return
+    # Con muestreo los conteos se extrapolan al total de filas del catálogo
+    sample_rows = profile["row_count"]
+    if not sample_rows:
+        raise ValueError("la muestra no devolvió filas")
+    profile["sample_rows"] = sample_rows
+    profile["row_count"] = table.row_count
+    for column in profile["columns"]:
+        column["sampled"] = True
+        if "non_null_count" in column:
+            null_sample = sample_rows - column["non_null_count"]
+            blank_sample = null_sample + column.get("empty_count", 0)
+            column["null_count"], column["null_count_margin"] = estimate_count(
+                null_sample, sample_rows, table.row_count
+            )
+            column["blank_count"], column["blank_count_margin"] = estimate_count(
+                blank_sample, sample_rows, table.row_count
+            )
+
+
+def count_text(column, metric):
+    margin = column.get(metric + "_margin")
+    if margin is None:
+        return str(column[metric])
+    return f"{column[metric]} ± {margin} (estimado)"
+
+
+def parse_candidate_keys(text):
+    # Una clave por línea: "esquema.tabla: columna1, columna2"
+    candidate_keys = []
+    for line in (text or "").splitlines():
+        if not line.strip():
+            continue
+        table_name, _, columns = line.partition(":")
+        columns = [column.strip() for column in columns.split(",") if column.strip()]
+        candidate_keys.append((table_name.strip(), columns))
+    return candidate_keys
+
+
+def duplicate_analysis_targets(catalog, candidate_keys):
+    # Columnas agrupables sin PK ni constraint único propio, más las claves candidatas pedidas
+    unique_columns = {
+        (constraint.schema, constraint.table, constraint.columns[0])
+        for constraint in catalog.unique_constraints
+        if len(constraint.columns) == 1
+    }
+    targets = {}
+    for table in catalog.tables.values():
+        for column in table.columns:
+            if column.data_type in UNGROUPABLE_TYPES:
+                continue
+            if (table.schema, table.name, column.name) in unique_columns:
+                continue
+            targets.setdefault(table.display_name, (table, []))[1].append([column.name])
+
+    tables_by_name = {table.display_name: table for table in catalog.tables.values()}
+    errors = []
+    for table_name, columns in candidate_keys:
+        if "." not in table_name:
+            table_name = f"dbo.{table_name}"
+        table = tables_by_name.get(table_name)
+        known_columns = {column.name for column in table.columns} if table else set()
+        if table is None or not columns or not set(columns) <= known_columns:
+            errors.append(f"Clave candidata inválida: {table_name}({', '.join(columns)})")
+            continue
+        targets.setdefault(table.display_name, (table, []))[1].append(columns)
+    return list(targets.values()), errors
+
+
+def duplicate_summary_query(table, targets, top_values, plan):
+    branches = []
+    for index, columns in enumerate(targets):
+        names = [quote_identifier(column) for column in columns]
+        value = text_value([f"g.{name}" for name in names])
+        conditions = [f"{name} IS NOT NULL" for name in names]
+        if plan and plan["predicate"]:
+            conditions.append(plan["predicate"])
+        # Las funciones de ventana se calculan sobre todos los grupos antes del TOP
+        branches.append(f"""
+    SELECT {index} AS target_index, d.value, d.occurrences, d.duplicate_groups, d.duplicated_rows
+    FROM (
+        SELECT TOP ({top_values})
+            {value} AS value,
+            g.occurrences,
+            COUNT_BIG(*) OVER () AS duplicate_groups,
+            SUM(g.occurrences) OVER () AS duplicated_rows
+        FROM (
+            SELECT {", ".join(names)}, COUNT_BIG(*) AS occurrences
+            FROM {table.qualified_name} {plan["from"] if plan else ""}
+            WHERE {" AND ".join(conditions)}
+            GROUP BY {", ".join(names)}
+            HAVING COUNT_BIG(*) > 1
+        ) AS g
+        ORDER BY g.occurrences DESC
+    ) AS d""")
+    return "\n    UNION ALL".join(branches)
+
+
+class PlannedStatement:
+    __slots__ = ("purpose", "query", "scans")
+
+    def __init__(self, purpose, query, scans=0):
+        self.purpose = purpose
+        self.query = query
+        # Recorridos de la tabla auditada; las sentencias que recorren la tabla llevan el límite de MAXDOP
+        self.scans = scans
+
+
+class TableBatch:
+    # Consultas de auditoría de una tabla que se envían juntas en un solo viaje al servidor
+    __slots__ = ("table", "sampling", "profile", "profile_chunks", "outlier_specs", "duplicate_chunks", "statements")
+
+    def __init__(self, table, sampling, profile):
+        self.table = table
+        self.sampling = sampling
+        self.profile = profile
+        self.profile_chunks = []
+        self.outlier_specs = []
+        self.duplicate_chunks = []
+        self.statements = []
+
+    @property
+    def round_trips(self):
+        return 1 if self.statements else 0
+
+    @property
+    def scans(self):
+        return sum(statement.scans for statement in self.statements)
+
+
+def outlier_expressions(table, chunks, histograms):
+    # Conteos de valores fuera de los límites IQR y z-score, calculados con las métricas del perfilado
+    # guardadas en las tablas temporales #perfilN (alias pN). Las columnas con histograma no necesitan pasada
+    positions = {
+        (index, metric): f"p{number}.m{position}"
+        for number, chunk in enumerate(chunks)
+        for position, (index, metric, _) in enumerate(chunk)
+    }
+    iqr_factor = app.config["OUTLIER_IQR_FACTOR"]
+    z_score = app.config["OUTLIER_Z_SCORE"]
+    specs = []
+    for index, column in enumerate(table.columns):
+        if column.data_type not in NUMERIC_TYPES or (table.schema, table.name, column.name) in histograms:
+            continue
+        name = f"t.{quote_identifier(column.name)}"
+        if (index, "q1") in positions:
+            q1, q3 = positions[(index, "q1")], positions[(index, "q3")]
+            specs.append((
+                index,
+                "iqr_outliers",
+                f"COUNT_BIG(CASE WHEN {name} < {q1} - {iqr_factor!r} * ({q3} - {q1}) "
+                f"OR {name} > {q3} + {iqr_factor!r} * ({q3} - {q1}) THEN 1 END)",
+            ))
+        mean, stddev = positions[(index, "mean")], positions[(index, "stddev")]
+        specs.append((
+            index,
+            "zscore_outliers",
+            f"COUNT_BIG(CASE WHEN {stddev} > 0 AND ({name} < {mean} - {z_score!r} * {stddev} "
+            f"OR {name} > {mean} + {z_score!r} * {stddev}) THEN 1 END)",
+        ))
+    return specs
+
+
+def plan_table_batch(table, capabilities, settings, histograms, profile=True, duplicate_targets=()):
+    # Un lote por tabla: el perfilado agregado (dividido solo en tablas muy anchas), la pasada de
+    # outliers y el análisis de duplicados, leídos después con cursor.nextset()
+    plan = sampling_plan(table, settings)
+    source = f"{table.qualified_name} {plan['from'] if plan else ''}"
+    where = f"WHERE {plan['predicate']}" if plan and plan["predicate"] else ""
+    batch = TableBatch(table, plan, profile)
+
+    if profile:
+        # Los cuartiles se piden al servidor solo si no hay un histograma de estadísticas para la columna
+        specs = [
+            (index, metric, expression)
+            for index, column in enumerate(table.columns)
+            for metric, expression in profile_expressions(
+                column,
+                capabilities,
+                capabilities.get("approx_percentile") and (table.schema, table.name, column.name) not in histograms,
+            )
+        ]
+        batch.profile_chunks = [
+            specs[start : start + PROFILE_EXPRESSIONS_PER_QUERY]
+            for start in range(0, len(specs), PROFILE_EXPRESSIONS_PER_QUERY)
+        ]
+        batch.outlier_specs = outlier_expressions(table, batch.profile_chunks, histograms)
+        for number, chunk in enumerate(batch.profile_chunks):
+            select_list = ["COUNT_BIG(*) AS row_count"] + [
+                f"{expression} AS m{position}" for position, (_, _, expression) in enumerate(chunk)
+            ]
+            if not batch.outlier_specs:
+                batch.statements.append(PlannedStatement("perfil", f"""
+        SELECT 
+            {", ".join(select_list)}
+        FROM 
+            {source}
+        {where}
+        """, scans=1))
+                continue
+            # El perfil queda en una tabla temporal para que la pasada de outliers use sus límites
+            # sin otro viaje al servidor
+            temporary = f"#perfil{number}"
+            batch.statements.append(PlannedStatement(
+                "limpieza", f"IF OBJECT_ID('tempdb..{temporary}') IS NOT NULL DROP TABLE {temporary}"
+            ))
+            batch.statements.append(PlannedStatement("perfil", f"""
+        SELECT 
+            {", ".join(select_list)}
+        INTO 
+            {temporary}
+        FROM 
+            {source}
+        {where}
+        """, scans=1))
+            batch.statements.append(PlannedStatement("perfil", f"SELECT * FROM {temporary}"))
+        if batch.outlier_specs:
+            columns = sorted({index for index, _, _ in batch.outlier_specs})
+            select_list = [
+                f"{expression} AS m{position}" for position, (_, _, expression) in enumerate(batch.outlier_specs)
+            ]
+            batch.statements.append(PlannedStatement("outliers", f"""
+        SELECT 
+            {", ".join(select_list)}
+        FROM 
+            (SELECT {", ".join(quote_identifier(table.columns[index].name) for index in columns)} FROM {source} {where}) AS t
+            {" ".join(f"CROSS JOIN #perfil{number} AS p{number}" for number in range(len(batch.profile_chunks)))}
+        """, scans=1))
+            batch.statements.extend(
+                PlannedStatement("limpieza", f"DROP TABLE #perfil{number}")
+                for number in range(len(batch.profile_chunks))
+            )
+
+    duplicate_targets = list(duplicate_targets)
+    batch.duplicate_chunks = [
+        duplicate_targets[start : start + DUPLICATE_TARGETS_PER_QUERY]
+        for start in range(0, len(duplicate_targets), DUPLICATE_TARGETS_PER_QUERY)
+    ]
+    for chunk in batch.duplicate_chunks:
+        # Cada rama del UNION ALL agrupa una columna o clave candidata: un recorrido por rama
+        batch.statements.append(PlannedStatement(
+            "duplicados",
+            duplicate_summary_query(table, chunk, app.config["DUPLICATE_TOP_VALUES"], plan),
+            scans=len(chunk),
+        ))
+    return batch
+
+
+def explain_batches(batches, histograms_loaded=False, chunk_plans=()):
+    # Costo del chequeo de datos antes de ejecutarlo: viajes al servidor y recorridos de tablas por lote
+    lines = ["PLAN DE CONSULTAS DEL CHEQUEO DE DATOS:"]
+    round_trips = 0
+    scans = 0
+    if histograms_loaded:
+        lines.append("  Histogramas de estadísticas: 1 viaje, sin recorridos de tablas")
+        round_trips += 1
+    for batch in batches:
+        if not batch.round_trips:
+            continue
+        purposes = {}
+        for statement in batch.statements:
+            if statement.scans:
+                purposes[statement.purpose] = purposes.get(statement.purpose, 0) + statement.scans
+        detail = ", ".join(f"{purpose}: {count}" for purpose, count in purposes.items())
+        lines.append(
+            f"  {batch.table.display_name}: {batch.round_trips} viaje, {batch.scans} recorridos ({detail})"
+            f"{' sobre una muestra' if batch.sampling else ''}"
+        )
+        round_trips += batch.round_trips
+        scans += batch.scans
+    for plan in chunk_plans:
+        # Cada parte recorre solo su rango: una consulta de perfil y, si hace falta, otra de outliers
+        parts = len(plan.predicates)
+        lines.append(
+            f"  {plan.table.display_name}: {parts} partes por {plan.method}, "
+            f"{parts} consultas de perfil y hasta {parts} de outliers (1 recorrido)"
+        )
+        round_trips += parts
+        scans += 1
+    lines.append(f"Total: {round_trips} viajes al servidor, {scans} recorridos de tablas.")
+    return lines
+
+
+def run_table_batch(cursor, batch, histograms):
+    result_sets = iter(
+        run_script(cursor, batch.statements, check="datos", table=batch.table.display_name)
+        if batch.statements
+        else []
+    )
+
+    profile = None
+    if batch.profile:
+        profile = new_profile(batch.table)
+        # Sin expresiones de perfil no hay consulta ni muestra: la tabla se informa con las filas del catálogo
+        sampling = batch.sampling if batch.profile_chunks else None
+        if not batch.profile_chunks:
+            profile["row_count"] = batch.table.row_count
+        for chunk in batch.profile_chunks:
+            row = next(result_sets)[0]
+            profile["row_count"] = row[0]
+            for position, (index, metric, _) in enumerate(chunk, start=1):
+                profile["columns"][index][metric] = row[position]
+        counts = {}
+        if batch.outlier_specs:
+            row = next(result_sets)[0]
+            counts = {(index, metric): row[position] for position, (index, metric, _) in enumerate(batch.outlier_specs)}
+        finish_profile(batch.table, profile, sampling)
+        count_outliers(batch.table, profile, sampling, histograms, counts)
+
+    duplicates = [
+        {
+            "columns": columns,
+            "duplicate_groups": 0,
+            "duplicated_rows": 0,
+            "top_values": [],
+            "sampled": batch.sampling is not None,
+        }
+        for chunk in batch.duplicate_chunks
+        for columns in chunk
+    ]
+    start = 0
+    for chunk in batch.duplicate_chunks:
+        for row in next(result_sets):
+            summary = duplicates[start + row.target_index]
+            summary["duplicate_groups"] = row.duplicate_groups
+            summary["duplicated_rows"] = row.duplicated_rows
+            summary["top_values"].append((row.value, row.occurrences))
+        start += len(chunk)
+    return profile, duplicates
+
+
+def merge_moments(sizes, means, stddevs):
+    # Media y desvío estándar muestral del total a partir de los de cada parte (fórmula de Chan)
+    total, mean, squares = 0, 0.0, 0.0
+    for size, chunk_mean, chunk_stddev in zip(sizes, means, stddevs):
+        if not size or chunk_mean is None:
+            continue
+        delta = chunk_mean - mean
+        combined = total + size
+        mean += delta * size / combined
+        squares += (chunk_stddev or 0.0) ** 2 * (size - 1) + delta ** 2 * total * size / combined
+        total = combined
+    if total == 0:
+        return None, None
+    return mean, math.sqrt(squares / (total - 1)) if total > 1 else None
+
+
+def merge_chunk_profiles(table, specs, rows):
+    # rows: [row_count, m0, m1, ...] de cada parte, con las métricas de specs
+    profile = new_profile(table)
+    row_counts = [row[0] for row in rows]
+    profile["row_count"] = sum(row_counts)
+    values = {(index, metric): [row[position] for row in rows] for position, (index, metric, _) in enumerate(specs, start=1)}
+    for (index, metric), chunk_values in values.items():
+        column = profile["columns"][index]
+        present = [value for value in chunk_values if value is not None]
+        if metric in ("non_null_count", "empty_count"):
+            column[metric] = sum(chunk_values)
+        elif metric == "min_value":
+            column[metric] = min(present, default=None)
+        elif metric in ("max_value", "max_size"):
+            column[metric] = max(present, default=None)
+        elif metric == "mean":
+            column["mean"], column["stddev"] = merge_moments(
+                values.get((index, "non_null_count"), row_counts), chunk_values, values[(index, "stddev")]
+            )
+    return profile
+
+
+def profile_table_in_chunks(connection, pool, plan, capabilities, histograms):
+    # Perfil de una tabla grande a partir de los agregados de cada parte. Los conteos, mínimos, máximos,
+    # medias y desvíos se pueden combinar; el conteo de distintos y los percentiles no, así que no se
+    # piden: los cuartiles salen del histograma de estadísticas si existe
+    table = plan.table
+    specs = [
+        (index, metric, expression)
+        for index, column in enumerate(table.columns)
+        for metric, expression in profile_expressions(column, capabilities)
+        if metric != "distinct_count"
+    ]
+    groups = [
+        specs[start : start + PROFILE_EXPRESSIONS_PER_QUERY]
+        for start in range(0, len(specs), PROFILE_EXPRESSIONS_PER_QUERY)
+    ] or [[]]
+    queries = [
+        f"""
+    SELECT 
+        {", ".join(["COUNT_BIG(*) AS row_count"] + [f"{expression} AS m{position}" for position, (_, _, expression) in enumerate(group)])}
+    FROM 
+        {table.qualified_name} AS t
+    WHERE 
+        {predicate}
+    """
+        for group in groups
+        for predicate in plan.predicates
+    ]
+    results = run_chunks(connection, pool, plan, "perfil", queries)
+    parts = len(plan.predicates)
+    rows = [
+        [results[part][0]] + [value for number in range(len(groups)) for value in results[number * parts + part][1:]]
+        for part in range(parts)
+    ]
+    profile = merge_chunk_profiles(table, specs, rows)
+    finish_profile(table, profile, None)
+
+    # Segunda pasada con los límites del total ya calculados, como literales
+    set_outlier_bounds(table, profile, histograms)
+    outlier_specs = [
+        (
+            index,
+            metric,
+            f"COUNT_BIG(CASE WHEN t.{quote_identifier(column['name'])} < {low!r} "
+            f"OR t.{quote_identifier(column['name'])} > {high!r} THEN 1 END)",
+        )
+        for index, column in enumerate(profile["columns"])
+        if (table.schema, table.name, column["name"]) not in histograms
+        for metric, (low, high) in column.get("outlier_bounds", {}).items()
+    ]
+    counts = {}
+    if outlier_specs:
+        select_list = [f"{expression} AS m{position}" for position, (_, _, expression) in enumerate(outlier_specs)]
+        queries = [
+            f"""
+    SELECT 
+        {", ".join(select_list)}
+    FROM 
+        {table.qualified_name} AS t
+    WHERE 
+        {predicate}
+    """
+            for predicate in plan.predicates
+        ]
+        results = run_chunks(connection, pool, plan, "outliers", queries)
+        counts = {
+            (index, metric): sum(row[position] for row in results)
+            for position, (index, metric, _) in enumerate(outlier_specs)
+        }
+    count_outliers(table, profile, None, histograms, counts)
+    plan.finish()
+    return profile
 
 
-def write_to_file(filename, data):
-    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    with open(filepath, "w") as file:
-        for entry in data:
-            file.write(entry + "\n")
-    print(f"Datos guardados exitosamente en '{filename}'.")
-    return filepath
+def failed_profile(table, error):
+    return {"schema": table.schema, "table": table.name, "row_count": None, "sample_rows": None, "columns": [], "error": error}
 
 
-def identify_relations(connection):
-    print("Identificación automática de las relaciones.")
-    cursor = connection.cursor()
+class ProfilePlan:
+    # Lotes del chequeo de datos armados antes de ejecutarlos, para escribir el plan de consultas primero
+    __slots__ = ("tables", "capabilities", "histograms", "targets", "batches", "chunk_plans")
 
-    query = """
-    SELECT 
-        fk.name AS foreign_key_name,
-        tp.name AS parent_table,
-        cp.name AS parent_column,
-        tr.name AS referenced_table,
-        cr.name AS referenced_column
-    FROM 
-        sys.foreign_keys AS fk
-    INNER JOIN 
-        sys.tables AS tp ON fk.parent_object_id = tp.object_id
-    INNER JOIN 
-        sys.tables AS tr ON fk.referenced_object_id = tr.object_id
-    INNER JOIN 
-        sys.foreign_key_columns AS fkc ON fkc.constraint_object_id = fk.object_id
-    INNER JOIN 
-        sys.columns AS cp ON fkc.parent_column_id = cp.column_id AND fkc.parent_object_id = cp.object_id
-    INNER JOIN 
-        sys.columns AS cr ON fkc.referenced_column_id = cr.column_id AND fkc.referenced_object_id = cr.object_id
-    """
+    def __init__(self, tables, capabilities, histograms, targets, batches, chunk_plans):
+        self.tables = tables
+        self.capabilities = capabilities
+        self.histograms = histograms
+        self.targets = targets
+        self.batches = batches
+        self.chunk_plans = chunk_plans
 
-    cursor.execute(query)
-    rows = cursor.fetchall()
+    def explain(self):
+        return explain_batches(self.batches, bool(self.histograms), self.chunk_plans.values())
 
-    log_entries = []
-    if rows:
-        log_entries = [
-            f"Foreign Key: {row.foreign_key_name} - Table: {row.parent_table}({row.parent_column}) -> {row.referenced_table}({row.referenced_column})"
-            for row in rows
-        ]
-        filepath = write_to_file("relations_log.txt", log_entries)
-    else:
-        log_entries.append("No se encontraron relaciones.")
-        filepath = write_to_file("relations_log.txt", log_entries)
 
-    return log_entries, filepath
+def plan_profiles(connection, tables, capabilities, settings=None, duplicate_targets=(), chunk_plans=None):
+    settings = settings or {}
+    histograms = {}
+    if capabilities.get("stats_histogram") and any(
+        column.data_type in NUMERIC_TYPES for table in tables for column in table.columns
+    ):
+        try:
+            histograms = load_numeric_histograms(connection.cursor())
+        except Exception as e:
+            # Sin acceso a las estadísticas los cuartiles se calculan en la pasada de perfilado
+            print("No se pudieron leer los histogramas de estadísticas:", e)
 
+    # Las tablas que no hay que perfilar (sin cambios en modo incremental) solo llevan sus duplicados, y
+    # las que se recorren por partes se perfilan después, parte por parte
+    chunk_plans = chunk_plans or {}
+    targets = {table.display_name: (table, table_targets) for table, table_targets in duplicate_targets}
+    profiled = {table.display_name for table in tables}
+    batches = [
+        plan_table_batch(
+            table,
+            capabilities,
+            settings,
+            histograms,
+            profile=table.display_name not in chunk_plans,
+            duplicate_targets=targets.get(table.display_name, (table, []))[1],
+        )
+        for table in tables
+    ] + [
+        plan_table_batch(table, capabilities, settings, histograms, profile=False, duplicate_targets=table_targets)
+        for name, (table, table_targets) in targets.items()
+        if name not in profiled
+    ]
+    return ProfilePlan(tables, capabilities, histograms, targets, batches, chunk_plans)
 
-def check_integrity_anomalies(connection):
-    print("Chequeo automático de anomalías en la integridad referencial.")
-    cursor = connection.cursor()
 
-    anomalies_log = []
+def profile_tables(connection, plan, pool=None, progress=None):
+    # Devuelve los perfiles de plan.tables y, para cada tabla con duplicados a analizar, (tabla, resúmenes, error)
+    def run(cursor, batch):
+        try:
+            profile, duplicates = run_table_batch(cursor, batch, plan.histograms)
+            error = None
+        except Exception as e:
+            profile = failed_profile(batch.table, e)
+            duplicates, error = [], e
+        if progress is not None and batch.profile:
+            progress.advance("datos", rows=profile["sample_rows"] or profile["row_count"])
+        return profile, duplicates, error
 
-    # Consulta para obtener las claves foráneas
-    foreign_keys_query = """
-    SELECT 
-        fk.name AS FK_Name,
-        tp.name AS TableName,
-        cp.name AS ColumnName,
-        tr.name AS ReferencedTableName,
-        cr.name AS ReferencedColumnName
-    FROM 
-        sys.foreign_keys AS fk
-    INNER JOIN 
-        sys.foreign_key_columns AS fkc ON fk.object_id = fkc.constraint_object_id
-    INNER JOIN 
-        sys.tables AS tp ON fkc.parent_object_id = tp.object_id
-    INNER JOIN 
-        sys.columns AS cp ON fkc.parent_object_id = cp.object_id AND fkc.parent_column_id = cp.column_id
-    INNER JOIN 
-        sys.tables AS tr ON fkc.referenced_object_id = tr.object_id
-    INNER JOIN 
-        sys.columns AS cr ON fkc.referenced_object_id = cr.object_id AND fkc.referenced_column_id = cr.column_id;
-    """
+    results = dict(
+        zip((batch.table.display_name for batch in plan.batches), run_parallel(connection, pool, run, plan.batches))
+    )
+    # Las partes de cada tabla usan todas las conexiones del pool, una tabla por vez
+    for name, chunk_plan in plan.chunk_plans.items():
+        try:
+            profile = profile_table_in_chunks(connection, pool, chunk_plan, plan.capabilities, plan.histograms)
+        except Exception as e:
+            profile = failed_profile(chunk_plan.table, e)
+        if progress is not None:
+            progress.advance("datos", rows=profile["row_count"])
+        results[name] = (profile, *results[name][1:])
+    profiles = [results[table.display_name][0] for table in plan.tables]
+    duplicates = [(table, *results[name][1:]) for name, (table, _) in plan.targets.items()]
+    return profiles, duplicates
+
+
+def audit_duplicates(duplicates, errors):
+    for error in errors:
+        yield AuditRecord("datos", error, metric="candidate_key", severity="error")
 
-    cursor.execute(foreign_keys_query)
-    foreign_keys = cursor.fetchall()
-
-    # Chequeo de anomalías de inserción
-    anomalies_log.append("Chequeo de anomalías de inserción:")
-    for fk in foreign_keys:
-        insert_check_query = f"""
-        SELECT COUNT(*) AS OrphanedRows
-        FROM {fk.TableName} t
-        LEFT JOIN {fk.ReferencedTableName} r ON t.{fk.ColumnName} = r.{fk.ReferencedColumnName}
-        WHERE r.{fk.ReferencedColumnName} IS NULL;
-        """
-        cursor.execute(insert_check_query)
-        result = cursor.fetchone()
-        if result.OrphanedRows > 0:
-            anomalies_log.append(
-                f"Anomalía de inserción en la tabla {fk.TableName}, columna {fk.ColumnName}. No existe el valor referenciado en la tabla {fk.ReferencedTableName}."
+    found_duplicates = False
+    for table, summaries, error in duplicates:
+        if error is not None:
+            yield AuditRecord(
+                "datos", f"Error al analizar duplicados en {table.display_name}: {error}",
+                table.display_name, metric="duplicate_groups", severity="error",
             )
-        else:
-            anomalies_log.append(
-                f"No se encontraron anomalías de inserción para {fk.TableName}."
-            )
-
-    # Chequeo de anomalías de eliminación
-    anomalies_log.append("Chequeo de anomalías de eliminación:")
-    for fk in foreign_keys:
-        delete_check_query = f"""
-        SELECT COUNT(*) AS OrphanedRows
-        FROM {fk.TableName} t
-        WHERE t.{fk.ColumnName} IS NOT NULL
-        AND NOT EXISTS (
-            SELECT 1
-            FROM {fk.ReferencedTableName} r
-            WHERE r.{fk.ReferencedColumnName} = t.{fk.ColumnName}
-        );
-        """
-        cursor.execute(delete_check_query)
-        result = cursor.fetchone()
-        if result.OrphanedRows > 0:
-            anomalies_log.append(
-                f"Anomalía de eliminación en la tabla {fk.TableName}, columna {fk.ColumnName}. Hay registros huérfanos que refieren a la tabla {fk.ReferencedTableName}."
+            continue
+        for summary in summaries:
+            columns = ", ".join(summary["columns"])
+            if not summary["duplicate_groups"]:
+                continue
+            found_duplicates = True
+            top_values = ", ".join(f"'{value}' ({count})" for value, count in summary["top_values"])
+            yield AuditRecord(
+                "datos",
+                f"{table.display_name}: {columns} - Grupos duplicados: {summary['duplicate_groups']}, "
+                f"filas duplicadas: {summary['duplicated_rows']}{' en la muestra' if summary['sampled'] else ''}. "
+                f"Más repetidos: {top_values}",
+                table.display_name, columns, "duplicate_groups", summary["duplicate_groups"], "warning",
             )
-        else:
-            anomalies_log.append(
-                f"No se encontraron anomalías de eliminación para {fk.TableName}."
-            )
-
-    # Chequeo de anomalías de actualización
-    anomalies_log.append("Chequeo de anomalías de actualización:")
-    for fk in foreign_keys:
-        update_check_query = f"""
-        SELECT COUNT(*) AS OrphanedRows
-        FROM {fk.TableName} t
-        LEFT JOIN {fk.ReferencedTableName} r ON t.{fk.ColumnName} = r.{fk.ReferencedColumnName}
-        WHERE t.{fk.ColumnName} IS NOT NULL AND r.{fk.ReferencedColumnName} IS NULL;
-        """
-        cursor.execute(update_check_query)
-        result = cursor.fetchone()
-        if result.OrphanedRows > 0:
-            anomalies_log.append(
-                f"Anomalía de actualización en la tabla {fk.TableName}, columna {fk.ColumnName}. Posible inconsistencia con la tabla {fk.ReferencedTableName}."
+            yield AuditRecord(
+                "datos", None, table.display_name, columns, "duplicated_rows", summary["duplicated_rows"], "warning"
             )
-        else:
-            anomalies_log.append(
-                f"No se encontraron anomalías de actualización para {fk.TableName}."
+            yield AuditRecord(
+                "datos", None, table.display_name, columns, "top_values", summary["top_values"], "warning"
             )
+    if not found_duplicates:
+        yield "No se encontraron duplicados."
 
-    # Escribir el log de anomalías a un archivo
-    filepath = write_to_file("integrity_anomalies_log.txt", anomalies_log)
-    return anomalies_log, filepath
 
+def plan_data_chunks(connection, catalog, tables, settings):
+    # Las tablas muestreadas ya leen pocas filas: solo se dividen las que se recorren completas
+    if not settings.get("chunked"):
+        return {}
+    return plan_table_chunks(
+        connection, catalog, [table for table in tables if sampling_plan(table, settings) is None], "datos"
+    )
 
-def check_data_anomalies(connection):
-    print("Chequeo automático de las anomalías de los datos.")
-    cursor = connection.cursor()
-    
-    data_anomalies_log = []
-        
-    # Chequeo de valores nulos
+
+def audit_data_anomalies(connection, pool=None, progress=None, settings=None, catalog=None):
+    progress = progress or AuditProgress()
+    settings = settings or {}
+
+    # Perfilado, outliers y duplicados de cada tabla en un solo lote por tabla
+    duplicate_targets, key_errors = [], []
     try:
-        query = """
-        SELECT 
-            table_name, column_name
-        FROM 
-            information_schema.columns
-        WHERE 
-            is_nullable = 'YES'
-        """
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE NULLS:")
-        data_anomalies_log.append("="*40)
-        if rows:
-            found_nulls = False
-            for row in rows:
-                table_name = row.table_name
-                column_name = row.column_name
-                check_query = f"""
-                SELECT 
-                    '{table_name}' AS table_name, 
-                    '{column_name}' AS column_name, 
-                    COUNT(*) AS null_count
-                FROM 
-                    {table_name}
-                WHERE 
-                    {column_name} IS NULL
-                """
-                cursor.execute(check_query)
-                result = cursor.fetchone()
-                if result and result.null_count > 0:
-                    data_anomalies_log.append(f"{table_name}: {column_name} - Datos nulos: {result.null_count}")
-                    found_nulls = True
-            if not found_nulls:
-                data_anomalies_log.append("No se encontraron valores nulos.")
+        catalog = catalog or get_schema_catalog(connection)
+        tables = [table for table in catalog.tables.values() if table.columns]
+        progress.start_check("datos", len(tables))
+        if settings.get("duplicate_analysis"):
+            duplicate_targets, key_errors = duplicate_analysis_targets(
+                catalog, parse_candidate_keys(settings.get("candidate_keys"))
+            )
+        if settings.get("incremental"):
+            # Los perfiles por muestreo, los exactos y los de las tablas recorridas por partes (sin valores distintos
+            # ni cuartiles por consulta) se guardan por separado
+            check_name = "datos_muestreo" if settings.get("sampling") else "datos"
+            if settings.get("chunked"):
+                check_name += "_partes"
+            watermarks, previous, state_key, warning = load_incremental_state(connection, pool, catalog, check_name)
+            if warning:
+                yield AuditRecord("datos", warning, metric="incremental", severity="warning")
+            table_key = lambda table: table.display_name
+            reused, pending = split_unchanged(tables, table_key, watermarks, previous)
+            progress.advance("datos", len(reused))
+            chunk_plans = plan_data_chunks(connection, catalog, pending, settings)
+            plan = plan_profiles(connection, pending, catalog.capabilities, settings, duplicate_targets, chunk_plans)
+            yield from plan.explain()
+            fresh, duplicates = profile_tables(connection, plan, pool, progress)
+            audit_state_store.save(
+                state_key,
+                check_name,
+                [
+                    (table_key(table), watermarks[table_key(table)], profile)
+                    for table, profile in zip(pending, fresh)
+                    if profile["error"] is None and table_key(table) in watermarks
+                ],
+            )
+            fresh = dict(zip(map(table_key, pending), fresh))
+            profiles = [reused.get(table_key(table)) or fresh[table_key(table)] for table in tables]
+            yield (
+                f"Modo incremental: {len(reused)} tablas sin cambios reutilizadas, "
+                f"{len(pending)} tablas auditadas."
+            )
         else:
-            data_anomalies_log.append("No se encontraron columnas que permitan valores nulos.")
+            chunk_plans = plan_data_chunks(connection, catalog, tables, settings)
+            plan = plan_profiles(connection, tables, catalog.capabilities, settings, duplicate_targets, chunk_plans)
+            yield from plan.explain()
+            profiles, duplicates = profile_tables(connection, plan, pool, progress)
+        if chunk_plans:
+            yield (
+                f"Modo por partes: {len(chunk_plans)} tablas recorridas por partes ({', '.join(chunk_plans)}). "
+                "En ellas no se cuentan valores duplicados por columna; para eso use el análisis de duplicados."
+            )
     except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de nulls: {e}")
+        yield AuditRecord("datos", f"Error al perfilar las tablas: {e}", metric="error", value=str(e), severity="error")
+        catalog = SchemaCatalog(None, None)
+        profiles = []
+        duplicates = []
+
+    for profile in profiles:
+        if profile["error"] is not None:
+            yield AuditRecord(
+                "datos",
+                f"Error al perfilar la tabla {profile['schema']}.{profile['table']}: {profile['error']}",
+                f"{profile['schema']}.{profile['table']}",
+                metric="error",
+                value=str(profile["error"]),
+                severity="error",
+            )
+    profiled = [profile for profile in profiles if profile["error"] is None]
+    if settings.get("sampling"):
+        sampled = sum(1 for profile in profiled if profile["sample_rows"] is not None)
+        yield (
+            f"Modo muestreo: {sampled} tablas estimadas a partir de una muestra, "
+            f"{len(profiled) - sampled} tablas recorridas completas."
+        )
+
+    def profiled_columns(predicate):
+        for profile in profiled:
+            table_name = f"{profile['schema']}.{profile['table']}"
+            for column in profile["columns"]:
+                if predicate(column):
+                    yield table_name, column
+
+    # Chequeo de valores nulos
+    yield "CHEQUEO DE ANOMALÍAS DE NULLS:"
+    yield "="*40
+    nullable_columns = list(profiled_columns(lambda column: "null_count" in column))
+    if nullable_columns:
+        found_nulls = False
+        for table_name, column in nullable_columns:
+            if column["null_count"] > 0:
+                yield AuditRecord(
+                    "datos", f"{table_name}: {column['name']} - Datos nulos: {count_text(column, 'null_count')}",
+                    table_name, column["name"], "null_count", column["null_count"], "warning",
+                )
+                found_nulls = True
+        if not found_nulls:
+            yield "No se encontraron valores nulos."
+    else:
+        yield "No se encontraron columnas que permitan valores nulos."
 
     # Chequeo de duplicados
-    try:
-        query = """
-        SELECT 
-            table_name, column_name
-        FROM 
-            information_schema.columns
-        WHERE 
-            is_nullable = 'YES'
-        """
-        cursor.execute(query)
-        columns = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE DUPLICADOS:")
-        data_anomalies_log.append("="*40)
-        for column in columns:
-            table_name = column.table_name
-            column_name = column.column_name
-            check_query = f"""
-            SELECT 
-                '{table_name}' AS table_name, 
-                '{column_name}' AS column_name, 
-                COUNT(*) AS duplicate_count
-            FROM 
-                {table_name}
-            GROUP BY 
-                {column_name}
-            HAVING 
-                COUNT(*) > 1
-            """
-            cursor.execute(check_query)
-            rows = cursor.fetchall()
-            if rows:
-                for row in rows:
-                    data_anomalies_log.append(f"{table_name}: {column_name} - Duplicado: {row.duplicate_count}")
-            else:
-                data_anomalies_log.append(f"No se encontraron duplicados en {table_name}.{column_name}.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de duplicados: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE DUPLICADOS:"
+    yield "="*40
+    if settings.get("duplicate_analysis"):
+        yield from audit_duplicates(duplicates, key_errors)
+    for table_name, column in profiled_columns(
+        lambda column: "distinct_count" in column and not settings.get("duplicate_analysis")
+    ):
+        duplicate_count = column["non_null_count"] - column["distinct_count"]
+        estimated = catalog.capabilities.get("approx_count_distinct")
+        if estimated and duplicate_count <= column["non_null_count"] * APPROX_DISTINCT_ERROR:
+            # Dentro del margen de error del conteo aproximado: puede no haber ningún duplicado
+            duplicate_count = 0
+        if duplicate_count > 0 and column.get("sampled"):
+            message = f"{table_name}: {column['name']} - Valores duplicados en la muestra: {duplicate_count}"
+        elif duplicate_count > 0 and estimated:
+            message = (
+                f"{table_name}: {column['name']} - Valores duplicados (estimados, ±{APPROX_DISTINCT_ERROR:.0%} "
+                f"de {column['non_null_count']} valores): {duplicate_count}"
+            )
+        elif duplicate_count > 0:
+            message = f"{table_name}: {column['name']} - Valores duplicados: {duplicate_count}"
+        elif estimated:
+            message = (
+                f"No se encontraron duplicados en {table_name}.{column['name']} "
+                f"por encima del margen de error de la estimación ({APPROX_DISTINCT_ERROR:.0%})."
+            )
+        else:
+            message = f"No se encontraron duplicados en {table_name}.{column['name']}."
+        yield AuditRecord(
+            "datos", message, table_name, column["name"], "duplicate_count", duplicate_count,
+            "warning" if duplicate_count > 0 else "info",
+        )
 
     # Chequeo de outliers
-    try:
-        query = """
-        SELECT 
-            table_name, column_name
-        FROM 
-            information_schema.columns
-        WHERE 
-            data_type IN ('int', 'decimal', 'float', 'numeric')
-        """
-        cursor.execute(query)
-        numeric_columns = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE OUTLIERS:")
-        data_anomalies_log.append("="*40)
-        for column in numeric_columns:
-            table_name = column.table_name
-            column_name = column.column_name
-            check_query = f"""
-            SELECT 
-                '{table_name}' AS table_name, 
-                '{column_name}' AS column_name, 
-                MAX({column_name}) AS max_value, 
-                MIN({column_name}) AS min_value
-            FROM 
-                {table_name}
-            """
-            cursor.execute(check_query)
-            result = cursor.fetchone()
-            if result:
-                data_anomalies_log.append(f"{table_name}: {column_name} - Max: {result.max_value}, Min: {result.min_value}")
-            else:
-                data_anomalies_log.append(f"No se encontraron valores para {table_name}.{column_name}.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de outliers: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE OUTLIERS:"
+    yield "="*40
+    outlier_labels = {
+        "iqr_outliers": "Fuera del rango intercuartil",
+        "zscore_outliers": f"Con |z| > {app.config['OUTLIER_Z_SCORE']}",
+    }
+    for table_name, column in profiled_columns(lambda column: column["data_type"] in NUMERIC_TYPES):
+        if column["max_value"] is None:
+            yield AuditRecord(
+                "datos", f"No se encontraron valores para {table_name}.{column['name']}.",
+                table_name, column["name"], "max_value", None,
+            )
+            continue
+        statistics = [f"Max: {column['max_value']}", f"Min: {column['min_value']}"]
+        for metric, label in (("mean", "Media"), ("stddev", "Desv. estándar"), ("q1", "Q1"), ("q3", "Q3")):
+            if column.get(metric) is not None:
+                statistics.append(f"{label}: {column[metric]:.6g}")
+        message = f"{table_name}: {column['name']} - {', '.join(statistics)}{' (muestra)' if column.get('sampled') else ''}"
+        # Los perfiles guardados antes de calcular outliers solo tienen máximo y mínimo
+        counts = [metric for metric in outlier_labels if column.get(metric) is not None]
+        if counts:
+            message += " - " + ", ".join(f"{outlier_labels[metric]}: {count_text(column, metric)}" for metric in counts)
+            if column.get("outlier_source") == "histogram":
+                message += " (estimado con el histograma de estadísticas)"
+            outliers = max(column[metric] for metric in counts)
+            yield AuditRecord(
+                "datos", message, table_name, column["name"], counts[0], column[counts[0]],
+                "warning" if outliers > 0 else "info",
+            )
+            details = counts[1:] + ["max_value", "min_value"]
+        else:
+            yield AuditRecord("datos", message, table_name, column["name"], "max_value", column["max_value"])
+            details = ["min_value"]
+        for metric in details + ["mean", "stddev", "q1", "q3"]:
+            if column.get(metric) is not None:
+                yield AuditRecord("datos", None, table_name, column["name"], metric, column[metric])
 
     # Chequeo de registros huérfanos
-    try:
-        query = """
-        SELECT 
-            fk.name AS foreign_key_name,
-            tp.name AS parent_table,
-            cp.name AS parent_column,
-            tr.name AS referenced_table,
-            cr.name AS referenced_column
-        FROM 
-            sys.foreign_keys AS fk
-        INNER JOIN 
-            sys.tables AS tp ON fk.parent_object_id = tp.object_id
-        INNER JOIN 
-            sys.tables AS tr ON fk.referenced_object_id = tr.object_id
-        INNER JOIN 
-            sys.foreign_key_columns AS fkc ON fkc.constraint_object_id = fk.object_id
-        INNER JOIN 
-            sys.columns AS cp ON fkc.parent_column_id = cp.column_id AND fkc.parent_object_id = cp.object_id
-        INNER JOIN 
-            sys.columns AS cr ON fkc.referenced_column_id = cr.column_id AND fkc.referenced_object_id = cr.object_id
-        """
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE REGISTROS HUÉRFANOS:")
-        data_anomalies_log.append("="*40)
-        if rows:
-            for row in rows:
-                data_anomalies_log.append(f"{row.foreign_key_name} - Table: {row.parent_table}({row.parent_column}) -> {row.referenced_table}({row.referenced_column})")
-        else:
-            data_anomalies_log.append("No se encontraron registros huérfanos.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de orphaned_records: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE REGISTROS HUÉRFANOS:"
+    yield "="*40
+    if catalog.foreign_keys:
+        for fk in catalog.foreign_keys:
+            yield relation_record(fk, "datos", prefix="")
+    else:
+        yield "No se encontraron registros huérfanos."
 
     # Chequeo de constraints únicos
-    try:
-        query = """
-        SELECT 
-            tc.table_name, 
-            tc.constraint_name, 
-            kcu.column_name
-        FROM 
-            information_schema.table_constraints AS tc
-        INNER JOIN 
-            information_schema.key_column_usage AS kcu
-        ON 
-            tc.constraint_name = kcu.constraint_name
-        WHERE 
-            tc.constraint_type = 'UNIQUE'
-        """
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE CONSTRAINTS ÚNICOS:")
-        data_anomalies_log.append("="*40)
-        if rows:
-            for row in rows:
-                data_anomalies_log.append(f"{row.table_name}: {row.column_name} - Constraint único: {row.constraint_name}")
-        else:
-            data_anomalies_log.append("No se encontraron constraints únicos.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de unique_constraints: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE CONSTRAINTS ÚNICOS:"
+    yield "="*40
+    unique_constraints = [constraint for constraint in catalog.unique_constraints if not constraint.primary_key]
+    if unique_constraints:
+        for constraint in unique_constraints:
+            yield AuditRecord(
+                "datos", f"{constraint.table}: {', '.join(constraint.columns)} - Constraint único: {constraint.name}",
+                f"{constraint.schema}.{constraint.table}", ", ".join(constraint.columns), "unique_constraint", constraint.name,
+            )
+    else:
+        yield "No se encontraron constraints únicos."
 
     # Chequeo de validez de fecha y hora
-    try:
-        query = """
-        SELECT 
-            table_name, column_name
-        FROM 
-            information_schema.columns
-        WHERE 
-            data_type IN ('datetime', 'date', 'time')
-        """
-        cursor.execute(query)
-        datetime_columns = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE VALIDEZ DE FECHA Y HORA:")
-        data_anomalies_log.append("="*40)
-        for column in datetime_columns:
-            table_name = column.table_name
-            column_name = column.column_name
-            check_query = f"""
-            SELECT 
-                '{table_name}' AS table_name, 
-                '{column_name}' AS column_name, 
-                MIN({column_name}) AS min_date, 
-                MAX({column_name}) AS max_date
-            FROM 
-                {table_name}
-            """
-            cursor.execute(check_query)
-            result = cursor.fetchone()
-            if result:
-                data_anomalies_log.append(f"{table_name}: {column_name} - Min: {result.min_date}, Max: {result.max_date}")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de date_time_validity: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE VALIDEZ DE FECHA Y HORA:"
+    yield "="*40
+    for table_name, column in profiled_columns(lambda column: column["data_type"] in DATETIME_TYPES):
+        yield AuditRecord(
+            "datos",
+            f"{table_name}: {column['name']} - Min: {column['min_value']}, Max: {column['max_value']}{' (muestra)' if column.get('sampled') else ''}",
+            table_name, column["name"], "min_value", column["min_value"],
+        )
+        yield AuditRecord("datos", None, table_name, column["name"], "max_value", column["max_value"])
 
     # Chequeo de tamaño de datos
-    try:
-        query = """
-        SELECT 
-            table_name, column_name, character_maximum_length
-        FROM 
-            information_schema.columns
-        WHERE 
-            character_maximum_length IS NOT NULL
-        """
-        cursor.execute(query)
-        size_columns = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE TAMAÑO DE DATOS:")
-        data_anomalies_log.append("="*40)
-        found_size_anomalies = False
-        for column in size_columns:
-            table_name = column.table_name
-            column_name = column.column_name
-            max_length = column.character_maximum_length
-            check_query = f"""
-            SELECT 
-                '{table_name}' AS table_name, 
-                '{column_name}' AS column_name, 
-                MAX(LEN({column_name})) AS max_size
-            FROM 
-                {table_name}
-            """
-            cursor.execute(check_query)
-            result = cursor.fetchone()
-            if result and result.max_size > max_length:
-                data_anomalies_log.append(f"{table_name}: {column_name} - Tamaño de datos excede el máximo permitido de {max_length}")
-                found_size_anomalies = True
-        if not found_size_anomalies:
-            data_anomalies_log.append("No se encontraron anomalías de tamaño de datos.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de data_size: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE TAMAÑO DE DATOS:"
+    yield "="*40
+    found_size_anomalies = False
+    for table_name, column in profiled_columns(lambda column: "max_size" in column):
+        if column["max_size"] is not None and column["max_size"] > column["max_length"]:
+            yield AuditRecord(
+                "datos", f"{table_name}: {column['name']} - Tamaño de datos excede el máximo permitido de {column['max_length']}",
+                table_name, column["name"], "max_size", column["max_size"], "warning",
+            )
+            found_size_anomalies = True
+    if not found_size_anomalies:
+        yield "No se encontraron anomalías de tamaño de datos."
 
     # Chequeo de datos en blanco
-    try:
-        query = """
-        SELECT 
-            table_name, column_name
-        FROM 
-            information_schema.columns
-        WHERE 
-            is_nullable = 'YES'
-        """
-        cursor.execute(query)
-        columns = cursor.fetchall()
-        data_anomalies_log.append("CHEQUEO DE ANOMALÍAS DE DATOS EN BLANCO:")
-        data_anomalies_log.append("="*40)
-        found_blank_data = False
-        for column in columns:
-            table_name = column.table_name
-            column_name = column.column_name
-            check_query = f"""
-            SELECT 
-                '{table_name}' AS table_name, 
-                '{column_name}' AS column_name, 
-                COUNT(*) AS blank_count
-            FROM 
-                {table_name}
-            WHERE 
-                {column_name} IS NULL OR {column_name} = ''
-            """
-            cursor.execute(check_query)
-            result = cursor.fetchone()
-            if result and result.blank_count > 0:
-                data_anomalies_log.append(f"{table_name}: {column_name} - Datos en blanco: {result.blank_count}")
-                found_blank_data = True
-        if not found_blank_data:
-            data_anomalies_log.append("No se encontraron datos en blanco.")
-    except Exception as e:
-        data_anomalies_log.append(f"Error al ejecutar el chequeo de blank_data: {e}")
+    yield "CHEQUEO DE ANOMALÍAS DE DATOS EN BLANCO:"
+    yield "="*40
+    found_blank_data = False
+    for table_name, column in profiled_columns(lambda column: "null_count" in column):
+        if column["blank_count"] > 0:
+            yield AuditRecord(
+                "datos", f"{table_name}: {column['name']} - Datos en blanco: {count_text(column, 'blank_count')}",
+                table_name, column["name"], "blank_count", column["blank_count"], "warning",
+            )
+            found_blank_data = True
+    if not found_blank_data:
+        yield "No se encontraron datos en blanco."
 
-    # Guardar y retornar resultados
-    filepath = write_to_file('data_anomalies_log.txt', data_anomalies_log)
-    return data_anomalies_log, filepath
+    if settings.get("row_samples"):
+        samples = []
+        for profile in profiled:
+            table = catalog.tables.get((profile["schema"], profile["table"]))
+            if table is None:
+                continue
+            for column in profile["columns"]:
+                name = f"t.{quote_identifier(column['name'])}"
+                if column.get("max_size") is not None and column["max_size"] > column["max_length"]:
+                    size = "DATALENGTH" if column["data_type"] in BINARY_TYPES else "LEN"
+                    samples.append(row_sample(
+                        "datos", catalog, table, [column["name"]], "max_size",
+                        f"{size}({name})", f"{size}({name}) > {column['max_length']}",
+                    ))
+                if column.get("blank_count"):
+                    condition = f"{name} IS NULL"
+                    if column["data_type"] in STRING_TYPES:
+                        condition += f" OR {name} = ''"
+                    samples.append(row_sample(
+                        "datos", catalog, table, [column["name"]], "blank_count", text_value([name]), condition
+                    ))
+        yield from audit_row_samples(connection, catalog, pool, "datos", samples, "data_row_samples.jsonl", settings)
 
-def generate_custom_log(connection):
-    print("Generación de log personalizado para cada caso.")
-    cursor = connection.cursor()
 
-    log_entries = []
+
+def check_data_anomalies(connection, pool=None, progress=None, settings=None):
+    print("Chequeo automático de las anomalías de los datos.")
+    # Guardar y retornar resultados
+    return write_to_file(
+        "data_anomalies_log.txt",
+        cached_audit(
+            "datos",
+            connection,
+            settings,
+            lambda catalog: audit_data_anomalies(connection, pool, progress, settings, catalog),
+            reuse=False,
+        ),
+        progress,
+    )
+
+def audit_custom_log(connection, pool=None, progress=None, settings=None):
+    progress = progress or AuditProgress()
 
     # Añadir encabezado y marca de tiempo
-    log_entries.append("==== LOG PERSONALIZADO DE AUDITORÍA ====")
-    log_entries.append(f"Fecha y Hora: {datetime.datetime.now()}")
-    log_entries.append("======================================\n")
+    yield "==== LOG PERSONALIZADO DE AUDITORÍA ===="
+    yield f"Fecha y Hora: {datetime.datetime.now()}"
+    yield "======================================\n"
 
-    # Identificación de relaciones de integridad referencial
-    log_entries.append("=== Relaciones de Integridad Referencial ===")
-    try:
-        query = """
-        SELECT 
-            fk.name AS foreign_key_name,
-            tp.name AS parent_table,
-            cp.name AS parent_column,
-            tr.name AS referenced_table,
-            cr.name AS referenced_column
-        FROM 
-            sys.foreign_keys AS fk
-        INNER JOIN 
-            sys.tables AS tp ON fk.parent_object_id = tp.object_id
-        INNER JOIN 
-            sys.tables AS tr ON fk.referenced_object_id = tr.object_id
-        INNER JOIN 
-            sys.foreign_key_columns AS fkc ON fkc.constraint_object_id = fk.object_id
-        INNER JOIN 
-            sys.columns AS cp ON fkc.parent_column_id = cp.column_id AND fkc.parent_object_id = cp.object_id
-        INNER JOIN 
-            sys.columns AS cr ON fkc.referenced_column_id = cr.column_id AND fkc.referenced_object_id = cr.object_id
-        """
+    # Los resultados se toman de la caché si el chequeo se ejecutó hace poco con el mismo esquema
+    records = []
 
-        cursor.execute(query)
-        rows = cursor.fetchall()
+    def collected(entries):
+        for entry in entries:
+            if isinstance(entry, AuditRecord):
+                records.append(entry)
+            yield entry
 
-        if rows:
-            for row in rows:
-                log_entry = f"Foreign Key: {row.foreign_key_name} - Table: {row.parent_table}({row.parent_column}) -> {row.referenced_table}({row.referenced_column})"
-                log_entries.append(log_entry)
-        else:
-            log_entries.append("No se encontraron relaciones.")
+    # Identificación de relaciones de integridad referencial
+    yield "=== Relaciones de Integridad Referencial ==="
+    try:
+        yield from collected(
+            cached_audit("relaciones", connection, None, lambda catalog: audit_relations(connection, progress, catalog))
+        )
     except Exception as e:
-        log_entries.append(f"Error en identificación de relaciones: {e}")
-    log_entries.append("\n")
+        yield AuditRecord("relaciones", f"Error en identificación de relaciones: {e}", metric="error", value=str(e), severity="error")
+    yield "\n"
 
     # Chequeo de anomalías de integridad
-    log_entries.append("=== Anomalías de Integridad ===")
+    yield "=== Anomalías de Integridad ==="
     try:
-        queries = {
-            "inserts": """
-            -- Insert anomaly check (example)
-            SELECT * FROM information_schema.referential_constraints
-            """,
-            "deletes": """
-            -- Delete anomaly check (example)
-            SELECT * FROM information_schema.referential_constraints
-            """,
-            "updates": """
-            -- Update anomaly check (example)
-            SELECT * FROM information_schema.referential_constraints
-            """,
-        }
-
-        for action, query in queries.items():
-            log_entries.append(f"\nChequeo de anomalías para {action}:")
-            cursor.execute(query)
-            rows = cursor.fetchall()
-
-            if rows:
-                for row in rows:
-                    log_entries.append(str(row))
-            else:
-                log_entries.append(f"No se encontraron anomalías para {action}.")
+        yield from collected(
+            cached_audit(
+                "integridad",
+                connection,
+                settings,
+                lambda catalog: audit_integrity_anomalies(connection, pool, progress, settings, catalog),
+            )
+        )
     except Exception as e:
-        log_entries.append(f"Error en chequeo de anomalías de integridad: {e}")
-    log_entries.append("\n")
+        yield AuditRecord("integridad", f"Error en chequeo de anomalías de integridad: {e}", metric="error", value=str(e), severity="error")
+    yield "\n"
 
     # Chequeo de anomalías de los datos
-    log_entries.append("=== Anomalías de los Datos ===")
+    yield "=== Anomalías de los Datos ==="
     try:
-        # Incluye aquí tu lógica de chequeo de anomalías de datos
-        # Usando las funciones ya definidas como ejemplo
-        # Chequeo de valores nulos, duplicados, etc.
-        data_anomalies_log, _ = check_data_anomalies(connection)
-        log_entries.extend(data_anomalies_log)
+        yield from collected(
+            cached_audit(
+                "datos",
+                connection,
+                settings,
+                lambda catalog: audit_data_anomalies(connection, pool, progress, settings, catalog),
+            )
+        )
     except Exception as e:
-        log_entries.append(f"Error en chequeo de anomalías de datos: {e}")
-    log_entries.append("\n")
+        yield AuditRecord("datos", f"Error en chequeo de anomalías de datos: {e}", metric="error", value=str(e), severity="error")
+    yield "\n"
 
     # Resumen Estadístico
-    log_entries.append("=== Resumen Estadístico ===")
-    log_entries.append("Total de relaciones identificadas: ...")
-    log_entries.append("Total de anomalías de integridad: ...")
-    log_entries.append("Total de anomalías de datos: ...")
+    relations = sum(1 for record in records if record.check == "relaciones" and record.metric == "foreign_key")
+    # Las secciones de inserción, eliminación y actualización repiten el mismo conteo por FK
+    orphaned = [
+        record for record in records
+        if record.check == "integridad" and record.metric == "insert_anomaly" and record.severity == "warning"
+    ]
+    data_anomalies = sum(
+        1 for record in records
+        if record.check == "datos" and record.severity == "warning" and record.message is not None
+    )
+    errors = sum(1 for record in records if record.severity == "error")
+    yield "=== Resumen Estadístico ==="
+    yield f"Total de relaciones identificadas: {relations}"
+    yield (
+        f"Total de anomalías de integridad: {len(orphaned)} claves foráneas con "
+        f"{sum(record.value for record in orphaned)} filas huérfanas"
+    )
+    yield f"Total de anomalías de datos: {data_anomalies}"
+    if errors:
+        yield f"Errores durante la auditoría: {errors}"
+
 
+
+def generate_custom_log(connection, pool=None, progress=None, settings=None):
+    print("Generación de log personalizado para cada caso.")
     # Guardar en el archivo
-    filepath = write_to_file("custom_log.txt", log_entries)
-    return log_entries, filepath
+    return write_to_file(
+        "custom_log.txt", audit_custom_log(connection, pool, progress, settings), progress
+    )
+
+
+def concat_expression(expressions):
+    # CONCAT recibe entre 2 y 254 argumentos
+    if len(expressions) == 1:
+        return f"CONCAT({expressions[0]}, N'')"
+    if len(expressions) > 254:
+        return concat_expression([concat_expression(expressions[start : start + 254]) for start in range(0, len(expressions), 254)])
+    return f"CONCAT({', '.join(expressions)})"
+
+
+def row_hash_expression(columns):
+    # SHA-256 de la fila: cada valor como texto precedido de su largo, para que "ab"+"c" no sea "a"+"bc",
+    # y NULL distinto de cualquier texto
+    parts = []
+    for column in columns:
+        name = f"t.{quote_identifier(column.name)}"
+        style = HASH_CONVERT_STYLES.get(column.data_type)
+        converted = f"CONVERT(nvarchar(max), {name}{f', {style}' if style is not None else ''})"
+        parts.append(f"CASE WHEN {name} IS NULL THEN N'~' ELSE CONCAT(DATALENGTH({converted}), N':', {converted}) END")
+    return f"HASHBYTES('SHA2_256', {concat_expression(parts)})"
+
+
+def range_predicate(key, low, high):
+    # Rango [low, high) de la clave; None deja el extremo abierto
+    conditions = []
+    if low is not None:
+        conditions.append(f"{key} >= {sql_literal(low)}")
+    if high is not None:
+        conditions.append(f"{key} < {sql_literal(high)}")
+    return " AND ".join(conditions) or "1 = 1"
+
+
+def split_range(low, high, lowest, highest):
+    # Divide [low, high) en COMPARE_FANOUT rangos; los extremos abiertos se acotan con la menor y la mayor
+    # clave de las dos bases. Devuelve un solo rango si ya no se puede dividir
+    start = lowest if low is None else low
+    end = highest if high is None else high
+    boundaries = sorted({
+        boundary
+        for boundary in (chunk_boundary(start, end, number, COMPARE_FANOUT) for number in range(1, COMPARE_FANOUT))
+        if boundary > start and (high is None or boundary < high)
+    })
+    edges = [low] + boundaries + [high]
+    return list(zip(edges, edges[1:]))
+
+
+def range_text(column_name, low, high):
+    if low is None and high is None:
+        return "toda la tabla"
+    if low is None:
+        return f"{column_name} < {high}"
+    if high is None:
+        return f"{column_name} >= {low}"
+    return f"{low} <= {column_name} < {high}"
+
+
+def fingerprint_ranges(cursor, table, columns, key, ranges, side):
+    # Por rango: filas, CHECKSUM_AGG de los primeros 4 bytes del hash de cada fila y suma de los 4
+    # siguientes. Las filas no salen del servidor: vuelve una fila por rango
+    row_hash = row_hash_expression(columns)
+    fingerprints = {}
+    for start in range(0, len(ranges), COMPARE_RANGES_PER_QUERY):
+        predicates = [range_predicate(key, low, high) for low, high in ranges[start : start + COMPARE_RANGES_PER_QUERY]]
+        cases = " ".join(f"WHEN {predicate} THEN {start + number}" for number, predicate in enumerate(predicates))
+        query = f"""
+    SELECT 
+        x.range_index,
+        COUNT_BIG(*) AS row_count,
+        CHECKSUM_AGG(CAST(SUBSTRING(x.row_hash, 1, 4) AS int)) AS xor_hash,
+        SUM(CAST(CAST(SUBSTRING(x.row_hash, 5, 4) AS int) AS bigint)) AS sum_hash
+    FROM (
+        SELECT CASE {cases} END AS range_index, {row_hash} AS row_hash
+        FROM {table.qualified_name} AS t
+        WHERE {" OR ".join(f"({predicate})" for predicate in predicates)}
+    ) AS x
+    GROUP BY 
+        x.range_index
+    """
+        for row in run_query(cursor, query, check="comparacion", table=table.display_name, column=side, full_scan=True):
+            fingerprints[row.range_index] = (row.row_count, row.xor_hash, row.sum_hash)
+    return [fingerprints.get(number, (0, None, None)) for number in range(len(ranges))]
+
+
+def fetch_row_hashes(cursor, table, columns, key_columns, key, ranges, side):
+    query = f"""
+    SELECT 
+        {text_value([f"t.{quote_identifier(column)}" for column in key_columns])} AS row_key,
+        {row_hash_expression(columns)} AS row_hash
+    FROM 
+        {table.qualified_name} AS t
+    WHERE 
+        {" OR ".join(f"({range_predicate(key, low, high)})" for low, high in ranges)}
+    """
+    return {
+        row.row_key: row.row_hash
+        for row in run_query(cursor, query, check="comparacion", table=table.display_name, column=side, full_scan=True)
+    }
+
+
+COMPARE_SIDES = ("origen", "destino")
+
+
+def on_both_sides(executor, sides, task):
+    # sides: (cursor, throttle) del origen y del destino; task(cursor, lado) corre en los dos a la vez y
+    # cada lado espera según la carga de su propio servidor
+    def run(side, cursor, throttle):
+        if throttle is not None:
+            current_throttle.set(throttle)
+        return task(cursor, side)
+
+    futures = [
+        executor.submit(contextvars.copy_context().run, run, side, cursor, throttle)
+        for side, (cursor, throttle) in zip(COMPARE_SIDES, sides)
+    ]
+    return [future.result() for future in futures]
+
+
+def compare_table(executor, sides, table, columns, key_columns, key_column):
+    # Compara las huellas de toda la tabla y, mientras difieran, las de rangos cada vez más chicos de la
+    # primera columna de la PK. Devuelve (filas por lado, claves distintas, filas traídas, rangos sin ubicar
+    # con sus filas en cada lado)
+    key = f"t.{quote_identifier(key_column.name)}" if key_column is not None else None
+    lowest = highest = None
+    if key is not None:
+        bounds = on_both_sides(executor, sides, lambda cursor, side: run_query(
+            cursor,
+            f"SELECT MIN({key}) AS low, MAX({key}) AS high FROM {table.qualified_name} AS t",
+            fetch="one", check="comparacion", table=table.display_name, column=side,
+        ))
+        lows = [row.low for row in bounds if row is not None and row.low is not None]
+        highs = [row.high for row in bounds if row is not None and row.high is not None]
+        lowest, highest = min(lows, default=None), max(highs, default=None)
+
+    row_counts = None
+    mismatches = []
+    transferred = 0
+    unresolved = []
+    ranges = [(None, None)]
+    while ranges:
+        source, target = on_both_sides(
+            executor, sides, lambda cursor, side: fingerprint_ranges(cursor, table, columns, key, ranges, side)
+        )
+        transferred += 2 * len(ranges)
+        if row_counts is None:
+            row_counts = (source[0][0], target[0][0])
+        different = [
+            (current, source_print[0], target_print[0])
+            for current, source_print, target_print in zip(ranges, source, target)
+            if source_print != target_print
+        ]
+        if key is None or lowest is None:
+            unresolved = different
+            break
+        leaves = []
+        ranges = []
+        for current, source_count, target_count in different:
+            if max(source_count, target_count) <= app.config["COMPARE_ROW_LIMIT"]:
+                leaves.append(current)
+                continue
+            parts = split_range(*current, lowest, highest)
+            if len(parts) > 1:
+                ranges.extend(parts)
+            else:
+                # Un solo valor de la primera columna de una PK compuesta con más filas que el límite: no se
+                # traen todas sus filas, el rango se informa con sus conteos
+                unresolved.append((current, source_count, target_count))
+        if leaves:
+            source_rows, target_rows = on_both_sides(
+                executor,
+                sides,
+                lambda cursor, side: fetch_row_hashes(cursor, table, columns, key_columns, key, leaves, side),
+            )
+            transferred += len(source_rows) + len(target_rows)
+            for row_key in set(source_rows) | set(target_rows):
+                if row_key not in target_rows:
+                    mismatches.append((row_key, "solo existe en el origen"))
+                elif row_key not in source_rows:
+                    mismatches.append((row_key, "solo existe en el destino"))
+                elif source_rows[row_key] != target_rows[row_key]:
+                    mismatches.append((row_key, "tiene valores distintos"))
+    # Las claves llegan como texto: se ordenan por largo y valor para que 11 quede antes que 2501
+    mismatches.sort(key=lambda mismatch: (len(mismatch[0]), mismatch[0]))
+    return row_counts, mismatches, transferred, unresolved
+
+
+def audit_database_comparison(connection, pool=None, progress=None, settings=None, catalog=None):
+    progress = progress or AuditProgress()
+    settings = settings or {}
+    registered = connection_manager.get(*settings["compare_with"]) if settings.get("compare_with") else None
+    if registered is None:
+        raise ValueError("No hay una base de destino conectada para comparar.")
+    other_pool = audit_pool(registered, "6")
+    catalog = catalog or get_schema_catalog(connection)
+    throttle = current_throttle.get()
+
+    with connection_manager.using(registered), other_pool.connection() as other_connection, ThreadPoolExecutor(max_workers=2) as executor:
+        # Dentro del bloque, current_throttle es el del servidor (o la réplica) de la base de destino
+        sides = ((connection.cursor(), throttle), (other_connection.cursor(), current_throttle.get()))
+        other_catalog = get_schema_catalog(other_connection)
+        origin_tables = {table.display_name: table for table in catalog.tables.values()}
+        target_tables = {table.display_name: table for table in other_catalog.tables.values()}
+        common = sorted(set(origin_tables) & set(target_tables))
+        progress.start_check("comparacion", len(common))
+
+        yield f"COMPARACIÓN DE {'/'.join(catalog.key)} (origen) CON {'/'.join(other_catalog.key)} (destino):"
+        yield "="*40
+        for name in sorted(set(origin_tables) ^ set(target_tables)):
+            side, missing = ("origen", "destino") if name in origin_tables else ("destino", "origen")
+            yield AuditRecord(
+                "comparacion", f"{name}: solo existe en el {side}.", name, metric="missing_table", value=missing, severity="warning"
+            )
+
+        identical = 0
+        total_rows = 0
+        total_transferred = 0
+        for name in common:
+            table, other_table = origin_tables[name], target_tables[name]
+            other_columns = {column.name: column.data_type for column in other_table.columns}
+            # Se comparan las columnas con el mismo nombre y tipo en las dos bases
+            columns = [
+                column
+                for column in table.columns
+                if other_columns.get(column.name) == column.data_type and column.data_type not in UNGROUPABLE_TYPES
+            ]
+            skipped = sorted(
+                ({column.name for column in table.columns} | set(other_columns)) - {column.name for column in columns}
+            )
+            if skipped:
+                yield AuditRecord(
+                    "comparacion",
+                    f"{name}: columnas que no se comparan (faltan en una base, cambian de tipo o no se pueden comparar): {', '.join(skipped)}",
+                    name, ", ".join(skipped), "column_mismatch", skipped, "warning",
+                )
+            if not columns:
+                progress.advance("comparacion")
+                continue
+            key_columns = next(
+                (
+                    constraint.columns
+                    for constraint in catalog.unique_constraints
+                    if constraint.primary_key and (constraint.schema, constraint.table) == (table.schema, table.name)
+                ),
+                [],
+            )
+            compared = {column.name: column for column in columns}
+            if not all(column in compared for column in key_columns):
+                key_columns = []
+            key_column = compared[key_columns[0]] if key_columns else None
+            if key_column is not None and key_column.data_type not in CHUNK_KEY_TYPES:
+                key_column = None
+
+            try:
+                row_counts, mismatches, transferred, unresolved = compare_table(
+                    executor, sides, table, columns, key_columns, key_column
+                )
+            except Exception as e:
+                yield AuditRecord(
+                    "comparacion", f"Error al comparar {name}: {e}", name, metric="error", value=str(e), severity="error"
+                )
+                progress.advance("comparacion")
+                continue
+            total_rows += max(row_counts)
+            total_transferred += transferred
+            progress.advance("comparacion", rows=sum(row_counts))
+            if not mismatches and not unresolved:
+                identical += 1
+                yield AuditRecord("comparacion", f"{name}: idéntica ({row_counts[0]} filas).", name, metric="fingerprint", value=row_counts[0])
+                continue
+            if unresolved and key_column is None:
+                yield AuditRecord(
+                    "comparacion",
+                    f"{name}: difiere ({row_counts[0]} filas en el origen, {row_counts[1]} en el destino). Sin una PK "
+                    "numérica o de fecha no se pueden ubicar las filas distintas.",
+                    name, metric="fingerprint", value=list(row_counts), severity="warning",
+                )
+                continue
+            yield AuditRecord(
+                "comparacion",
+                f"{name}: {len(mismatches)} filas distintas{f', {len(unresolved)} rangos sin ubicar' if unresolved else ''} "
+                f"({row_counts[0]} filas en el origen, {row_counts[1]} en el destino).",
+                name, ", ".join(key_columns), "mismatched_rows", len(mismatches), "warning",
+            )
+            for row_key, difference in mismatches[: app.config["COMPARE_MAX_KEYS"]]:
+                yield AuditRecord(
+                    "comparacion", f"   {', '.join(key_columns)} = {row_key}: {difference}.",
+                    name, ", ".join(key_columns), "row_mismatch", row_key, "warning",
+                )
+            if len(mismatches) > app.config["COMPARE_MAX_KEYS"]:
+                yield f"   ... y {len(mismatches) - app.config['COMPARE_MAX_KEYS']} filas más."
+            for (low, high), source_count, target_count in unresolved:
+                yield AuditRecord(
+                    "comparacion",
+                    f"   {range_text(key_column.name, low, high)}: difiere ({source_count} filas en el origen, "
+                    f"{target_count} en el destino). El rango supera COMPARE_ROW_LIMIT y {key_column.name} no "
+                    "permite dividirlo, así que no se traen sus filas.",
+                    name, key_column.name, "unresolved_range", [low, high], "warning",
+                )
+
+        yield (
+            f"Tablas comparadas: {len(common)}, idénticas: {identical}, con diferencias: {len(common) - identical}. "
+            f"Filas traídas de las dos bases para ubicar las diferencias: {total_transferred} (de {total_rows} filas)."
+        )
+
+
+def compare_databases(connection, pool=None, progress=None, settings=None):
+    print("Comparación de datos con la base de destino.")
+    return write_to_file(
+        "database_comparison_log.txt",
+        cached_audit(
+            "comparacion",
+            connection,
+            settings,
+            lambda catalog: audit_database_comparison(connection, pool, progress, settings, catalog),
+            reuse=False,
+        ),
+        progress,
+    )
+
+
+def run_audit(option, connection, pool=None, progress=None, settings=None, folder=None):
+    # Cada trabajo escribe en su propia carpeta para que dos corridas de la misma opción no pisen sus logs
+    folder_token = current_output_folder.set(folder)
+    try:
+        return run_audit_option(option, connection, pool, progress, settings)
+    finally:
+        current_output_folder.reset(folder_token)
+
+
+def run_audit_option(option, connection, pool, progress, settings):
+    if option == "1":
+        return identify_relations(connection, progress)
+    elif option == "2":
+        return check_integrity_anomalies(connection, pool, progress, settings)
+    elif option == "3":
+        return check_data_anomalies(connection, pool, progress, settings)
+    elif option == "4":
+        return generate_custom_log(connection, pool, progress, settings)
+    elif option == "5":
+        return advise_foreign_key_indexes(connection, progress)
+    elif option == "6":
+        return compare_databases(connection, pool, progress, settings)
+    raise ValueError(f"Opción de auditoría desconocida: {option}")
+
+
+JOB_STATUS_LABELS = {
+    "pending": "En cola",
+    "running": "En ejecución",
+    "finished": "Finalizado",
+    "failed": "Error",
+}
+
+
+class AuditJob:
+    def __init__(self, option, settings=None, pool=None):
+        self.id = uuid.uuid4().hex
+        self.option = option
+        self.pool = pool
+        self.settings = settings or {}
+        self.status = "pending"
+        self.progress = AuditProgress()
+        self.profiler = QueryProfiler(app.config["PROFILE_STATISTICS_IO"])
+        self.profile_filepath = None
+        self.filepath = None
+        self.output_folder = os.path.join(app.config["UPLOAD_FOLDER"], self.id)
+        self.error = None
+        self.submitted_at = datetime.datetime.now()
+        self.finished_at = None
+
+    def run(self, registered):
+        self.status = "running"
+        self.progress.started = time.monotonic()
+        pool = audit_pool(registered, self.option)
+        profiler_token = current_profiler.set(self.profiler)
+        try:
+            # Conexión propia del trabajo, fuera de los lugares del pool que usan los chequeos en paralelo
+            with pool.dedicated_connection() as connection:
+                self.filepath = run_audit(
+                    self.option, connection, pool, self.progress, self.settings, self.output_folder
+                )
+            self.status = "finished"
+        except Exception as e:
+            print("Error al ejecutar la auditoría:", e)
+            self.error = str(e)
+            self.status = "failed"
+        finally:
+            current_profiler.reset(profiler_token)
+            self.progress.finish()
+            self.finished_at = datetime.datetime.now()
+            audit_metrics.add("audit_jobs_finished_total", (("option", self.option), ("status", self.status)))
+            audit_metrics.observe(
+                "audit_job_duration_seconds",
+                (("option", self.option),),
+                self.progress.finished - self.progress.started,
+                CHECK_DURATION_BUCKETS,
+            )
+            self.write_profile()
+            connection_manager.release(registered)
+
+    def write_profile(self):
+        # Perfil de consultas de la corrida en JSON, para comparar entre auditorías
+        profile = self.profiler.to_dict()
+        profile.update({
+            "job_id": self.id,
+            "option": self.option,
+            "settings": self.settings,
+            "status": self.status,
+            "submitted_at": self.submitted_at.isoformat(),
+            "finished_at": self.finished_at.isoformat(),
+            "elapsed_seconds": self.progress.snapshot()["elapsed_seconds"],
+        })
+        try:
+            os.makedirs(self.output_folder, exist_ok=True)
+            filepath = os.path.join(self.output_folder, f"profile_{self.id}.json")
+            with open(filepath, "w", encoding="utf-8") as file:
+                json.dump(profile, file, ensure_ascii=False, indent=2, default=str)
+            self.profile_filepath = filepath
+        except Exception as e:
+            print("Error al guardar el perfil de consultas:", e)
+
+    @property
+    def running(self):
+        return self.status in ("pending", "running")
+
+    def log_pages(self):
+        # Mientras el trabajo corre solo se ven las páginas que ya llegaron al disco
+        if self.progress.output is None:
+            return []
+        return self.progress.output.pages()
+
+    def to_dict(self):
+        status = {
+            "id": self.id,
+            "option": self.option,
+            "settings": self.settings,
+            "status": self.status,
+            "submitted_at": self.submitted_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "filepath": self.filepath,
+            "profile_filepath": self.profile_filepath,
+            "error": self.error,
+        }
+        status.update(self.progress.snapshot())
+        return status
+
+
+audit_jobs = {}
+audit_jobs_lock = threading.Lock()
+audit_executor = ThreadPoolExecutor(
+    max_workers=app.config["AUDIT_MAX_JOBS"], thread_name_prefix="audit-job"
+)
+
+
+def submit_audit_job(option, pool, settings=None):
+    job = AuditJob(option, settings, pool)
+    with audit_jobs_lock:
+        # Una opción corre una sola vez por base: dos corridas a la vez se pisarían el estado incremental y las
+        # partes guardadas
+        for other in audit_jobs.values():
+            if other.running and other.option == option and other.pool is pool:
+                return None
+        # Se descartan los trabajos terminados más antiguos
+        finished = [job_id for job_id, old_job in audit_jobs.items() if not old_job.running]
+        for job_id in finished[: max(0, len(finished) - app.config["AUDIT_KEEP_FINISHED_JOBS"] + 1)]:
+            del audit_jobs[job_id]
+        audit_jobs[job.id] = job
+    # El pool no se cierra aunque la sesión se reconecte mientras el trabajo espera o corre
+    connection_manager.retain(pool)
+    audit_executor.submit(job.run, pool)
+    return job
 
 
 @app.route("/")
@@ -597,9 +4128,15 @@ def connect():
     database = request.form["database"]
     username = request.form["username"]
     password = request.form["password"]
+    replicas = [replica.strip() for replica in request.form.get("replicas", "").split(",") if replica.strip()]
 
-    global connection
-    connection = connect_to_database(server, database, username, password)
+    try:
+        connect_to_database(server, database, username, password, replicas, "read_only" in request.form)
+    except Exception as e:
+        flash(f"Error al conectar a la base de datos: {e}", "error")
+        return redirect(url_for("index"))
+    # Cada sesión recuerda su base; el pool con las conexiones vive en connection_manager
+    session["connection"] = [server, database, username]
     flash("Conexión exitosa a la base de datos.", "success")
     return redirect(url_for("index"))
 
@@ -608,31 +4145,322 @@ def connect():
 def audit():
     option = request.form["option"]
 
-    if option == "1":
-        results, filepath = identify_relations(connection)
-    elif option == "2":
-        results, filepath = check_integrity_anomalies(connection)
-    elif option == "3":
-        results, filepath = check_data_anomalies(connection)
-    elif option == "4":
-        results, filepath = generate_custom_log(connection)
+    connection_pool = connection_manager.get(*session["connection"]) if "connection" in session else None
+    if connection_pool is None:
+        flash("Primero debe conectarse a la base de datos.", "error")
+        return redirect(url_for("index"))
 
-    session["results"] = results
-    session["filepath"] = filepath
+    settings = {
+        "sampling": "sampling" in request.form,
+        "incremental": "incremental" in request.form,
+        "duplicate_analysis": "duplicate_analysis" in request.form,
+        "candidate_keys": request.form.get("candidate_keys", ""),
+        "chunked": "chunked" in request.form,
+        "row_samples": "row_samples" in request.form,
+        "quarantine": "quarantine" in request.form,
+    }
+    if option == "6":
+        # La base de destino tiene su propio pool en connection_manager, como la de origen
+        target = [request.form.get(f"compare_{key}", "") for key in ("server", "database", "username")]
+        try:
+            connect_to_database(*target, request.form.get("compare_password", ""))
+        except Exception as e:
+            flash(f"Error al conectar a la base de destino: {e}", "error")
+            return redirect(url_for("index"))
+        settings["compare_with"] = tuple(target)
+    job = submit_audit_job(option, connection_pool, settings)
+    if job is None:
+        flash("Ya hay una auditoría de esa opción en curso para esta base; espere a que termine.", "error")
+        return redirect(url_for("results"))
+    session["job_id"] = job.id
     return redirect(url_for("results"))
 
 
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = audit_jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
 @app.route("/results")
 def results():
-    results = session.get("results", [])
-    filepath = session.get("filepath", "")
-    return render_template("results.html", results=results, filepath=filepath)
+    job = audit_jobs.get(request.args.get("job", session.get("job_id")))
+    if job is None:
+        return render_template("results.html", results=[], job=None)
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    pages = job.log_pages()
+    results = []
+    filename = None
+    records_filename = None
+    if job.progress.output is not None:
+        filename = os.path.basename(job.progress.output.filepath)
+        records_filename = os.path.basename(job.progress.output.records_filepath)
+        if page <= len(pages):
+            results = read_log_page(job.progress.output.filepath, pages[page - 1])
+    return render_template(
+        "results.html",
+        results=results,
+        filename=filename,
+        records_filename=records_filename,
+        page=page,
+        page_count=len(pages),
+        job=job.to_dict(),
+        running=job.running,
+        throttled_seconds=job.profiler.to_dict()["throttled_seconds"],
+        slowest_checks=job.profiler.by_check()[: app.config["PROFILE_SLOWEST_QUERIES"]],
+        slowest_queries=job.profiler.slowest(app.config["PROFILE_SLOWEST_QUERIES"]),
+        profile_filename=os.path.basename(job.profile_filepath) if job.profile_filepath else None,
+        status_labels=JOB_STATUS_LABELS,
+    )
+
+
+@app.route("/metrics")
+def metrics():
+    with audit_jobs_lock:
+        statuses = [job.status for job in audit_jobs.values()]
+    gauges = [("audit_jobs", (("status", status),), statuses.count(status)) for status in ("pending", "running")]
+    for (server, database, _), pool in connection_manager.pools():
+        for node in pool.all_nodes() if isinstance(pool, ReplicaPool) else [pool]:
+            in_use, idle = node.stats()
+            labels = (("server", server), ("database", database), ("node", connection_server(node.connection_string)))
+            gauges.append(("audit_pool_connections", labels + (("state", "in_use"),), in_use))
+            gauges.append(("audit_pool_connections", labels + (("state", "idle"),), idle))
+            gauges.append(("audit_pool_max_connections", labels, node.max_size))
+    return Response(audit_metrics.render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/download/<job_id>/<filename>")
+def download_file(job_id, filename):
+    job = audit_jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return send_from_directory(job.output_folder, filename)
+
+
+# Opciones de auditoría del modo batch y nombre con que aparecen en el resumen
+BATCH_AUDIT_OPTIONS = {
+    "1": "relaciones",
+    "2": "integridad",
+    "3": "datos",
+    "4": "personalizado",
+    "5": "indices",
+    "6": "comparacion",
+}
+
+
+def load_batch_targets(config_path, options=None):
+    # Una sección por base de datos; [DEFAULT] sirve para los valores comunes (usuario, opciones...)
+    parser = configparser.ConfigParser()
+    if not parser.read(config_path, encoding="utf-8"):
+        raise ValueError(f"No se pudo leer el archivo de configuración: {config_path}")
+    targets = []
+    for name in parser.sections():
+        section = parser[name]
+        for key in ("server", "database"):
+            if not section.get(key):
+                raise ValueError(f"Falta '{key}' en la sección [{name}]")
+        target_options = options or [
+            option.strip() for option in section.get("options", "1,2,3").split(",") if option.strip()
+        ]
+        unknown = [option for option in target_options if option not in BATCH_AUDIT_OPTIONS]
+        if unknown:
+            raise ValueError(f"Opciones desconocidas en la sección [{name}]: {', '.join(unknown)}")
+        compare = None
+        if "6" in target_options:
+            for key in ("compare_server", "compare_database"):
+                if not section.get(key):
+                    raise ValueError(f"Falta '{key}' en la sección [{name}] para la comparación")
+            compare = {
+                "server": section["compare_server"],
+                "database": section["compare_database"],
+                "username": section.get("compare_username", section.get("username", "")),
+                "password": section.get(
+                    "compare_password", os.environ.get("AUDIT_COMPARE_PASSWORD", os.environ.get("AUDIT_PASSWORD", ""))
+                ),
+            }
+        targets.append({
+            "name": name,
+            "server": section["server"],
+            "database": section["database"],
+            "username": section.get("username", ""),
+            # La contraseña puede quedar fuera del archivo, en AUDIT_PASSWORD
+            "password": section.get("password", os.environ.get("AUDIT_PASSWORD", "")),
+            "options": target_options,
+            "connections": section.getint("connections", app.config["AUDIT_MAX_CONNECTIONS"]),
+            "replicas": [replica.strip() for replica in section.get("replicas", "").split(",") if replica.strip()],
+            "read_only": section.getboolean("read_only", False),
+            "compare": compare,
+            "settings": {
+                "sampling": section.getboolean("sampling", False),
+                "incremental": section.getboolean("incremental", False),
+                "duplicate_analysis": section.getboolean("duplicate_analysis", False),
+                "candidate_keys": section.get("candidate_keys", ""),
+                "chunked": section.getboolean("chunked", False),
+                "row_samples": section.getboolean("row_samples", False),
+                "quarantine": section.getboolean("quarantine", False),
+                "compare_with": (compare["server"], compare["database"], compare["username"]) if compare else None,
+            },
+        })
+    return targets
 
 
-@app.route("/download/<filename>")
-def download_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+def audit_target(target, output_folder):
+    # Corre en un proceso del pool: cada destino escribe sus logs en su propia carpeta
+    app.config["UPLOAD_FOLDER"] = os.path.join(output_folder, target["name"])
+    started = time.monotonic()
+    result = {
+        "name": target["name"],
+        "server": target["server"],
+        "database": target["database"],
+        "status": "finished",
+        "error": None,
+        "checks": [],
+    }
+    try:
+        pool = build_pool(
+            target["server"],
+            target["database"],
+            target["username"],
+            target["password"],
+            target["connections"],
+            target["replicas"],
+            target["read_only"],
+        )
+        # Verifica la conexión antes de empezar; queda ociosa en el pool
+        with pool.connection():
+            pass
+    except Exception as e:
+        result.update(status="failed", error=f"Error al conectar a la base de datos: {e}")
+        result["elapsed_seconds"] = round(time.monotonic() - started, 1)
+        return result
+    if target.get("compare"):
+        compare = target["compare"]
+        try:
+            connection_manager.connect(compare["server"], compare["database"], compare["username"], compare["password"])
+        except Exception as e:
+            pool.close()
+            result.update(status="failed", error=f"Error al conectar a la base de destino: {e}")
+            result["elapsed_seconds"] = round(time.monotonic() - started, 1)
+            return result
+
+    try:
+        for option in target["options"]:
+            progress = AuditProgress()
+            check = {"option": option, "name": BATCH_AUDIT_OPTIONS[option], "filepath": None, "error": None}
+            try:
+                routed = audit_pool(pool, option)
+                # Cada chequeo usa su propia conexión; con réplicas, del nodo que le corresponde
+                with routed.dedicated_connection() as connection:
+                    check["filepath"] = run_audit(option, connection, routed, progress, target["settings"])
+                check["lines"] = progress.output.lines if progress.output is not None else 0
+                check["records"] = progress.output.records if progress.output is not None else 0
+            except Exception as e:
+                check["error"] = str(e)
+                result["status"] = "failed"
+            progress.finish()
+            check.update(progress.snapshot())
+            result["checks"].append(check)
+    finally:
+        pool.close()
+    result["elapsed_seconds"] = round(time.monotonic() - started, 1)
+    return result
+
+
+def write_batch_summary(results, output_folder, elapsed_seconds):
+    lines = [
+        "==== RESUMEN DE AUDITORÍA BATCH ====",
+        f"Fecha y Hora: {datetime.datetime.now()}",
+        f"Bases auditadas: {len(results)} - Con errores: {sum(result['status'] == 'failed' for result in results)}",
+        f"Tiempo total: {elapsed_seconds} s",
+        "====================================",
+    ]
+    for result in results:
+        lines.append("")
+        lines.append(f"[{result['name']}] {result['server']}/{result['database']} - {JOB_STATUS_LABELS[result['status']]} - {result['elapsed_seconds']} s")
+        if result["error"]:
+            lines.append(f"  {result['error']}")
+        for check in result["checks"]:
+            if check["error"]:
+                lines.append(f"  {check['name']}: error - {check['error']}")
+            else:
+                lines.append(
+                    f"  {check['name']}: {check['lines']} líneas, {check['records']} resultados en {check['filepath']} - "
+                    f"{check['elapsed_seconds']} s"
+                )
+
+    with open(os.path.join(output_folder, "summary.txt"), "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+    with open(os.path.join(output_folder, "summary.json"), "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2, default=str)
+    return lines
+
+
+def run_batch(targets, output_folder, processes):
+    os.makedirs(output_folder, exist_ok=True)
+    started = time.monotonic()
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, min(processes, len(targets)))) as executor:
+        futures = {executor.submit(audit_target, target, output_folder): target for target in targets}
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # El proceso del pool terminó de forma anormal
+                result = {
+                    "name": target["name"],
+                    "server": target["server"],
+                    "database": target["database"],
+                    "status": "failed",
+                    "error": str(e),
+                    "checks": [],
+                    "elapsed_seconds": None,
+                }
+            print(f"[{result['name']}] {JOB_STATUS_LABELS[result['status']]}")
+            results.append(result)
+    results.sort(key=lambda result: [target["name"] for target in targets].index(result["name"]))
+    return results, write_batch_summary(results, output_folder, round(time.monotonic() - started, 1))
+
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(
+        description="Audita en paralelo las bases de datos listadas en un archivo de configuración."
+    )
+    parser.add_argument("config", help="archivo .ini con una sección por base de datos")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1,
+        help="cantidad de bases auditadas a la vez",
+    )
+    parser.add_argument(
+        "--output", default=None,
+        help="carpeta de salida (por defecto logs/batch_<fecha>)",
+    )
+    parser.add_argument(
+        "--options", default=None,
+        help="opciones a correr en todas las bases, separadas por comas (1 relaciones, 2 integridad, 3 datos, 4 log personalizado, 5 índices de FKs, 6 comparación)",
+    )
+    args = parser.parse_args(argv)
+
+    options = [option.strip() for option in args.options.split(",")] if args.options else None
+    try:
+        targets = load_batch_targets(args.config, options)
+    except ValueError as e:
+        parser.error(str(e))
+    if not targets:
+        parser.error("El archivo de configuración no tiene bases de datos para auditar.")
+
+    output_folder = args.output or os.path.join(
+        app.config["UPLOAD_FOLDER"], datetime.datetime.now().strftime("batch_%Y%m%d_%H%M%S")
+    )
+    results, summary = run_batch(targets, output_folder, args.processes)
+    print("\n".join(summary))
+    return 1 if any(result["status"] == "failed" for result in results) else 0
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     app.run(debug=True)
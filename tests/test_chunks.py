@@ -0,0 +1,133 @@
+import datetime
+import decimal
+import os
+import statistics
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import main
+from standin import StandInDatabase
+
+
+class MergeMomentsTests(unittest.TestCase):
+    def test_matches_the_moments_of_the_whole_table(self):
+        parts = [[1.0, 2.0, 4.0], [10.0], [], [3.5, 3.5, 7.0, 12.0]]
+        described = [
+            (len(part), statistics.mean(part) if part else None, statistics.stdev(part) if len(part) > 1 else None)
+            for part in parts
+        ]
+        mean, stddev = main.merge_moments(*zip(*described))
+        values = [value for part in parts for value in part]
+        self.assertAlmostEqual(mean, statistics.mean(values))
+        self.assertAlmostEqual(stddev, statistics.stdev(values))
+
+    def test_single_row_has_no_stddev(self):
+        self.assertEqual(main.merge_moments([0, 1], [None, 5.0], [None, None]), (5.0, None))
+
+    def test_empty_parts(self):
+        self.assertEqual(main.merge_moments([0, 0], [None, None], [None, None]), (None, None))
+
+
+class ChunkPredicatesTests(unittest.TestCase):
+    def setUp(self):
+        self.previous = main.app.config["AUDIT_CHUNK_ROWS"]
+        main.app.config["AUDIT_CHUNK_ROWS"] = 250
+
+    def tearDown(self):
+        main.app.config["AUDIT_CHUNK_ROWS"] = self.previous
+
+    def test_consecutive_partitions_are_grouped(self):
+        table = main.TableInfo(1, "dbo", "Ventas", 1000)
+        layout = ("pf_fecha", "fecha", "id", [(1, 300), (2, 200), (3, 250), (4, 250)])
+        method, predicates = main.chunk_predicates(None, table, layout)
+        self.assertEqual(method, "particiones de fecha")
+        self.assertEqual(predicates, [
+            "$PARTITION.[pf_fecha](t.[fecha]) = 1",
+            "$PARTITION.[pf_fecha](t.[fecha]) BETWEEN 2 AND 3",
+            "$PARTITION.[pf_fecha](t.[fecha]) = 4",
+        ])
+
+    def test_key_ranges_cover_every_row_exactly_once(self):
+        rows = [(number, None if number % 7 == 0 else number * 3) for number in range(1, 1001)]
+        database = StandInDatabase({"Ventas": ([("id", "int", False, None), ("monto", "int", True, None)], rows)})
+        table = main.TableInfo(1000, "dbo", "Ventas", len(rows))
+        table.columns = [main.ColumnInfo("id", "int", False, None), main.ColumnInfo("monto", "int", True, None)]
+        cursor = database.connect().cursor()
+        method, predicates = main.chunk_predicates(cursor, table, (None, None, "id", [(1, len(rows))]))
+        self.assertEqual(method, "rangos de id")
+        self.assertEqual(len(predicates), 4)
+        counts = [
+            cursor.execute(f"SELECT COUNT(*) AS n FROM {table.qualified_name} AS t WHERE {predicate}").fetchone().n
+            for predicate in predicates
+        ]
+        self.assertEqual(sum(counts), len(rows))
+        self.assertTrue(all(counts))
+
+    def test_table_without_usable_key_is_not_split(self):
+        table = main.TableInfo(1, "dbo", "Ventas", 1000)
+        table.columns = [main.ColumnInfo("codigo", "varchar", False, 20)]
+        self.assertEqual(main.chunk_predicates(None, table, (None, None, "codigo", [(1, 1000)])), (None, []))
+
+    def test_key_range_narrower_than_the_parts_is_not_split(self):
+        rows = [(number % 2, number) for number in range(1000)]
+        database = StandInDatabase({"Ventas": ([("id", "int", False, None), ("monto", "int", True, None)], rows)})
+        table = main.TableInfo(1000, "dbo", "Ventas", len(rows))
+        table.columns = [main.ColumnInfo("id", "int", False, None), main.ColumnInfo("monto", "int", True, None)]
+        cursor = database.connect().cursor()
+        self.assertEqual(main.chunk_predicates(cursor, table, (None, None, "id", [(1, len(rows))])), (None, []))
+
+
+class RunChunksTests(unittest.TestCase):
+    def setUp(self):
+        self.previous_store = main.audit_state_store
+        main.audit_state_store = main.AuditStateStore(":memory:")
+        rows = [(number, number % 10) for number in range(1, 101)]
+        self.database = StandInDatabase({"Ventas": ([("id", "int", False, None), ("monto", "int", True, None)], rows)})
+        table = main.TableInfo(1000, "dbo", "Ventas", len(rows))
+        self.plan = main.ChunkPlan(table, ("standin", "standin"), "datos", "rangos de id", [
+            "t.[id] < 50", "t.[id] >= 50 AND t.[id] < 80", "t.[id] >= 80",
+        ])
+
+    def tearDown(self):
+        main.audit_state_store = self.previous_store
+
+    def queries(self, broken=None):
+        return [
+            f"SELECT COUNT(*) AS filas, SUM(t.[monto]) AS total FROM "
+            f"{'dbo.NoExiste' if number == broken else self.plan.table.qualified_name} AS t WHERE {predicate}"
+            for number, predicate in enumerate(self.plan.predicates)
+        ]
+
+    def run_chunks(self, queries):
+        profiler = main.QueryProfiler()
+        token = main.current_profiler.set(profiler)
+        try:
+            rows = main.run_chunks(self.database.connect(), None, self.plan, "perfil", queries)
+        finally:
+            main.current_profiler.reset(token)
+        return [list(row) for row in rows], len(profiler.queries)
+
+    def test_interrupted_audit_resumes_with_the_missing_parts(self):
+        with self.assertRaises(Exception):
+            self.run_chunks(self.queries(broken=1))
+        # La primera parte quedó guardada: solo se recorren las dos que faltan
+        rows, executed = self.run_chunks(self.queries())
+        self.assertEqual(rows, [[49, 225], [30, 135], [21, 90]])
+        self.assertEqual(executed, 2)
+        rows, executed = self.run_chunks(self.queries())
+        self.assertEqual(executed, 0)
+
+    def test_finish_forgets_the_saved_parts(self):
+        self.run_chunks(self.queries())
+        self.plan.finish()
+        self.assertEqual(self.run_chunks(self.queries())[1], 3)
+
+    def test_saved_values_keep_their_type(self):
+        row = [decimal.Decimal("12.50"), datetime.date(2024, 2, 29), datetime.datetime(2024, 2, 29, 8, 30), 3, None]
+        self.assertEqual(main.decode_chunk_row(main.encode_chunk_row(row)), row)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import main
+from standin import StandInDatabase
+
+COLUMNS = [("id", "int", False, None), ("codigo", "varchar", True, 20), ("monto", "float", True, None)]
+
+
+def sales_rows(count=500):
+    return [(number, f"C-{number}", number * 1.5) for number in range(1, count + 1)]
+
+
+class RangeTests(unittest.TestCase):
+    def test_range_predicate(self):
+        self.assertEqual(main.range_predicate("t.[id]", None, None), "1 = 1")
+        self.assertEqual(main.range_predicate("t.[id]", 10, None), "t.[id] >= 10")
+        self.assertEqual(main.range_predicate("t.[id]", 10, 20), "t.[id] >= 10 AND t.[id] < 20")
+
+    def test_open_range_is_split_between_the_lowest_and_highest_keys(self):
+        ranges = main.split_range(None, None, 0, 160)
+        self.assertEqual(len(ranges), main.COMPARE_FANOUT)
+        self.assertEqual(ranges[0], (None, 10))
+        self.assertEqual(ranges[-1], (150, None))
+        self.assertTrue(all(low == previous_high for (_, previous_high), (low, _) in zip(ranges, ranges[1:])))
+
+    def test_range_that_cannot_be_split(self):
+        self.assertEqual(main.split_range(5, 6, 0, 160), [(5, 6)])
+
+
+class CompareTableTests(unittest.TestCase):
+    def setUp(self):
+        self.previous_limit = main.app.config["COMPARE_ROW_LIMIT"]
+        main.app.config["COMPARE_ROW_LIMIT"] = 10
+        self.table = main.TableInfo(1000, "dbo", "Ventas", 500)
+
+    def tearDown(self):
+        main.app.config["COMPARE_ROW_LIMIT"] = self.previous_limit
+
+    def compare(self, source_rows, target_rows, key_column="id", columns=COLUMNS, key_columns=("id",)):
+        self.table.columns = [main.ColumnInfo(*column) for column in columns]
+        source = StandInDatabase({"Ventas": (columns, source_rows)}, name="origen")
+        target = StandInDatabase({"Ventas": (columns, target_rows)}, name="destino")
+        sides = ((source.connect().cursor(), None), (target.connect().cursor(), None))
+        key = next((column for column in self.table.columns if column.name == key_column), None)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return main.compare_table(executor, sides, self.table, self.table.columns, list(key_columns), key)
+
+    def test_identical_tables(self):
+        row_counts, mismatches, transferred, unresolved = self.compare(sales_rows(), sales_rows())
+        self.assertEqual(row_counts, (500, 500))
+        self.assertEqual((mismatches, unresolved), ([], []))
+        self.assertEqual(transferred, 2)
+
+    def test_bisect_finds_changed_missing_and_extra_rows(self):
+        target = sales_rows()
+        target[6] = (7, "C-7", 0.0)
+        target[20] = (21, None, 31.5)
+        del target[299]
+        target.append((501, "C-501", 1.0))
+        row_counts, mismatches, transferred, unresolved = self.compare(sales_rows(), target)
+        self.assertEqual(row_counts, (500, 500))
+        self.assertEqual(mismatches, [
+            ("7", "tiene valores distintos"),
+            ("21", "tiene valores distintos"),
+            ("300", "solo existe en el origen"),
+            ("501", "solo existe en el destino"),
+        ])
+        self.assertEqual(unresolved, [])
+        # Solo se traen las filas de los rangos con diferencias, no las de toda la tabla
+        self.assertLess(transferred, 200)
+
+    def test_without_key_the_difference_is_not_located(self):
+        target = sales_rows()
+        target[0] = (1, "C-1", 0.0)
+        _, mismatches, _, unresolved = self.compare(sales_rows(), target, key_column=None)
+        self.assertEqual((mismatches, unresolved), ([], [((None, None), 500, 500)]))
+
+    def test_range_of_a_single_leading_key_value_is_not_fetched(self):
+        # PK (grupo, id) con 4 grupos de 125 filas: un grupo no se puede dividir por debajo del límite de 10 filas
+        columns = [("grupo", "int", False, None)] + COLUMNS
+        source_rows = [(number % 4, *row) for number, row in enumerate(sales_rows(), start=1)]
+        target_rows = list(source_rows)
+        target_rows[4] = (1, 5, "C-5", 0.0)
+        row_counts, mismatches, transferred, unresolved = self.compare(
+            source_rows, target_rows, "grupo", columns, ("grupo", "id")
+        )
+        self.assertEqual(row_counts, (500, 500))
+        self.assertEqual(mismatches, [])
+        self.assertEqual(unresolved, [((1, 2), 125, 125)])
+        self.assertLess(transferred, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
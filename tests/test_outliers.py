@@ -0,0 +1,75 @@
+import unittest
+
+import main
+
+
+def numeric_table(row_count=100):
+    table = main.TableInfo(1, "dbo", "Ventas", row_count)
+    table.columns = [main.ColumnInfo("monto", "int", True, None)]
+    return table
+
+
+# Histograma con 5 filas iguales a 10, 10 filas entre 10 y 20, 5 iguales a 20 y 10 iguales a 30
+STEPS = [(10, 0, 5), (20, 10, 5), (30, 0, 10)]
+
+
+class HistogramQuantileTests(unittest.TestCase):
+    def test_quantile_on_a_step_key(self):
+        self.assertEqual(main.histogram_quantile(STEPS, 0.1), 10)
+        self.assertEqual(main.histogram_quantile(STEPS, 0.75), 30)
+
+    def test_quantile_interpolated_inside_a_range(self):
+        # El cuartil 0.25 cae en la fila 7.5: 2.5 de las 10 filas entre 10 y 20
+        self.assertEqual(main.histogram_quantile(STEPS, 0.25), 12.5)
+
+    def test_quantile_past_the_end_returns_the_last_key(self):
+        self.assertEqual(main.histogram_quantile(STEPS, 1.5), 30)
+
+
+class HistogramCountOutsideTests(unittest.TestCase):
+    def test_counts_equal_rows_and_the_uniform_share_of_each_range(self):
+        # Fuera de [12, 25]: las 5 filas en 10, 2 de las 10 filas entre 10 y 20 y las 10 filas en 30
+        self.assertEqual(main.histogram_count_outside(STEPS, 12, 25), 17)
+
+    def test_nothing_outside_bounds_that_cover_the_histogram(self):
+        self.assertEqual(main.histogram_count_outside(STEPS, 0, 100), 0)
+
+
+class CountOutliersTests(unittest.TestCase):
+    def profile(self, table, mean, stddev):
+        profile = main.new_profile(table)
+        profile["row_count"] = 60
+        profile["columns"][0].update(non_null_count=60, null_count=0, mean=mean, stddev=stddev)
+        return profile
+
+    def test_server_counts_are_used_without_histogram(self):
+        table = numeric_table()
+        profile = self.profile(table, 20, 5)
+        profile["columns"][0].update(q1=15, q3=25)
+        main.count_outliers(table, profile, None, {}, {(0, "iqr_outliers"): 3, (0, "zscore_outliers"): 1})
+        column = profile["columns"][0]
+        self.assertEqual(column["outlier_bounds"], {"iqr_outliers": (0.0, 40.0), "zscore_outliers": (5, 35)})
+        self.assertEqual((column["iqr_outliers"], column["zscore_outliers"]), (3, 1))
+
+    def test_histogram_estimate_is_scaled_to_the_current_rows(self):
+        table = numeric_table()
+        profile = self.profile(table, 20, 2)
+        main.count_outliers(table, profile, None, {("dbo", "Ventas", "monto"): STEPS}, {})
+        column = profile["columns"][0]
+        self.assertEqual((column["q1"], column["q3"]), (12.5, 30))
+        self.assertEqual(column["outlier_source"], "histogram")
+        self.assertEqual(column["iqr_outliers"], 0)
+        # Fuera de [14, 26]: 5 + 4 + 10 = 19 de las 30 filas del histograma, escaladas a 60 filas no nulas
+        self.assertEqual(column["zscore_outliers"], 38)
+
+    def test_constant_column_has_no_zscore_outliers(self):
+        table = numeric_table()
+        profile = self.profile(table, 20, 0)
+        main.set_outlier_bounds(table, profile, {})
+        column = profile["columns"][0]
+        self.assertEqual(column["zscore_outliers"], 0)
+        self.assertNotIn("zscore_outliers", column["outlier_bounds"])
+
+
+if __name__ == "__main__":
+    unittest.main()